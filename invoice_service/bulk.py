@@ -0,0 +1,465 @@
+"""
+Offline bulk extraction with the Gemini Batch API.
+
+Backlog imports do not need answers in seconds, so instead of calling the model once per file they are sent as
+one batch job: the files are preprocessed exactly like on the /invoice path (`main.build_request`), written to a
+JSONL request file, submitted through a `BatchTransport` and the results are stored in `invoice_processes` once
+the job has finished. Batch requests are billed at a discount and do not count against the interactive quota.
+
+    python bulk.py submit --model gemini-2.5-flash /archive/2023 /archive/2024
+    python bulk.py status 3
+    python bulk.py wait 3
+    python bulk.py run --model gemini-2.5-flash /archive/2023   # submit and wait
+
+Jobs and their files are tracked in the `bulk_jobs` and `bulk_items` tables, so `wait` can be resumed after
+an interruption. BULK_API_BASE_URL points the transport at another Gemini API endpoint (e.g. a local fake).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Awaitable, BinaryIO, Callable, Dict, List, Optional, Tuple
+
+from database import Database
+from invoice_types import Invoice
+from utils import replace_null_values
+
+
+logger = logging.getLogger("invoice_service")
+
+
+# Local job status
+BULK_PREPARING = "preparing"
+BULK_SUBMITTED = "submitted"
+BULK_DONE = "done"
+BULK_FAILED = "failed"
+
+# Item status
+ITEM_PENDING = "pending"
+ITEM_DONE = "done"
+ITEM_FAILED = "failed"
+
+# Remote batch job states (google.genai.types.JobState)
+BATCH_SUCCEEDED = "JOB_STATE_SUCCEEDED"
+BATCH_PARTIALLY_SUCCEEDED = "JOB_STATE_PARTIALLY_SUCCEEDED"
+BATCH_FAILED_STATES = ("JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED")
+
+
+class BatchTransport:
+    """
+    Interface to a batch prediction service. A request file holds one JSON line per request
+    ({"key": ..., "request": GenerateContentRequest}), the result file one line per processed request
+    ({"key": ..., "response": GenerateContentResponse} or {"key": ..., "error": Status}).
+    """
+
+    async def submit(self, model_name: str, requests_path: Path, display_name: str) -> str:
+        """Upload the request file, start a batch job and return its name."""
+        raise NotImplementedError
+
+    async def get_state(self, job_name: str) -> Tuple[str, Optional[str]]:
+        """Return the job state (a JobState name) and its error message, if any."""
+        raise NotImplementedError
+
+    async def download_results(self, job_name: str) -> bytes:
+        """Return the JSONL result file of a finished job."""
+        raise NotImplementedError
+
+
+class GeminiBatchTransport(BatchTransport):
+    """Batch transport using the Gemini Batch API through the google-genai client."""
+
+    def __init__(self, client):
+        self.client = client
+
+    async def submit(self, model_name: str, requests_path: Path, display_name: str) -> str:
+        from google.genai import types
+
+        uploaded = await self.client.aio.files.upload(
+            file=str(requests_path),
+            config=types.UploadFileConfig(mime_type="jsonl", display_name=display_name),
+        )
+        job = await self.client.aio.batches.create(
+            model=model_name,
+            src=uploaded.name,
+            config=types.CreateBatchJobConfig(display_name=display_name),
+        )
+        return job.name
+
+    async def get_state(self, job_name: str) -> Tuple[str, Optional[str]]:
+        job = await self.client.aio.batches.get(name=job_name)
+        state = getattr(job.state, "value", job.state)
+        return state, job.error.message if job.error else None
+
+    async def download_results(self, job_name: str) -> bytes:
+        job = await self.client.aio.batches.get(name=job_name)
+        if not job.dest or not job.dest.file_name:
+            raise RuntimeError(f"Batch job {job_name} has no result file")
+        return await self.client.aio.files.download(file=job.dest.file_name)
+
+
+def setup_bulk_tables(cursor: sqlite3.Cursor):
+    """Create the tables tracking bulk jobs and their files."""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS bulk_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        batch_name TEXT,
+        model TEXT NOT NULL,
+        status TEXT NOT NULL,
+        batch_state TEXT,
+        request_count INTEGER NOT NULL DEFAULT 0,
+        error_message TEXT,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS bulk_items (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        bulk_job_id INTEGER NOT NULL,
+        file_id TEXT NOT NULL,
+        file_name TEXT NOT NULL,
+        file_type TEXT NOT NULL,
+        extra_fields TEXT,
+        status TEXT NOT NULL,
+        error_message TEXT
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_bulk_items_job ON bulk_items (bulk_job_id, status)")
+
+
+def request_line(key: str, contents: List[Any], system_instruction: str, response_schema: Dict[str, Any]) -> str:
+    """Serialize one GenerateContentRequest as a line of a batch request file."""
+    from google.genai import types
+
+    parts = [types.Part.from_text(text=item) if isinstance(item, str) else item for item in contents]
+    content = types.Content(role="user", parts=parts).model_dump(mode="json", exclude_none=True, by_alias=True)
+    request = {
+        "contents": [content],
+        "systemInstruction": {"parts": [{"text": system_instruction}]},
+        "generationConfig": {"responseMimeType": "application/json", "responseSchema": response_schema},
+    }
+    return json.dumps({"key": key, "request": request}) + "\n"
+
+
+def invoice_response_schema() -> Dict[str, Any]:
+    """The Invoice response schema in the API format, as the SDK sends it for `response_schema=Invoice`."""
+    from google.genai import types
+
+    schema = types.Schema.from_json_schema(json_schema=types.JSONSchema.model_validate(Invoice.model_json_schema()))
+    return schema.model_dump(mode="json", exclude_none=True, by_alias=True)
+
+
+def parse_result_line(line: Dict[str, Any], model_name: str) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """Turn one result line into an extraction result like `generate_response` returns, or an error message."""
+    error = line.get("error") or line.get("status")
+    if error:
+        return None, error.get("message") or json.dumps(error)
+
+    response = line.get("response") or {}
+    candidates = response.get("candidates") or []
+    if not candidates:
+        reason = (response.get("promptFeedback") or {}).get("blockReason") or "no candidates"
+        return None, f"Empty response from the model ({reason})"
+    parts = (candidates[0].get("content") or {}).get("parts") or []
+    text = "".join(part.get("text", "") for part in parts if not part.get("thought"))
+    if not text:
+        return None, f"Empty response from the model ({candidates[0].get('finishReason')})"
+
+    try:
+        invoice = Invoice.model_validate_json(text)
+    except ValueError as e:
+        return None, f"Invalid response from the model: {str(e)}"
+
+    usage = response.get("usageMetadata") or {}
+    return {
+        "invoice": replace_null_values(invoice.model_dump()),
+        "total_token_count": usage.get("totalTokenCount"),
+        "input_token_count": usage.get("promptTokenCount"),
+        "output_token_count": usage.get("candidatesTokenCount"),
+        "thoughts_token_count": usage.get("thoughtsTokenCount"),
+        "cached_token_count": usage.get("cachedContentTokenCount") or 0,
+        "model": model_name,
+    }, None
+
+
+class BulkJobs:
+    """
+    Bulk extraction jobs: prepare the request file, submit it through the transport, poll the job
+    and store the results. `build_request(file_type, document)` returns the model contents and the
+    fields added to the result, `save_result(file_id, file_name, file_type, model, result, error)`
+    stores a processing record (both are provided by main).
+    """
+
+    def __init__(self, db: Database, transport: BatchTransport,
+                 build_request: Callable[[str, BinaryIO], Awaitable[Tuple[List[Any], Dict[str, Any]]]],
+                 save_result: Callable[..., Awaitable[None]], system_instruction: str,
+                 concurrency: int = 4, poll_interval: float = 60.0, spool_dir: Optional[str] = None):
+        self.db = db
+        self.transport = transport
+        self.build_request = build_request
+        self.save_result = save_result
+        self.system_instruction = system_instruction
+        self.concurrency = max(1, concurrency)
+        self.poll_interval = poll_interval
+        self.spool_dir = spool_dir
+
+        self._response_schema: Optional[Dict[str, Any]] = None
+
+    async def submit(self, model_name: str, files: List[Tuple[Path, str, str]], display_name: str = "") -> int:
+        """
+        Preprocess the files, given as (path, file_id, file_type), and submit them as one batch job.
+        Files failing preprocessing are stored as failed records and left out of the job.
+        Returns the local bulk job ID.
+        """
+        if self._response_schema is None:
+            self._response_schema = invoice_response_schema()
+
+        now = datetime.now().isoformat()
+        job_id = await self.db.execute(
+            "INSERT INTO bulk_jobs (model, status, created_at, updated_at) VALUES (?, ?, ?, ?)",
+            [model_name, BULK_PREPARING, now, now]
+        )
+        display_name = display_name or f"invoice-service-bulk-{job_id}"
+
+        with tempfile.NamedTemporaryFile("w", suffix=".jsonl", dir=self.spool_dir, delete=False) as requests_file:
+            requests_path = Path(requests_file.name)
+        try:
+            request_count = await self._write_requests(job_id, model_name, files, requests_path)
+            if not request_count:
+                await self._update_job(job_id, status=BULK_DONE)
+                return job_id
+
+            try:
+                batch_name = await self.transport.submit(model_name, requests_path, display_name)
+            except Exception as e:
+                logger.error(f"Bulk job {job_id} could not be submitted: {str(e)}")
+                await self._fail_pending(job_id, f"Batch job not submitted: {str(e)}")
+                await self._update_job(job_id, status=BULK_FAILED, error_message=str(e))
+                raise
+        finally:
+            requests_path.unlink(missing_ok=True)
+
+        await self._update_job(job_id, status=BULK_SUBMITTED, batch_name=batch_name, request_count=request_count)
+        logger.info(f"Submitted bulk job {job_id} as {batch_name} with {request_count} requests")
+        return job_id
+
+    async def _write_requests(self, job_id: int, model_name: str, files: List[Tuple[Path, str, str]],
+                              requests_path: Path) -> int:
+        """Preprocess the files concurrently and append their request lines; returns the number of requests."""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        write_lock = asyncio.Lock()
+        request_count = 0
+
+        async def prepare(path: Path, file_id: str, file_type: str, requests_file):
+            nonlocal request_count
+            async with semaphore:
+                try:
+                    with open(path, "rb") as document:
+                        contents, extra_fields = await self.build_request(file_type, document)
+                except Exception as e:
+                    logger.error(f"Error preparing bulk file {path.name}: {str(e)}")
+                    await self._insert_item(job_id, file_id, path.name, file_type, None, ITEM_FAILED, str(e))
+                    await self.save_result(file_id, path.name, file_type, model_name, None, str(e))
+                    return
+
+                item_id = await self._insert_item(job_id, file_id, path.name, file_type, extra_fields, ITEM_PENDING)
+                line = await asyncio.to_thread(
+                    request_line, str(item_id), contents, self.system_instruction, self._response_schema
+                )
+                async with write_lock:
+                    await asyncio.to_thread(requests_file.write, line)
+                    request_count += 1
+
+        with open(requests_path, "w") as requests_file:
+            await asyncio.gather(*(prepare(path, file_id, file_type, requests_file)
+                                   for path, file_id, file_type in files))
+        return request_count
+
+    async def refresh(self, job_id: int) -> Dict[str, Any]:
+        """Poll the batch job once and store its results when it has finished; returns the job."""
+        job = await self.get(job_id)
+        if job is None:
+            raise KeyError(f"Bulk job {job_id} not found")
+        if job["status"] != BULK_SUBMITTED:
+            return job
+
+        state, error_message = await self.transport.get_state(job["batch_name"])
+        if state in (BATCH_SUCCEEDED, BATCH_PARTIALLY_SUCCEEDED):
+            await self._store_results(job)
+            await self._fail_pending(job_id, "No result in the batch output")
+            await self._update_job(job_id, status=BULK_DONE, batch_state=state, error_message=error_message)
+        elif state in BATCH_FAILED_STATES:
+            logger.error(f"Bulk job {job_id} ended in state {state}: {error_message}")
+            await self._fail_pending(job_id, f"Batch job ended in state {state}")
+            await self._update_job(job_id, status=BULK_FAILED, batch_state=state, error_message=error_message)
+        elif state != job["batch_state"]:
+            await self._update_job(job_id, batch_state=state)
+        return await self.get(job_id)
+
+    async def wait(self, job_id: int) -> Dict[str, Any]:
+        """Poll the batch job every `poll_interval` seconds until it is done or failed."""
+        while True:
+            job = await self.refresh(job_id)
+            if job["status"] != BULK_SUBMITTED:
+                return job
+            logger.info(f"Bulk job {job_id} is {job['batch_state']}, {job['items'].get(ITEM_PENDING, 0)} files pending")
+            await asyncio.sleep(self.poll_interval)
+
+    async def get(self, job_id: int) -> Optional[Dict[str, Any]]:
+        """Return the bulk job with the number of its files per status."""
+        def query(conn: sqlite3.Connection):
+            row = conn.execute("SELECT * FROM bulk_jobs WHERE id = ?", [job_id]).fetchone()
+            counts = conn.execute(
+                "SELECT status, COUNT(*) FROM bulk_items WHERE bulk_job_id = ? GROUP BY status", [job_id]
+            ).fetchall()
+            return row, counts
+
+        row, counts = await self.db.run_read(query)
+        if row is None:
+            return None
+        return {**dict(row), "items": {status: count for status, count in counts}}
+
+    async def _store_results(self, job: Dict[str, Any]):
+        """Download the result file and store one processing record per pending file."""
+        content = await self.transport.download_results(job["batch_name"])
+        items = await self.db.run_read(lambda conn: {
+            str(row["id"]): dict(row) for row in conn.execute(
+                "SELECT * FROM bulk_items WHERE bulk_job_id = ? AND status = ?", [job["id"], ITEM_PENDING]
+            )
+        })
+
+        for raw_line in content.splitlines():
+            if not raw_line.strip():
+                continue
+            line = json.loads(raw_line)
+            item = items.pop(str(line.get("key")), None)
+            if item is None:
+                # Unknown key or a file stored by an interrupted earlier run
+                continue
+
+            result, error_message = parse_result_line(line, job["model"])
+            if result is not None:
+                result.update(json.loads(item["extra_fields"] or "{}"))
+                result["file_id"] = item["file_id"]
+                result["bulk_job_id"] = job["id"]
+            await self.save_result(item["file_id"], item["file_name"], item["file_type"], job["model"],
+                                   result, error_message)
+            await self.db.execute(
+                "UPDATE bulk_items SET status = ?, error_message = ? WHERE id = ?",
+                [ITEM_FAILED if error_message else ITEM_DONE, error_message, item["id"]]
+            )
+
+    async def _insert_item(self, job_id: int, file_id: str, file_name: str, file_type: str,
+                           extra_fields: Optional[Dict[str, Any]], status: str,
+                           error_message: Optional[str] = None) -> int:
+        return await self.db.execute('''
+        INSERT INTO bulk_items (bulk_job_id, file_id, file_name, file_type, extra_fields, status, error_message)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [job_id, file_id, file_name, file_type,
+              json.dumps(extra_fields) if extra_fields is not None else None, status, error_message])
+
+    async def _fail_pending(self, job_id: int, error_message: str):
+        await self.db.execute(
+            "UPDATE bulk_items SET status = ?, error_message = ? WHERE bulk_job_id = ? AND status = ?",
+            [ITEM_FAILED, error_message, job_id, ITEM_PENDING]
+        )
+
+    async def _update_job(self, job_id: int, **fields: Any):
+        fields["updated_at"] = datetime.now().isoformat()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        await self.db.execute(f"UPDATE bulk_jobs SET {assignments} WHERE id = ?", [*fields.values(), job_id])
+
+
+def collect_files(paths: List[str], file_types: Dict[str, str]) -> List[Tuple[Path, str, str]]:
+    """Expand files and directories (recursively) into (path, file_id, file_type) for the supported files."""
+    files = []
+    for path in map(Path, paths):
+        candidates = sorted(p for p in path.rglob("*") if p.is_file()) if path.is_dir() else [path]
+        for candidate in candidates:
+            file_type = file_types.get(candidate.suffix.lower().lstrip("."))
+            if file_type is None or candidate.name.startswith("."):
+                logger.warning(f"Skipping unsupported file {candidate}")
+                continue
+            files.append((candidate, candidate.name, file_type))
+    return files
+
+
+async def _run_command(args: argparse.Namespace) -> int:
+    import main as service
+    from google import genai
+    from google.genai import types
+
+    try:
+        service.setup_logging()
+        service.check_pdf_settings()
+    except RuntimeError:
+        return 1
+    service.setup_database()
+    api_key = os.environ.get("GEMINI_API_KEY")
+    if not api_key:
+        logger.error("GEMINI_API_KEY environment variable not set")
+        return 1
+
+    base_url = os.environ.get("BULK_API_BASE_URL")
+    client = genai.Client(api_key=api_key, http_options=types.HttpOptions(base_url=base_url) if base_url else None)
+
+    service.db = Database(service.DB_PATH, batch_size=service.DB_BATCH_SIZE)
+    service.db.start()
+    try:
+        bulk_jobs = BulkJobs(
+            service.db,
+            GeminiBatchTransport(client),
+            service.build_request,
+            service._save_result,
+            service.SYSTEM_INSTRUCTION,
+            concurrency=service.BATCH_CONCURRENCY,
+            poll_interval=args.poll_interval,
+        )
+
+        if args.command in ("submit", "run"):
+            files = collect_files(args.paths, service.FILE_TYPES)
+            if not files:
+                logger.error("No supported files found")
+                return 1
+            job_id = await bulk_jobs.submit(args.model or service.MODEL_NAME, files)
+        else:
+            job_id = args.job_id
+
+        if args.command in ("wait", "run"):
+            job = await bulk_jobs.wait(job_id)
+        elif args.command == "status":
+            job = await bulk_jobs.refresh(job_id)
+        else:
+            job = await bulk_jobs.get(job_id)
+        print(json.dumps(job, indent=2))
+        return 0 if job["status"] != BULK_FAILED else 1
+    finally:
+        service.db.stop()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--poll-interval", type=float, default=60, help="Seconds between job state checks")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name in ("submit", "run"):
+        command = commands.add_parser(name, help="Submit files" + (" and wait for the results" if name == "run" else ""))
+        command.add_argument("--model", default="", help="Gemini model (GEMINI_MODEL by default)")
+        command.add_argument("paths", nargs="+", help="Invoice files or directories")
+    for name in ("status", "wait"):
+        command = commands.add_parser(name, help="Check a job" if name == "status" else "Wait for a job's results")
+        command.add_argument("job_id", type=int)
+    args = parser.parse_args()
+
+    if args.command in ("submit", "run") and not (args.model or os.environ.get("GEMINI_MODEL")):
+        parser.error("--model or GEMINI_MODEL is required")
+    return asyncio.run(_run_command(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
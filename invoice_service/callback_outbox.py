@@ -0,0 +1,224 @@
+import asyncio
+import json
+import logging
+import random
+import sqlite3
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Set
+
+from metrics import STAGE_CALLBACK_DELIVERY, observe_stage, count_error
+
+
+logger = logging.getLogger("invoice_service")
+
+
+CALLBACK_PENDING = "pending"
+CALLBACK_DELIVERING = "delivering"
+CALLBACK_DELIVERED = "delivered"
+CALLBACK_FAILED = "failed"
+
+# Responses worth retrying; other client errors will not succeed on a later attempt
+RETRYABLE_STATUS_CODES = (408, 425, 429)
+
+
+class CallbackOutbox:
+    """
+    Persistent outbox for result callbacks, drained by a background dispatcher.
+
+    Callbacks are stored in the `callback_outbox` table before they are sent, so an unreachable
+    endpoint or a restart does not lose results. Failed deliveries are retried with exponential
+    backoff and jitter until `max_attempts`; at most `concurrency` callbacks are in flight and
+    they share the pooled HTTP client passed in (an httpx.AsyncClient).
+    """
+
+    def __init__(self, db, http_client, concurrency: int = 8, max_attempts: int = 8,
+                 base_delay: float = 2.0, max_delay: float = 600.0, poll_interval: float = 1.0,
+                 drain_timeout: float = 10.0):
+        self.db = db
+        self.http_client = http_client
+        self.concurrency = max(1, concurrency)
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.drain_timeout = drain_timeout
+
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._in_flight: Set[asyncio.Task] = set()
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+
+    @staticmethod
+    def _create_table(conn: sqlite3.Connection):
+        cursor = conn.cursor()
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS callback_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            url TEXT NOT NULL,
+            payload TEXT,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TEXT NOT NULL,
+            last_error TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+        ''')
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_callback_outbox_due ON callback_outbox (status, next_attempt_at)"
+        )
+
+    async def start(self):
+        """Recover interrupted deliveries and start the dispatcher."""
+        await self.db.run_write(self._create_table)
+        recovered = await self.db.run_write(self._recover)
+        if recovered:
+            logger.info(f"Recovered {recovered} interrupted callbacks from the previous run")
+
+        self._stopping = False
+        self._dispatcher = asyncio.create_task(self._dispatch())
+        logger.info(f"Callback outbox started (concurrency {self.concurrency})")
+
+    async def stop(self):
+        """Stop the dispatcher and give the deliveries in flight `drain_timeout` seconds to finish."""
+        self._stopping = True
+        self._wakeup.set()
+        if self._dispatcher is None:
+            return
+        self._dispatcher.cancel()
+        await asyncio.gather(self._dispatcher, return_exceptions=True)
+        self._dispatcher = None
+
+        if self._in_flight:
+            done, pending = await asyncio.wait(self._in_flight, timeout=self.drain_timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                # Cancelled deliveries stay in the delivering state and are retried on the next start
+                await asyncio.gather(*pending, return_exceptions=True)
+                logger.warning(f"Callback outbox drain timed out, {len(pending)} callbacks will be retried on restart")
+        logger.info("Callback outbox stopped")
+
+    async def enqueue(self, url: str, payload: Dict[str, Any]) -> int:
+        """Persist a callback and wake up the dispatcher. Returns the callback ID."""
+        now = datetime.now().isoformat()
+        callback_id = await self.db.execute('''
+        INSERT INTO callback_outbox (url, payload, status, next_attempt_at, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', [url, json.dumps(payload), CALLBACK_PENDING, now, now, now])
+        self._wakeup.set()
+        return callback_id
+
+    async def get_callback(self, callback_id: int) -> Optional[Dict[str, Any]]:
+        """Return the delivery state of a callback (without the payload)."""
+        row = await self.db.run_read(lambda conn: conn.execute('''
+        SELECT id, url, status, attempts, next_attempt_at, last_error, created_at, updated_at
+        FROM callback_outbox WHERE id = ?
+        ''', [callback_id]).fetchone())
+        return dict(row) if row else None
+
+    async def pending_count(self) -> int:
+        """Return the number of callbacks waiting for (or in) delivery."""
+        return await self.db.run_read(lambda conn: conn.execute(
+            "SELECT COUNT(*) FROM callback_outbox WHERE status IN (?, ?)", [CALLBACK_PENDING, CALLBACK_DELIVERING]
+        ).fetchone()[0])
+
+    def backoff(self, attempts: int) -> float:
+        """Seconds to wait before the next attempt: exponential in the attempts made, with jitter."""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return random.uniform(delay / 2, delay)
+
+    async def _dispatch(self):
+        while not self._stopping:
+            self._wakeup.clear()
+            free = self.concurrency - len(self._in_flight)
+            callbacks = await self.db.run_write(lambda conn: self._claim(conn, free)) if free > 0 else []
+            for callback in callbacks:
+                task = asyncio.create_task(self._deliver(callback))
+                self._in_flight.add(task)
+                task.add_done_callback(self._delivery_done)
+
+            if self._in_flight and len(self._in_flight) >= self.concurrency:
+                # Every slot is busy, wait for one of them before claiming more
+                await asyncio.wait(set(self._in_flight), return_when=asyncio.FIRST_COMPLETED)
+                continue
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _delivery_done(self, task: asyncio.Task):
+        self._in_flight.discard(task)
+        self._wakeup.set()
+
+    async def _deliver(self, callback: Dict[str, Any]):
+        error = None
+        retryable = True
+        error_type = None
+        try:
+            with observe_stage(STAGE_CALLBACK_DELIVERY, "", ""):
+                response = await self.http_client.post(
+                    callback["url"],
+                    content=callback["payload"],
+                    headers={"Content-Type": "application/json"}
+                )
+            if response.status_code >= 300:
+                error = f"HTTP {response.status_code}"
+                error_type = f"http_{response.status_code}"
+                retryable = response.status_code >= 500 or response.status_code in RETRYABLE_STATUS_CODES
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            error_type = type(e).__name__
+        if error_type:
+            count_error(STAGE_CALLBACK_DELIVERY, error_type, "")
+
+        now = datetime.now()
+        if error is None:
+            # The payload is no longer needed once it was delivered
+            await self.db.execute(
+                "UPDATE callback_outbox SET status = ?, payload = NULL, last_error = NULL, updated_at = ? WHERE id = ?",
+                [CALLBACK_DELIVERED, now.isoformat(), callback["id"]]
+            )
+        elif retryable and callback["attempts"] < self.max_attempts:
+            delay = self.backoff(callback["attempts"])
+            logger.warning(f"Callback {callback['id']} to {callback['url']} failed ({error}), "
+                           f"attempt {callback['attempts']} of {self.max_attempts}, retrying in {delay:.0f} s")
+            await self.db.execute(
+                "UPDATE callback_outbox SET status = ?, next_attempt_at = ?, last_error = ?, updated_at = ? WHERE id = ?",
+                [CALLBACK_PENDING, (now + timedelta(seconds=delay)).isoformat(), error, now.isoformat(), callback["id"]]
+            )
+        else:
+            logger.error(f"Callback {callback['id']} to {callback['url']} failed after "
+                         f"{callback['attempts']} attempts: {error}")
+            await self.db.execute(
+                "UPDATE callback_outbox SET status = ?, last_error = ?, updated_at = ? WHERE id = ?",
+                [CALLBACK_FAILED, error, now.isoformat(), callback["id"]]
+            )
+
+    @staticmethod
+    def _claim(conn: sqlite3.Connection, limit: int) -> List[Dict[str, Any]]:
+        # Runs in the writer transaction, so selecting and marking the callbacks is atomic
+        cursor = conn.cursor()
+        now = datetime.now().isoformat()
+        cursor.execute('''
+        SELECT * FROM callback_outbox WHERE status = ? AND next_attempt_at <= ?
+        ORDER BY next_attempt_at, id LIMIT ?
+        ''', [CALLBACK_PENDING, now, limit])
+        rows = [dict(row) for row in cursor.fetchall()]
+        for row in rows:
+            row["attempts"] += 1
+            cursor.execute(
+                "UPDATE callback_outbox SET status = ?, attempts = ?, updated_at = ? WHERE id = ?",
+                [CALLBACK_DELIVERING, row["attempts"], now, row["id"]]
+            )
+        return rows
+
+    @staticmethod
+    def _recover(conn: sqlite3.Connection) -> int:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE callback_outbox SET status = ?, updated_at = ? WHERE status = ?",
+            [CALLBACK_PENDING, datetime.now().isoformat(), CALLBACK_DELIVERING]
+        )
+        return cursor.rowcount
@@ -0,0 +1,108 @@
+import io
+import logging
+import threading
+import time
+import zipfile
+from typing import BinaryIO
+
+
+logger = logging.getLogger("invoice_service")
+
+
+class DocumentConverter:
+    """
+    Shared MarkItDown converter used by all requests.
+
+    Creating MarkItDown builds its converter registry and loads the Magika file type model, and the
+    first conversion of each type imports pdfminer or mammoth; doing that once (ideally at startup with
+    `warm_up`) keeps it off the request path. Conversions do not modify the converter, so the instance
+    is used concurrently from the worker threads; only its creation is guarded by a lock.
+    """
+
+    def __init__(self, enable_plugins: bool = False):
+        self.enable_plugins = enable_plugins
+        self._markitdown = None
+        self._lock = threading.Lock()
+
+    def _get(self):
+        if self._markitdown is None:
+            with self._lock:
+                if self._markitdown is None:
+                    from markitdown import MarkItDown  # Microsoft's library for converting documents to markdown
+                    self._markitdown = MarkItDown(enable_plugins=self.enable_plugins)
+        return self._markitdown
+
+    def convert(self, document: BinaryIO, mime_type: str) -> str:
+        """Convert a document to markdown text (blocking, run in a worker thread)."""
+        from markitdown import StreamInfo
+
+        document.seek(0)
+        result = self._get().convert_stream(document, stream_info=StreamInfo(mimetype=mime_type))
+        return result.text_content or ""
+
+    def warm_up(self):
+        """Create the converter and run a tiny PDF and DOCX conversion to load all lazy imports."""
+        start = time.perf_counter()
+        for mime_type, content in (
+            ("application/pdf", _sample_pdf()),
+            ("application/vnd.openxmlformats-officedocument.wordprocessingml.document", _sample_docx()),
+        ):
+            try:
+                self.convert(io.BytesIO(content), mime_type)
+            except Exception as e:
+                logger.warning(f"Converter warm-up for {mime_type} failed: {str(e)}")
+        logger.info(f"Document converter warmed up in {time.perf_counter() - start:.2f} s")
+
+
+def _sample_pdf(text: str = "Invoice") -> bytes:
+    """Build a minimal one-page PDF with a line of text."""
+    stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET".encode()
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R "
+        b"/Resources << /Font << /F1 5 0 R >> >> >>",
+        b"<< /Length " + str(len(stream)).encode() + b" >>\nstream\n" + stream + b"\nendstream",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    pdf = io.BytesIO()
+    pdf.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(pdf.tell())
+        pdf.write(f"{number} 0 obj\n".encode() + body + b"\nendobj\n")
+    xref = pdf.tell()
+    pdf.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode())
+    for offset in offsets:
+        pdf.write(f"{offset:010d} 00000 n \n".encode())
+    pdf.write(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+    return pdf.getvalue()
+
+
+def _sample_docx(text: str = "Invoice") -> bytes:
+    """Build a minimal DOCX document with one paragraph."""
+    docx = io.BytesIO()
+    with zipfile.ZipFile(docx, "w") as archive:
+        archive.writestr("[Content_Types].xml", (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/word/document.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+            '</Types>'
+        ))
+        archive.writestr("_rels/.rels", (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Target="word/document.xml" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+            '</Relationships>'
+        ))
+        archive.writestr("word/document.xml", (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+            f'<w:body><w:p><w:r><w:t>{text}</w:t></w:r></w:p></w:body>'
+            '</w:document>'
+        ))
+    return docx.getvalue()
@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+
+
+logger = logging.getLogger("invoice_service")
+
+
+# Connection settings applied to every connection (journal_mode=WAL is persistent in the file)
+PRAGMAS = (
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),  # Safe with WAL, fsync only at checkpoints
+    ("busy_timeout", "5000"),
+    ("temp_store", "MEMORY"),
+    ("cache_size", "-16000"),  # 16 MB page cache
+    ("mmap_size", str(64 * 1024 * 1024)),
+)
+
+_STOP = object()
+
+
+def connect(db_path: Path, **kwargs) -> sqlite3.Connection:
+    """Open a SQLite connection with the service pragmas applied."""
+    conn = sqlite3.connect(db_path, **kwargs)
+    for name, value in PRAGMAS:
+        conn.execute(f"PRAGMA {name}={value}")
+    return conn
+
+
+def _is_lock_error(error: Exception) -> bool:
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ("locked" in message or "busy" in message)
+
+
+class Database:
+    """
+    SQLite access layer shared by the service.
+
+    All writes go through a single background writer thread that groups the queued operations
+    into one transaction, so concurrent requests do not serialize on the database lock.
+    Reads use long-lived per-thread connections and are offloaded from the event loop.
+    """
+
+    def __init__(self, db_path: Path, batch_size: int = 100, lock_retries: int = 3):
+        self.db_path = db_path
+        self.batch_size = max(1, batch_size)
+        self.lock_retries = lock_retries
+
+        self._queue: "queue.Queue[Any]" = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        self._local = threading.local()
+        self._read_connections: List[sqlite3.Connection] = []
+        self._read_connections_lock = threading.Lock()
+
+    def start(self):
+        """Start the background writer thread."""
+        if self._writer is not None:
+            return
+        self._writer = threading.Thread(target=self._writer_loop, name="db-writer", daemon=True)
+        self._writer.start()
+
+    def stop(self):
+        """Flush the pending writes and close all connections."""
+        if self._writer is not None:
+            self._queue.put(_STOP)
+            self._writer.join()
+            self._writer = None
+        with self._read_connections_lock:
+            for conn in self._read_connections:
+                conn.close()
+            self._read_connections = []
+        self._local = threading.local()
+
+    def write(self, fn: Callable[[sqlite3.Connection], Any]) -> Future:
+        """Queue fn(connection) to run in the writer thread inside a batched transaction."""
+        if self._writer is None:
+            raise RuntimeError("Database writer is not running")
+        future: Future = Future()
+        self._queue.put((fn, future))
+        return future
+
+    def write_nowait(self, fn: Callable[[sqlite3.Connection], Any]):
+        """Queue a write whose result is not needed; failures are only logged."""
+        self.write(fn).add_done_callback(self._log_failure)
+
+    async def run_write(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        """Queue a write and wait until its transaction is committed."""
+        return await asyncio.wrap_future(self.write(fn))
+
+    async def execute(self, sql: str, params: Sequence[Any] = ()) -> int:
+        """Execute a single write statement and return the last inserted row ID."""
+        return await self.run_write(lambda conn: conn.execute(sql, params).lastrowid)
+
+    def read(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        """Run fn(connection) on the calling thread's read connection."""
+        return fn(self._read_connection())
+
+    async def run_read(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        """Run a read in a worker thread so the event loop is not blocked."""
+        return await asyncio.to_thread(self.read, fn)
+
+    def _read_connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect(self.db_path, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+            with self._read_connections_lock:
+                self._read_connections.append(conn)
+        return conn
+
+    def _writer_loop(self):
+        conn = connect(self.db_path, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        stopping = False
+        try:
+            while not stopping:
+                item = self._queue.get()
+                if item is _STOP:
+                    break
+                batch = [item]
+                # Everything queued while the previous transaction was committing goes into this one
+                while len(batch) < self.batch_size:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+                # Writes whose caller was cancelled while they were queued are skipped
+                batch = [(fn, future) for fn, future in batch if future.set_running_or_notify_cancel()]
+                if batch:
+                    self._commit_batch(conn, batch)
+        finally:
+            conn.close()
+
+    def _commit_batch(self, conn: sqlite3.Connection, batch: List[Tuple[Callable, Future]]):
+        for attempt in range(self.lock_retries + 1):
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                results = [fn(conn) for fn, _ in batch]
+                conn.execute("COMMIT")
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                if _is_lock_error(e) and attempt < self.lock_retries:
+                    time.sleep(0.05 * 2 ** attempt)
+                    continue
+                if len(batch) > 1:
+                    # Isolate the failing operation so the rest of the batch is still committed
+                    for item in batch:
+                        self._commit_batch(conn, [item])
+                else:
+                    batch[0][1].set_exception(e)
+                return
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+            return
+
+    @staticmethod
+    def _log_failure(future: Future):
+        if future.exception() is not None:
+            logger.error(f"Database write failed: {str(future.exception())}")
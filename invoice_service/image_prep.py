@@ -0,0 +1,111 @@
+import io
+import math
+from typing import Any, BinaryIO, Dict, Tuple
+
+from PIL import Image, ImageOps
+
+
+# Gemini bills an image with both sides up to 384 px as one tile, larger images as 768x768 tiles
+TOKENS_PER_TILE = 258
+SMALL_IMAGE_SIZE = 384
+TILE_SIZE = 768
+
+IMAGE_FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+
+GRAYSCALE_MODES = ("auto", "always", "never")
+
+# Share of clearly colored pixels below which a page is treated as grayscale in the "auto" mode
+_COLOR_SATURATION = 48
+_COLOR_PIXEL_SHARE = 0.005
+
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """Estimate the input tokens Gemini bills for an image of the given size."""
+    if width <= SMALL_IMAGE_SIZE and height <= SMALL_IMAGE_SIZE:
+        return TOKENS_PER_TILE
+    return math.ceil(width / TILE_SIZE) * math.ceil(height / TILE_SIZE) * TOKENS_PER_TILE
+
+
+def fit_size(width: int, height: int, max_long_edge: int, max_tokens: int = 0) -> Tuple[int, int]:
+    """Return the largest size keeping the aspect ratio within the long edge and token budgets."""
+    scale = 1.0
+    if max_long_edge and max(width, height) > max_long_edge:
+        scale = max_long_edge / max(width, height)
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    if max_tokens:
+        while estimate_image_tokens(*size) > max_tokens and max(size) > SMALL_IMAGE_SIZE:
+            scale *= 0.9
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return size
+
+
+def open_image(document: BinaryIO, max_long_edge: int = 0, grayscale: str = "auto") -> Image.Image:
+    """
+    Open an uploaded image. JPEG files are decoded at a reduced scale (PIL draft mode) when they are
+    much larger than the target size, which avoids decoding all pixels of large photos.
+    """
+    document.seek(0)
+    image = Image.open(document)
+    if max_long_edge and image.format == "JPEG":
+        # Decodes at the smallest 1/2, 1/4 or 1/8 scale that is still at least the target size
+        image.draft("L" if grayscale == "always" else "RGB", fit_size(image.width, image.height, max_long_edge))
+    image.load()
+    return image
+
+
+def is_grayscale(image: Image.Image) -> bool:
+    """Check whether an image carries (almost) no color information."""
+    if image.mode in ("1", "L", "LA", "I", "I;16", "F"):
+        return True
+    sample = image.convert("RGB")
+    sample.thumbnail((128, 128))
+    histogram = sample.convert("HSV").getchannel("S").histogram()
+    colored = sum(histogram[_COLOR_SATURATION:])
+    return colored <= _COLOR_PIXEL_SHARE * sum(histogram)
+
+
+def _flatten(image: Image.Image) -> Image.Image:
+    if image.mode in ("RGBA", "LA", "P", "PA"):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    if image.mode not in ("RGB", "L"):
+        return image.convert("RGB")
+    return image
+
+
+def prepare_image(image: Image.Image, max_long_edge: int = 1536, max_tokens: int = 0, grayscale: str = "auto",
+                  image_format: str = "jpeg", quality: int = 80) -> Tuple[bytes, str, Dict[str, Any]]:
+    """
+    Orient, downscale and re-encode an image for the model.
+    Returns the encoded bytes, their MIME type and the applied parameters.
+    """
+    pil_format, mime_type = IMAGE_FORMATS[image_format]
+    original_size = image.size
+
+    image = _flatten(ImageOps.exif_transpose(image))
+    if grayscale == "always" or (grayscale == "auto" and is_grayscale(image)):
+        image = image.convert("L")
+
+    size = fit_size(image.width, image.height, max_long_edge, max_tokens)
+    if size != image.size:
+        image = image.resize(size, Image.Resampling.LANCZOS)
+
+    output = io.BytesIO()
+    image.save(output, pil_format, quality=quality, optimize=True)
+    data = output.getvalue()
+
+    params = {
+        "original_size": list(original_size),
+        "size": list(image.size),
+        "mode": image.mode,
+        "format": image_format,
+        "quality": quality,
+        "bytes": len(data),
+        "estimated_tokens": estimate_image_tokens(*image.size),
+    }
+    return data, mime_type, params
@@ -0,0 +1,124 @@
+import re
+from datetime import date, timedelta
+from typing import Any, Dict, List, Optional
+
+
+# A line amount may differ from quantity x unit price by the rounding of the printed 2-decimal value
+LINE_TOLERANCE = 0.02
+# The sum of the lines may differ from the total by cash rounding (up to 0.50 CZK) when it is not extracted
+TOTAL_TOLERANCE = 0.5
+RELATIVE_TOLERANCE = 0.001
+
+EARLIEST_DATE = date(2000, 1, 1)
+
+DATE_FIELDS = ("issue_date", "due_date", "taxable_supply_date", "deduction_date")
+
+
+def _number(value: Any) -> float:
+    return float(value) if isinstance(value, (int, float)) else 0.0
+
+
+def _close(actual: float, expected: float, tolerance: float) -> bool:
+    return abs(actual - expected) <= max(tolerance, RELATIVE_TOLERANCE * abs(expected))
+
+
+def check_line_amounts(invoice: Dict[str, Any]) -> List[str]:
+    """Every line's ext_price should be quantity x unit_price (before or after the line discount)."""
+    problems = []
+    for index, line in enumerate(invoice.get("lines") or []):
+        quantity, unit_price, ext_price = (_number(line.get(key)) for key in ("quantity", "unit_price", "ext_price"))
+        if not quantity and not unit_price:
+            continue
+        expected = quantity * unit_price
+        discounted = expected * (1 - _number(line.get("discount_percent")) / 100)
+        if not (_close(ext_price, expected, LINE_TOLERANCE) or _close(ext_price, discounted, LINE_TOLERANCE)):
+            problems.append(f"line {index + 1}: {quantity:g} x {unit_price:g} = {expected:.2f}, ext_price is {ext_price:.2f}")
+    return problems
+
+
+def check_totals(invoice: Dict[str, Any]) -> List[str]:
+    """The gross line amounts should add up to the invoice total (with rounding or discount applied)."""
+    lines = invoice.get("lines") or []
+    amount_total = _number(invoice.get("amount_total"))
+    if not lines:
+        return ["no line items extracted"] if amount_total else []
+
+    lines_total = 0.0
+    for line in lines:
+        gross = _number(line.get("total_with_vat"))
+        if not gross:
+            # The line is only known net, add its VAT
+            gross = _number(line.get("ext_price")) * (1 + _number(line.get("tax_class_id")) / 100)
+        lines_total += gross
+
+    candidates = {
+        amount_total,
+        amount_total - _number(invoice.get("amount_rounding")),
+        amount_total + _number(invoice.get("amount_discount")),
+        _number(invoice.get("amount_without_rounding")),
+        _number(invoice.get("amount_without_discount")),
+    }
+    if any(candidate and _close(lines_total, candidate, TOTAL_TOLERANCE) for candidate in candidates):
+        return []
+    return [f"lines add up to {lines_total:.2f}, amount_total is {amount_total:.2f}"]
+
+
+def _parse_date(value: Any) -> Optional[date]:
+    try:
+        return date.fromisoformat(value) if isinstance(value, str) and len(value) == 10 else None
+    except ValueError:
+        return None
+
+
+def check_dates(invoice: Dict[str, Any], today: Optional[date] = None) -> List[str]:
+    """Dates must be valid YYYY-MM-DD within a plausible range; the issue date is required."""
+    latest = (today or date.today()) + timedelta(days=366)
+    problems = []
+    for field in DATE_FIELDS:
+        value = invoice.get(field)
+        if not value:
+            if field == "issue_date":
+                problems.append("issue_date is missing")
+            continue
+        parsed = _parse_date(value)
+        if parsed is None:
+            problems.append(f"{field} is not a valid YYYY-MM-DD date: {value}")
+        elif not EARLIEST_DATE <= parsed <= latest:
+            problems.append(f"{field} is out of range: {value}")
+    return problems
+
+
+def is_valid_ico(value: str) -> bool:
+    """Check the modulo 11 check digit of a Czech company ID (IČO, 8 digits, older ones zero-padded)."""
+    digits = value.zfill(8)
+    if not re.fullmatch(r"\d{8}", digits):
+        return False
+    remainder = sum(int(digit) * weight for digit, weight in zip(digits[:7], range(8, 1, -1))) % 11
+    return int(digits[7]) == (11 - remainder) % 10
+
+
+def check_company_ids(invoice: Dict[str, Any]) -> List[str]:
+    """Czech company IDs (numeric, up to 8 digits) of both parties must have a valid check digit."""
+    problems = []
+    for party in ("own_company_info", "counterparty_info"):
+        value = re.sub(r"\s", "", str((invoice.get(party) or {}).get("identification_number") or ""))
+        # Foreign registration numbers have other formats and are not checked
+        if value.isdigit() and len(value) <= 8 and not is_valid_ico(value):
+            problems.append(f"{party}.identification_number has an invalid check digit: {value}")
+    return problems
+
+
+CHECKS = {
+    "line_amounts": check_line_amounts,
+    "totals": check_totals,
+    "dates": check_dates,
+    "company_ids": check_company_ids,
+}
+
+
+def check_invoice(invoice: Dict[str, Any]) -> List[Dict[str, str]]:
+    """Run the deterministic reconciliation checks on an extracted invoice; returns the failed ones."""
+    failures = []
+    for name, check in CHECKS.items():
+        failures.extend({"check": name, "message": message} for message in check(invoice))
+    return failures
@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import sqlite3
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from database import Database
+
+
+logger = logging.getLogger("invoice_service")
+
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+class QueueFullError(Exception):
+    """Raised when the number of pending jobs reached the configured limit."""
+
+
+class JobQueue:
+    """
+    Persistent job queue backed by a SQLite table with a fixed pool of asyncio workers.
+
+    Uploaded files are stored in the `jobs` table until they are processed, so a restart
+    does not lose any work: jobs left in the `running` state are re-queued on startup.
+    """
+
+    def __init__(self, db: Database, handler: Callable[[Dict[str, Any]], Awaitable[None]],
+                 workers: int = 4, max_pending: int = 1000, max_attempts: int = 3,
+                 poll_interval: float = 1.0, drain_timeout: float = 60.0):
+        self.db = db
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.drain_timeout = drain_timeout
+
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+
+    @staticmethod
+    def _create_table(conn: sqlite3.Connection):
+        cursor = conn.cursor()
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_id TEXT NOT NULL,
+            file_name TEXT NOT NULL,
+            file_extension TEXT NOT NULL,
+            model TEXT NOT NULL,
+            callback_url TEXT,
+            payload BLOB,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error_message TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, id)")
+
+    async def start(self):
+        """Recover unfinished jobs and start the worker pool."""
+        await self.db.run_write(self._create_table)
+        recovered = await self.db.run_write(self._recover)
+        if recovered:
+            logger.info(f"Recovered {recovered} unfinished jobs from the previous run")
+
+        self._stopping = False
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        self._wakeup.set()
+        logger.info(f"Job queue started with {self.workers} workers")
+
+    async def stop(self):
+        """Stop taking new jobs and wait for the jobs in flight to finish."""
+        self._stopping = True
+        self._wakeup.set()
+        if not self._tasks:
+            return
+
+        done, pending = await asyncio.wait(self._tasks, timeout=self.drain_timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            # Cancelled jobs stay in the running state and are re-queued on the next start
+            await asyncio.gather(*pending, return_exceptions=True)
+            logger.warning(f"Job queue drain timed out, {len(pending)} jobs will be resumed on restart")
+        self._tasks = []
+        logger.info("Job queue stopped")
+
+    async def enqueue(self, file_id: str, file_name: str, file_extension: str, model_name: str,
+                      content: bytes, callback_url: Optional[str] = None) -> int:
+        """Persist a new job and wake up an idle worker. Returns the job ID."""
+        if self._stopping:
+            raise QueueFullError("Job queue is shutting down")
+        job_id = await self.db.run_write(
+            lambda conn: self._insert(conn, file_id, file_name, file_extension, model_name, content, callback_url)
+        )
+        self._wakeup.set()
+        return job_id
+
+    async def get_job(self, job_id: int) -> Optional[Dict[str, Any]]:
+        """Return job status information (without the payload)."""
+        return await self.db.run_read(lambda conn: self._get(conn, job_id))
+
+    async def pending_count(self) -> int:
+        """Return the number of queued and running jobs."""
+        return await self.db.run_read(self._count_pending)
+
+    async def _worker(self, worker_id: int):
+        while not self._stopping:
+            try:
+                if await self._process_next():
+                    continue
+            except Exception:
+                # A failed claim or status write (e.g. a locked or full database) must not end the worker;
+                # a job whose status was not written stays running and is resumed on the next start
+                logger.exception(f"Job queue worker {worker_id} failed, retrying")
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _process_next(self) -> bool:
+        """Claim and run the next queued job; returns False when there is none."""
+        job = await self.db.run_write(self._claim)
+        if job is None:
+            return False
+
+        try:
+            await self.handler(job)
+        except Exception as e:
+            logger.error(f"Job {job['id']} failed: {str(e)}")
+            await self._finish(job["id"], JOB_FAILED, str(e))
+        else:
+            await self._finish(job["id"], JOB_DONE, None)
+        return True
+
+    async def _finish(self, job_id: int, status: str, error_message: Optional[str]):
+        # The payload is no longer needed once the job has finished
+        await self.db.execute(
+            "UPDATE jobs SET status = ?, error_message = ?, payload = NULL, updated_at = ? WHERE id = ?",
+            [status, error_message, datetime.now().isoformat(), job_id]
+        )
+
+    def _insert(self, conn: sqlite3.Connection, file_id, file_name, file_extension, model_name,
+                content, callback_url) -> int:
+        cursor = conn.cursor()
+        if self.max_pending:
+            cursor.execute("SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)", [JOB_QUEUED, JOB_RUNNING])
+            if cursor.fetchone()[0] >= self.max_pending:
+                raise QueueFullError(f"Job queue is full ({self.max_pending} pending jobs)")
+        now = datetime.now().isoformat()
+        cursor.execute('''
+        INSERT INTO jobs
+        (file_id, file_name, file_extension, model, callback_url, payload, status, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (file_id, file_name, file_extension, model_name, callback_url,
+              sqlite3.Binary(content), JOB_QUEUED, now, now))
+        return cursor.lastrowid
+
+    @staticmethod
+    def _claim(conn: sqlite3.Connection) -> Optional[Dict[str, Any]]:
+        # Runs in the writer transaction, so selecting and marking the job is atomic
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM jobs WHERE status = ? ORDER BY id LIMIT 1", [JOB_QUEUED])
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        cursor.execute(
+            "UPDATE jobs SET status = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+            [JOB_RUNNING, datetime.now().isoformat(), row["id"]]
+        )
+        return dict(row)
+
+    def _recover(self, conn: sqlite3.Connection) -> int:
+        cursor = conn.cursor()
+        now = datetime.now().isoformat()
+        # Jobs that were interrupted too many times are most likely crashing the worker
+        cursor.execute('''
+        UPDATE jobs SET status = ?, error_message = ?, payload = NULL, updated_at = ?
+        WHERE status = ? AND attempts >= ?
+        ''', [JOB_FAILED, "Job was interrupted too many times", now, JOB_RUNNING, self.max_attempts])
+        cursor.execute(
+            "UPDATE jobs SET status = ?, updated_at = ? WHERE status = ?",
+            [JOB_QUEUED, now, JOB_RUNNING]
+        )
+        return cursor.rowcount
+
+    @staticmethod
+    def _get(conn: sqlite3.Connection, job_id: int) -> Optional[Dict[str, Any]]:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT id, file_id, file_name, model, status, attempts, error_message, created_at, updated_at
+        FROM jobs WHERE id = ?
+        ''', [job_id])
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
+    @staticmethod
+    def _count_pending(conn: sqlite3.Connection) -> int:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)", [JOB_QUEUED, JOB_RUNNING])
+        return cursor.fetchone()[0]
@@ -0,0 +1,101 @@
+import json
+from typing import Any, Iterable, List, Optional, Tuple
+
+
+FIELD_EVENT = "field"
+ITEM_EVENT = "item"
+
+_WHITESPACE = " \t\r\n"
+
+
+class IncrementalJsonParser:
+    """
+    Incremental parser for a JSON object received in chunks (a streamed model response).
+
+    `feed` returns ("field", name, value) for every top-level member as soon as its value is complete
+    and, for the members named in `stream_arrays`, ("item", name, index, value) for each array element
+    instead of one field event for the whole array. Each completed value is decoded with `json.loads`
+    once, so the events carry exactly what the final document holds.
+    """
+
+    def __init__(self, stream_arrays: Iterable[str] = ()):
+        self.stream_arrays = set(stream_arrays)
+        self.done = False
+
+        self._buffer = ""
+        self._pos = 0
+        self._stack: List[str] = []  # Open containers, "{" or "["
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+
+        self._key: Optional[str] = None  # Top-level member being received
+        self._expect_value = False
+        self._value_start: Optional[int] = None
+        self._in_stream_array = False
+        self._item_start: Optional[int] = None
+        self._item_index = 0
+
+    def feed(self, chunk: str) -> List[Tuple[Any, ...]]:
+        """Consume the next chunk of text and return the events it completed."""
+        events: List[Tuple[Any, ...]] = []
+        self._buffer += chunk
+        while self._pos < len(self._buffer) and not self.done:
+            position = self._pos
+            char = self._buffer[position]
+            self._pos += 1
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if len(self._stack) == 1 and self._value_start is None:
+                        self._key = json.loads(self._buffer[self._string_start:position + 1])
+                continue
+            if char in _WHITESPACE:
+                continue
+
+            depth = len(self._stack)
+            if depth == 0:
+                # Anything before the top-level object is ignored
+                if char == "{":
+                    self._stack.append(char)
+                continue
+
+            if depth == 1 and self._expect_value:
+                self._expect_value = False
+                self._value_start = position
+            if self._in_stream_array and depth == 2 and self._item_start is None and char not in ",]":
+                self._item_start = position
+
+            if char == '"':
+                self._in_string = True
+                self._string_start = position
+            elif char == ":" and depth == 1:
+                self._expect_value = True
+            elif char in "{[":
+                self._stack.append(char)
+                if depth == 1 and char == "[" and self._key in self.stream_arrays:
+                    self._in_stream_array = True
+                    self._item_index = 0
+            elif char in ",}]":
+                if self._in_stream_array and depth == 2 and self._item_start is not None:
+                    value = json.loads(self._buffer[self._item_start:position])
+                    events.append((ITEM_EVENT, self._key, self._item_index, value))
+                    self._item_start = None
+                    self._item_index += 1
+                if char in "}]":
+                    self._stack.pop()
+                    if self._in_stream_array and len(self._stack) == 1:
+                        self._in_stream_array = False
+                if depth == 1 and self._value_start is not None:
+                    if self._key not in self.stream_arrays or self._buffer[self._value_start] != "[":
+                        events.append((FIELD_EVENT, self._key, json.loads(self._buffer[self._value_start:position])))
+                    self._key = None
+                    self._value_start = None
+                if not self._stack:
+                    self.done = True
+        return events
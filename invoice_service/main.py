@@ -1,36 +1,67 @@
 import os
-import tempfile
+import math
 import logging
 import sqlite3
 import json
-from logging.handlers import RotatingFileHandler
+import copy
+import base64
+import time
+import zipfile
+from logging.handlers import RotatingFileHandler, QueueListener
 from pathlib import Path
-from typing import Dict, Optional, List, Any, Union
+from typing import Dict, Optional, List, Any, Union, Tuple, Callable, Awaitable, AsyncIterator, BinaryIO, TYPE_CHECKING
 from datetime import datetime
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
-from fastapi.responses import JSONResponse, Response
-import uvicorn
-from PIL import Image
-from google import genai
-from markitdown import MarkItDown  # Microsoft's library for converting documents to markdown
-from pdf2image import convert_from_path
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Query
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
 from invoice_types import Invoice
 
-from contextlib import asynccontextmanager
-import httpx
+from contextlib import asynccontextmanager, nullcontext
 import asyncio
 
 
 from utils import replace_null_values
+from invoice_checks import check_invoice
+from database import Database, connect
+from job_queue import JobQueue, QueueFullError
+from callback_outbox import CallbackOutbox
+from converters import DocumentConverter
+from json_stream import IncrementalJsonParser, FIELD_EVENT
+from prompt_cache import PromptCache
+from rate_limiter import RateLimiter, is_overload_error, retry_after_seconds
+from metrics import (
+    STAGE_UPLOAD_READ, STAGE_CONVERSION, STAGE_RASTERIZATION, STAGE_IMAGE_PREPARATION, STAGE_LLM_CALL,
+    STAGE_DB_WRITE, STAGE_EXTRACTION, CACHE_HITS, QUEUE_DEPTH, LLM_CALLS_IN_FLIGHT, InFlightMiddleware,
+    observe_stage, metric_labels, set_metric_labels, count_error, count_tokens, limit_model_labels, model_label
+)
+from tracing import Trace, OtlpFileExporter, current_trace, set_current_trace, trace_context, set_trace_attributes
+from structured_logging import (
+    JsonFormatter, start_queue_logging, stop_queue_logging, set_log_context, log_context, parse_level
+)
+from pdf_classifier import classify_pdf, PDF_DIGITAL, PDF_UNKNOWN
+from rasterizers import Rasterizer, get_rasterizer
+from uploads import Upload, UploadTooLargeError, MaxBodySizeMiddleware, MULTIPART_OVERHEAD, expand_zip
+from bulk import setup_bulk_tables
+from result_cache import setup_cache_table, fingerprint, make_cache_key, get_cached_result, store_cached_result
 
+# The Gemini SDK, PIL and the document converters are imported on first use, so importing this module
+# (worker cold start, test collection) stays cheap and has no side effects
+if TYPE_CHECKING:
+    from PIL import Image
+    from google.genai import types
 
 
 # Configure logging
 LOG_DIR = Path("logs")
-LOG_DIR.mkdir(exist_ok=True)
 log_file = LOG_DIR / "invoice_service.log"
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+# Minimum level per pipeline stage as JSON, e.g. {"llm_call": "DEBUG", "upload_read": "WARNING"}
+# (parsed by setup_logging)
+LOG_STAGE_LEVELS = os.environ.get("LOG_STAGE_LEVELS", "{}")
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")  # json (one object per line) or text
 
 # Create logger
 logger = logging.getLogger("invoice_service")
@@ -38,13 +69,104 @@ logger.setLevel(logging.INFO)
 
 # Setup SQLite database
 DB_DIR = Path(os.environ.get("DB_LOCATION", "db"))
-DB_DIR.mkdir(exist_ok=True)
 DB_PATH = DB_DIR / "invoices.db"
+DB_BATCH_SIZE = int(os.environ.get("DB_BATCH_SIZE", "100"))  # Max writes committed in one transaction
 
 MODEL_NAME = os.environ.get("GEMINI_MODEL", "")
 
 CALLBACK_URL = os.environ.get("CALLBACK_URL", "")
 
+# Callback delivery: callbacks are stored in an outbox and sent over a pooled HTTP client,
+# failed deliveries are retried with exponential backoff (CALLBACK_BASE_DELAY doubled per attempt, with jitter)
+CALLBACK_TIMEOUT = float(os.environ.get("CALLBACK_TIMEOUT", "30"))  # seconds
+CALLBACK_CONCURRENCY = int(os.environ.get("CALLBACK_CONCURRENCY", "8"))
+CALLBACK_MAX_ATTEMPTS = int(os.environ.get("CALLBACK_MAX_ATTEMPTS", "8"))
+CALLBACK_BASE_DELAY = float(os.environ.get("CALLBACK_BASE_DELAY", "2"))  # seconds
+CALLBACK_MAX_DELAY = float(os.environ.get("CALLBACK_MAX_DELAY", "600"))  # seconds
+
+# Convert a tiny PDF and DOCX at startup, so the first request does not pay for the converter imports
+CONVERTER_WARMUP = os.environ.get("CONVERTER_WARMUP", "1") == "1"
+
+# Explicit Gemini context cache for the system instruction (GEMINI_CONTEXT_CACHE=0 sends it inline only)
+GEMINI_CONTEXT_CACHE = os.environ.get("GEMINI_CONTEXT_CACHE", "1") == "1"
+GEMINI_CACHE_TTL = int(os.environ.get("GEMINI_CACHE_TTL", "3600"))  # seconds
+# Smallest prompt worth caching in tokens, 0 = the model's minimum for explicit caching (1024, Pro models 4096)
+GEMINI_CACHE_MIN_TOKENS = int(os.environ.get("GEMINI_CACHE_MIN_TOKENS", "0"))
+
+# Client-side rate limiting of the Gemini calls per model: requests and tokens per minute (0 = unlimited),
+# GEMINI_RATE_LIMITS overrides them per model as JSON, e.g. {"gemini-2.5-pro": {"rpm": 150, "tpm": 2000000}}.
+# The concurrency limit is lowered on 429/503 responses and recovers with successful calls
+GEMINI_RPM = float(os.environ.get("GEMINI_RPM", "0"))
+GEMINI_TPM = float(os.environ.get("GEMINI_TPM", "0"))
+GEMINI_RATE_LIMITS = json.loads(os.environ.get("GEMINI_RATE_LIMITS", "{}"))
+GEMINI_MAX_CONCURRENCY = int(os.environ.get("GEMINI_MAX_CONCURRENCY", "16"))  # per model
+GEMINI_MAX_RETRIES = int(os.environ.get("GEMINI_MAX_RETRIES", "5"))  # retries of 429/503 responses
+GEMINI_RETRY_BASE_DELAY = float(os.environ.get("GEMINI_RETRY_BASE_DELAY", "1"))  # seconds, without retry-after hint
+GEMINI_OUTPUT_TOKEN_ESTIMATE = int(os.environ.get("GEMINI_OUTPUT_TOKEN_ESTIMATE", "2000"))  # per request
+
+# Model cascade: extract with the cheaper CASCADE_MODEL (e.g. gemini-2.5-flash) first and send the document
+# to the requested model only when the deterministic invoice checks fail. Empty = always use the requested model
+CASCADE_MODEL = os.environ.get("CASCADE_MODEL", "")
+
+# Models the clients may request (comma separated), by default GEMINI_MODEL, CASCADE_MODEL and the models of
+# GEMINI_RATE_LIMITS. Other names are rejected, the rate limiter and the metrics keep state for every model
+GEMINI_ALLOWED_MODELS = (
+    {model.strip() for model in os.environ.get("GEMINI_ALLOWED_MODELS", "").split(",") if model.strip()}
+    or {model for model in (MODEL_NAME, CASCADE_MODEL, *GEMINI_RATE_LIMITS) if model}
+)
+
+# Background job queue settings for /invoice/async
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+JOB_MAX_PENDING = int(os.environ.get("JOB_MAX_PENDING", "1000"))
+JOB_DRAIN_TIMEOUT = float(os.environ.get("JOB_DRAIN_TIMEOUT", "60"))
+
+# Upload limits: larger uploads are rejected with HTTP 413, uploads above the spool size are buffered
+# in an anonymous temporary file instead of memory
+MAX_UPLOAD_SIZE = int(os.environ.get("MAX_UPLOAD_SIZE", str(50 * 1024 * 1024)))  # bytes, 0 = unlimited
+UPLOAD_SPOOL_SIZE = int(os.environ.get("UPLOAD_SPOOL_SIZE", str(8 * 1024 * 1024)))  # bytes
+
+# POST /invoices/batch: files processed at the same time, files per batch and size of the whole request
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+BATCH_MAX_FILES = int(os.environ.get("BATCH_MAX_FILES", "500"))
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", str(500 * 1024 * 1024)))  # bytes, 0 = unlimited
+# Batch files wait for their turn in temporary files: only this much of each one is kept in memory
+BATCH_SPOOL_SIZE = int(os.environ.get("BATCH_SPOOL_SIZE", str(64 * 1024)))  # bytes
+
+# PDF rasterization: only the pages sent to the model are rendered, with the in-process pdfium
+# engine or with poppler subprocesses (PDF_RASTERIZER=poppler)
+PDF_RASTERIZER = os.environ.get("PDF_RASTERIZER", "pdfium")
+PDF_MAX_PAGES = int(os.environ.get("PDF_MAX_PAGES", "5"))
+PDF_DPI = int(os.environ.get("PDF_DPI", "150"))
+PDF_GRAYSCALE = os.environ.get("PDF_GRAYSCALE", "1") == "1"
+PDF_RASTER_THREADS = int(os.environ.get("PDF_RASTER_THREADS", str(min(4, os.cpu_count() or 1))))  # poppler only
+PDF_JPEG_QUALITY = int(os.environ.get("PDF_JPEG_QUALITY", "85"))
+
+# Born-digital PDFs (with a text layer and no page-size images) are sent as text only (PDF_DIGITAL_MODE=text),
+# as text with a low resolution image of the first page (first_page) or like scans with all pages (images)
+PDF_DIGITAL_MODES = ("first_page", "text", "images")
+PDF_DIGITAL_MODE = os.environ.get("PDF_DIGITAL_MODE", "first_page")
+PDF_DIGITAL_LONG_EDGE = int(os.environ.get("PDF_DIGITAL_LONG_EDGE", "768"))  # px, first_page mode
+PDF_MIN_CHAR_DENSITY = float(os.environ.get("PDF_MIN_CHAR_DENSITY", "2"))  # characters per square inch
+PDF_MAX_IMAGE_COVERAGE = float(os.environ.get("PDF_MAX_IMAGE_COVERAGE", "0.5"))  # share of the page area
+
+# Image preprocessing: every image or PDF page is oriented, downscaled to the budget and re-encoded
+IMAGE_MAX_LONG_EDGE = int(os.environ.get("IMAGE_MAX_LONG_EDGE", "1536"))  # px, 0 = keep the size
+IMAGE_MAX_TOKENS = int(os.environ.get("IMAGE_MAX_TOKENS", "0"))  # estimated tokens per page, 0 = no limit
+IMAGE_GRAYSCALE = os.environ.get("IMAGE_GRAYSCALE", "auto")  # auto (colorless images only), always, never
+IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", "jpeg")  # jpeg or webp
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", "80"))
+
+# Characters of the converted document text sent to the model, longer text is truncated
+DOCUMENT_TEXT_MAX_CHARS = 8000
+
+# Every record stores a trace of its pipeline stages; TRACE_EXPORT_FILE also appends the traces to a file
+# in the OpenTelemetry OTLP/JSON format (e.g. for the Collector's otlpjsonfile receiver)
+TRACE_EXPORT_FILE = os.environ.get("TRACE_EXPORT_FILE", "")
+
+# Extraction result cache settings (RESULT_CACHE_MAX_ENTRIES=0 disables the cache)
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", "10000"))
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", str(30 * 24 * 3600)))  # seconds
+
 PROMPT_SYSTEM = """
 You are a finance document parsing assistant. Use the provided **Invoice** response_schema as the only source of field names.
 **Return exactly ONE valid JSON object. No explanations.**
@@ -92,12 +214,75 @@ This document can be an image or PDF; you may receive **page images** and **conv
 Follow the **Invoice** response_schema exactly. Missing fields → empty value by type.
 """
 
-
+# Static instructions sent as the system instruction (or as explicit cached content), ahead of the document
+SYSTEM_INSTRUCTION = PROMPT_SYSTEM.strip() + "\n\n" + PROMPT_UNIFIED_POLICY.strip()
+
+# Cached results are invalidated whenever the prompts, the response schema or the settings deciding
+# what the model is sent (preprocessing) and which model answers (cascade) change
+PROMPT_VERSION = fingerprint(PROMPT_SYSTEM, PROMPT_UNIFIED_POLICY, PROMPT_TEMPLATE_DOCUMENT_TEXT)
+SCHEMA_VERSION = fingerprint(json.dumps(Invoice.model_json_schema(), sort_keys=True))
+SETTINGS_VERSION = fingerprint(json.dumps({
+    "CASCADE_MODEL": CASCADE_MODEL,
+    "PDF_RASTERIZER": PDF_RASTERIZER,
+    "PDF_MAX_PAGES": PDF_MAX_PAGES,
+    "PDF_DPI": PDF_DPI,
+    "PDF_GRAYSCALE": PDF_GRAYSCALE,
+    "PDF_JPEG_QUALITY": PDF_JPEG_QUALITY,
+    "PDF_DIGITAL_MODE": PDF_DIGITAL_MODE,
+    "PDF_DIGITAL_LONG_EDGE": PDF_DIGITAL_LONG_EDGE,
+    "PDF_MIN_CHAR_DENSITY": PDF_MIN_CHAR_DENSITY,
+    "PDF_MAX_IMAGE_COVERAGE": PDF_MAX_IMAGE_COVERAGE,
+    "IMAGE_MAX_LONG_EDGE": IMAGE_MAX_LONG_EDGE,
+    "IMAGE_MAX_TOKENS": IMAGE_MAX_TOKENS,
+    "IMAGE_GRAYSCALE": IMAGE_GRAYSCALE,
+    "IMAGE_FORMAT": IMAGE_FORMAT,
+    "IMAGE_QUALITY": IMAGE_QUALITY,
+    "DOCUMENT_TEXT_MAX_CHARS": DOCUMENT_TEXT_MAX_CHARS,
+}, sort_keys=True))
+
+NO_TOKEN_USAGE = {
+    "total_token_count": 0,
+    "input_token_count": 0,
+    "output_token_count": 0,
+    "thoughts_token_count": 0,
+    "cached_token_count": 0,
+}
+
+FILE_TYPES = {
+    "jpg": "image",
+    "jpeg": "image",
+    "png": "image",
+    "pdf": "pdf",
+    "docx": "docx",
+}
+
+# File types as named in log and error messages
+PROCESSING_KINDS = {
+    "image": "image",
+    "pdf": "PDF",
+    "docx": "DOCX",
+}
+
+# Cascade tiers recorded in invoice_processes.model_tier
+TIER_CHEAP = "cheap"
+TIER_STRONG = "strong"
+
+
+
+
+def _ensure_columns(cursor: sqlite3.Cursor, table: str, columns: Dict[str, str]):
+    """Add columns missing in databases created by older versions of the service."""
+    cursor.execute(f"PRAGMA table_info({table})")
+    existing = {row[1] for row in cursor.fetchall()}
+    for name, definition in columns.items():
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
 
 
 def setup_database():
     """Initialize the SQLite database with required tables."""
-    conn = sqlite3.connect(DB_PATH)
+    DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+    conn = connect(DB_PATH)
     cursor = conn.cursor()
       # Create table for storing invoice processing data
     cursor.execute('''
@@ -113,47 +298,131 @@ def setup_database():
         output_token_count INTEGER,
         thoughts_token_count INTEGER,
         response_json TEXT,
-        error_message TEXT
+        error_message TEXT,
+        cache_hit INTEGER NOT NULL DEFAULT 0,
+        image_params TEXT,
+        image_bytes INTEGER,
+        cached_token_count INTEGER,
+        model_tier TEXT,
+        duration_ms REAL,
+        trace_json TEXT
     )
     ''')
+    _ensure_columns(cursor, "invoice_processes", {
+        "cache_hit": "INTEGER NOT NULL DEFAULT 0",
+        "image_params": "TEXT",
+        "image_bytes": "INTEGER",
+        "cached_token_count": "INTEGER",
+        "model_tier": "TEXT",
+        "duration_ms": "REAL",
+        "trace_json": "TEXT",
+    })
+    # Indexes for /history: newest first, optionally filtered by file ID
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_invoice_processes_timestamp ON invoice_processes (timestamp DESC, id DESC)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_invoice_processes_file_id ON invoice_processes (file_id, timestamp DESC, id DESC)"
+    )
+
+    setup_cache_table(cursor)
+    setup_bulk_tables(cursor)
 
     conn.commit()
     conn.close()
     logger.info(f"Database initialized at {DB_PATH}")
 
 
-# Initialize database on module load
-setup_database()
+# Writes the queued log records to the handlers in a background thread
+log_listener: Optional[QueueListener] = None
 
-# Create handlers
-file_handler = RotatingFileHandler(
-    log_file, 
-    maxBytes=10 * 1024 * 1024,  # 10 MB
-    backupCount=5
-)
-console_handler = logging.StreamHandler()
 
-# Create formatters and add it to handlers
-log_format = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-file_handler.setFormatter(log_format)
-console_handler.setFormatter(log_format)
+def _parse_stage_levels() -> Dict[str, str]:
+    """Parse LOG_STAGE_LEVELS, rejecting a malformed value or an unknown level at startup."""
+    try:
+        stage_levels = json.loads(LOG_STAGE_LEVELS)
+        if not isinstance(stage_levels, dict):
+            raise ValueError("not a JSON object")
+        for level in stage_levels.values():
+            parse_level(level)
+    except ValueError as e:
+        message = (f"LOG_STAGE_LEVELS must be a JSON object of stage names and log levels, "
+                   f"got {LOG_STAGE_LEVELS!r}: {str(e)}")
+        logger.error(message)
+        raise RuntimeError(message)
+    return stage_levels
+
+
+def setup_logging():
+    """Attach the log file and console handlers behind a queue (once, on startup)."""
+    global log_listener
+    if log_listener is not None:
+        return
+    stage_levels = _parse_stage_levels()
+    LOG_DIR.mkdir(exist_ok=True)
+
+    # Create handlers
+    file_handler = RotatingFileHandler(
+        log_file, 
+        maxBytes=10 * 1024 * 1024,  # 10 MB
+        backupCount=5
+    )
+    console_handler = logging.StreamHandler()
+
+    # Create formatters and add it to handlers
+    if LOG_FORMAT == "text":
+        log_format = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    else:
+        log_format = JsonFormatter()
+    file_handler.setFormatter(log_format)
+    console_handler.setFormatter(log_format)
+
+    # The handlers run in the listener thread, request handlers only put records in a queue
+    log_listener = start_queue_logging(logger, [file_handler, console_handler], LOG_LEVEL, stage_levels)
 
-# Add handlers to the logger
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
+
+def shutdown_logging():
+    """Write the remaining queued records and stop the listener thread."""
+    global log_listener
+    if log_listener is not None:
+        stop_queue_logging(logger, log_listener)
+        log_listener = None
 
 
 
 # Initialize Google Gemini client
 client = None  # Will be initialized on startup
 
+# Shared database access layer
+db: Optional[Database] = None  # Will be started on startup
+
+# Background job queue for /invoice/async
+job_queue: Optional[JobQueue] = None  # Will be started on startup
+
+# Shared HTTP client (connection pool) and persistent outbox for result callbacks
+http_client = None  # Will be created on startup
+callback_outbox: Optional[CallbackOutbox] = None  # Will be started on startup
+
+# Per-model rate limiter for the Gemini calls
+rate_limiter: Optional[RateLimiter] = None  # Will be created on startup
+
+# Optional file export of the request traces (the file is created on the first export)
+trace_exporter = OtlpFileExporter(Path(TRACE_EXPORT_FILE)) if TRACE_EXPORT_FILE else None
+
+# Explicit context cache for the system instruction (created per model on first use)
+prompt_cache: Optional[PromptCache] = None
+
+# Shared document to markdown converter (MarkItDown is created and warmed up on startup)
+document_converter = DocumentConverter()
+
 
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup: Initialize Google Gemini client
-    global client
+    global client, db, job_queue, prompt_cache, http_client, callback_outbox, rate_limiter
+    setup_logging()
     api_key = os.environ.get("GEMINI_API_KEY")
     if not api_key:
         logger.error("GEMINI_API_KEY environment variable not set")
@@ -163,13 +432,79 @@ async def lifespan(app: FastAPI):
         logger.error("GEMINI_MODEL environment variable not set")
         raise RuntimeError("GEMINI_MODEL environment variable not set")
 
+    check_pdf_settings()
+    limit_model_labels(GEMINI_ALLOWED_MODELS)
+
+    from google import genai
+
     client = genai.Client(api_key=api_key)
     logger.info("Google Gemini client initialized")
+
+    rate_limiter = RateLimiter(
+        rpm=GEMINI_RPM,
+        tpm=GEMINI_TPM,
+        max_concurrency=GEMINI_MAX_CONCURRENCY,
+        limits=GEMINI_RATE_LIMITS,
+        max_retries=GEMINI_MAX_RETRIES,
+        base_delay=GEMINI_RETRY_BASE_DELAY
+    )
+
+    if GEMINI_CONTEXT_CACHE:
+        prompt_cache = PromptCache(SYSTEM_INSTRUCTION, ttl_seconds=GEMINI_CACHE_TTL, min_tokens=GEMINI_CACHE_MIN_TOKENS)
+        # Created here rather than by the first request, which would wait for it in its rate limiter slot
+        await prompt_cache.start(client, [MODEL_NAME, CASCADE_MODEL])
+
+    setup_database()
+
+    # Load the converters and renderers before the first request instead of on it
+    if CONVERTER_WARMUP:
+        await asyncio.to_thread(document_converter.warm_up)
+        await asyncio.to_thread(_get_rasterizer)
+
+    db = Database(DB_PATH, batch_size=DB_BATCH_SIZE)
+    db.start()
+
+    import httpx
+
+    http_client = httpx.AsyncClient(
+        timeout=CALLBACK_TIMEOUT,
+        limits=httpx.Limits(max_connections=CALLBACK_CONCURRENCY, max_keepalive_connections=CALLBACK_CONCURRENCY)
+    )
+    callback_outbox = CallbackOutbox(
+        db,
+        http_client,
+        concurrency=CALLBACK_CONCURRENCY,
+        max_attempts=CALLBACK_MAX_ATTEMPTS,
+        base_delay=CALLBACK_BASE_DELAY,
+        max_delay=CALLBACK_MAX_DELAY
+    )
+    await callback_outbox.start()
+
+    job_queue = JobQueue(
+        db,
+        _run_job,
+        workers=JOB_WORKERS,
+        max_pending=JOB_MAX_PENDING,
+        drain_timeout=JOB_DRAIN_TIMEOUT
+    )
+    await job_queue.start()
     
     yield  # This is where the app runs
     
-    # Shutdown: Clean up resources if needed
-    # No cleanup needed for the Gemini client
+    # Shutdown: Finish the jobs in flight, the queued ones are resumed on the next start
+    await job_queue.stop()
+    job_queue = None
+    # Undelivered callbacks stay in the outbox and are sent after the restart
+    await callback_outbox.stop()
+    callback_outbox = None
+    await http_client.aclose()
+    http_client = None
+    if prompt_cache:
+        await prompt_cache.close(client)
+        prompt_cache = None
+    db.stop()
+    db = None
+    shutdown_logging()
 
 app = FastAPI(
     title="Invoice Processing Service",
@@ -178,61 +513,228 @@ app = FastAPI(
     lifespan=lifespan
 )
 
-def save_to_database(file_id: str, file_name: str, file_type: str, 
+# Reject oversized request bodies before the multipart parser buffers them
+if MAX_UPLOAD_SIZE or BATCH_MAX_SIZE:
+    app.add_middleware(
+        MaxBodySizeMiddleware,
+        max_body_size=MAX_UPLOAD_SIZE + MULTIPART_OVERHEAD if MAX_UPLOAD_SIZE else 0,
+        path_limits={"/invoices/batch": BATCH_MAX_SIZE + MULTIPART_OVERHEAD if BATCH_MAX_SIZE else 0}
+    )
+
+# Compress larger responses (history pages, NDJSON streams) for clients sending Accept-Encoding: gzip
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+# Requests in progress for the invoice_requests_in_flight gauge, scrapes and health checks excluded
+app.add_middleware(InFlightMiddleware, exclude_paths=("/metrics", "/healthcheck"))
+
+async def save_to_database(file_id: str, file_name: str, file_type: str, 
                     token_count: Optional[int] = None, 
                     input_token_count: Optional[int] = None,
                     output_token_count: Optional[int] = None,
                     thoughts_token_count: Optional[int] = None,
+                    cached_token_count: Optional[int] = None,
                     model: Optional[str] = None, 
                     response_data: Optional[Dict] = None, 
-                    error_message: Optional[str] = None):
-    """Save processing data to SQLite database."""
+                    error_message: Optional[str] = None,
+                    cache_hit: bool = False,
+                    image_params: Optional[Dict] = None,
+                    model_tier: Optional[str] = None,
+                    trace: Optional[Dict] = None):
+    """Save processing data to SQLite database (batched with concurrent writes, waits for the commit)."""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        INSERT INTO invoice_processes 
-        (file_id, file_name, file_type, timestamp, model, token_count, input_token_count, output_token_count, thoughts_token_count, response_json, error_message)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            file_id,
-            file_name,
-            file_type,
-            datetime.now().isoformat(),
-            model,
-            token_count,
-            input_token_count,
-            output_token_count,
-            thoughts_token_count,
-            json.dumps(response_data) if response_data else None,
-            error_message
-        ))
+        with observe_stage(STAGE_DB_WRITE, file_type, model or ""):
+            await db.execute('''
+            INSERT INTO invoice_processes 
+            (file_id, file_name, file_type, timestamp, model, token_count, input_token_count, output_token_count, thoughts_token_count, response_json, error_message, cache_hit, image_params, image_bytes, cached_token_count, model_tier, duration_ms, trace_json)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                file_id,
+                file_name,
+                file_type,
+                datetime.now().isoformat(),
+                model,
+                token_count,
+                input_token_count,
+                output_token_count,
+                thoughts_token_count,
+                json.dumps(response_data) if response_data else None,
+                error_message,
+                int(cache_hit),
+                json.dumps(image_params) if image_params else None,
+                image_params["bytes"] if image_params else None,
+                cached_token_count,
+                model_tier,
+                trace["duration_ms"] if trace else None,
+                json.dumps(trace) if trace else None
+            ))
         
-        conn.commit()
-        conn.close()
         logger.info(f"Saved processing data for file {file_name} to database")
     except Exception as e:
         logger.error(f"Error saving to database: {str(e)}")
+        count_error(STAGE_DB_WRITE, type(e).__name__, file_type)
+        raise
 
 
-def generate_response(content, message, model_name):
-    response = client.models.generate_content(
-        model=model_name,
-        contents=content,
-        config={
-            'response_mime_type': 'application/json',
-            'response_schema': Invoice,
-        },
+async def _save_result(file_id: str, file_name: str, file_type: str, model_name: str,
+                       result: Optional[Dict[str, Any]], error_message: Optional[str] = None):
+    """
+    Store an extraction result with its token usage and the trace of the current request in the processing history.
+    The record's model is the one that produced the result (the cheap model of a cascade that was not escalated),
+    the requested model is kept in the trace.
+    """
+    result = result or {}
+    model = result.get("model") or model_name
+    trace = current_trace()
+    if trace:
+        trace.attributes["requested_model"] = model_name
+    end_ns = time.time_ns()
+    await save_to_database(
+        file_id=file_id,
+        file_name=file_name,
+        file_type=file_type,
+        model=model,
+        token_count=result.get("total_token_count"),
+        input_token_count=result.get("input_token_count"),
+        output_token_count=result.get("output_token_count"),
+        thoughts_token_count=result.get("thoughts_token_count"),
+        cached_token_count=result.get("cached_token_count"),
+        response_data=result,
+        error_message=error_message,
+        cache_hit=bool(result.get("cache_hit")),
+        image_params=result.get("image_params"),
+        model_tier=(result.get("cascade") or {}).get("tier"),
+        trace=trace.to_dict(end_ns) if trace else None
     )
+    if trace and trace_exporter:
+        attributes = {"file_id": file_id, "file_name": file_name, "file_type": file_type, "model": model,
+                      "error": error_message}
+        try:
+            await asyncio.to_thread(trace_exporter.export, trace, "extract_invoice", attributes, end_ns)
+        except Exception as e:
+            logger.error(f"Error exporting trace: {str(e)}")
+
+
+def _result_cache_key(content_sha256: str, model_name: str) -> Optional[str]:
+    """Cache key for an upload, or None when the result cache is disabled."""
+    if RESULT_CACHE_MAX_ENTRIES <= 0:
+        return None
+    return make_cache_key(content_sha256, model_name, PROMPT_VERSION, SCHEMA_VERSION, SETTINGS_VERSION)
+
+
+async def _get_cached_result(cache_key: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Return a previously extracted result for the same upload, model, prompts and schema."""
+    if not cache_key:
+        return None
+    try:
+        result = await get_cached_result(db, cache_key, RESULT_CACHE_TTL)
+    except Exception as e:
+        logger.error(f"Error reading result cache: {str(e)}")
+        return None
+    if result is None:
+        return None
+
+    # No tokens are spent on a cache hit
+    CACHE_HITS.labels("result").inc()
+    result.update(NO_TOKEN_USAGE)
+    result["cache_hit"] = True
+    return result
+
+
+async def _store_cached_result(cache_key: Optional[str], model_name: str, result: Dict[str, Any]):
+    """Store a successful extraction result in the cache."""
+    if not cache_key or "invoice" not in result:
+        return
+    cached = {key: value for key, value in result.items() if key not in ("file_id", "cache_hit")}
+    try:
+        await store_cached_result(db, cache_key, model_name, cached, RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_TTL)
+    except Exception as e:
+        logger.error(f"Error writing result cache: {str(e)}")
+
+
+def _generation_config(cache_name: Optional[str]) -> Dict[str, Any]:
+    config = {
+        'response_mime_type': 'application/json',
+        'response_schema': Invoice,
+    }
+    if cache_name:
+        config['cached_content'] = cache_name
+    else:
+        config['system_instruction'] = SYSTEM_INSTRUCTION
+    return config
+
+
+def estimate_request_tokens(contents: List[Any], extra_fields: Optional[Dict[str, Any]] = None) -> int:
+    """Rough token estimate of a request for the rate limiter: text at 4 characters per token, images
+    by their tile estimate, plus the expected output."""
+    text_length = len(SYSTEM_INSTRUCTION) + sum(len(item) for item in contents if isinstance(item, str))
+    image_params = (extra_fields or {}).get("image_params") or {}
+    return text_length // 4 + image_params.get("estimated_tokens", 0) + GEMINI_OUTPUT_TOKEN_ESTIMATE
+
+
+async def generate_response(content, message, model_name, estimated_tokens: Optional[int] = None):
+    from google.genai import errors
+
+    async def call():
+        with observe_stage(STAGE_LLM_CALL, model=model_name) as span, \
+                LLM_CALLS_IN_FLIGHT.labels(model_label(model_name)).track_inprogress():
+            response = await call_model()
+            span.update(_usage_attributes(response.usage_metadata))
+            return response
+
+    async def call_model():
+        cache_name = prompt_cache.get(client, model_name) if prompt_cache else None
+        try:
+            return await client.aio.models.generate_content(
+                model=model_name,
+                contents=content,
+                config=_generation_config(cache_name),
+            )
+        except errors.ClientError as e:
+            if not cache_name or e.code not in (400, 403, 404):
+                raise
+            # The cached content expired or was deleted outside of this process, send the prompt inline
+            logger.warning(f"Prompt cache {cache_name} rejected, retrying without it: {str(e)}")
+            prompt_cache.invalidate(model_name, cache_name)
+            return await client.aio.models.generate_content(
+                model=model_name,
+                contents=content,
+                config=_generation_config(None),
+            )
+
+    if rate_limiter is None:
+        response = await call()
+    else:
+        # Waits for the model's request/token budget and retries 429/503 responses
+        response = await rate_limiter.run(
+            model_name,
+            estimated_tokens or estimate_request_tokens(content),
+            call,
+            used_tokens=lambda response: response.usage_metadata.total_token_count
+        )
     
-    invoice: Invoice = response.parsed
-    token_count = response.usage_metadata.total_token_count
-    input_token_count = response.usage_metadata.prompt_token_count
-    output_token_count = response.usage_metadata.candidates_token_count
-    thoughts_token_count = response.usage_metadata.thoughts_token_count
+    return _response_result(response.parsed, response.usage_metadata, message, model_name)
+
+
+def _usage_attributes(usage_metadata: Any) -> Dict[str, Any]:
+    """Token counts of a model call for its trace span."""
+    return {
+        "input_tokens": usage_metadata.prompt_token_count,
+        "output_tokens": usage_metadata.candidates_token_count,
+        "thoughts_tokens": usage_metadata.thoughts_token_count,
+        "cached_tokens": usage_metadata.cached_content_token_count,
+    }
+
+
+def _response_result(invoice: Invoice, usage_metadata: Any, message: str, model_name: str) -> Dict[str, Any]:
+    """Build the extraction result from the parsed invoice and the token usage of the response."""
+    token_count = usage_metadata.total_token_count
+    input_token_count = usage_metadata.prompt_token_count
+    output_token_count = usage_metadata.candidates_token_count
+    thoughts_token_count = usage_metadata.thoughts_token_count
+    cached_token_count = usage_metadata.cached_content_token_count or 0
     logger.info(message)
-    logger.info(f"Tokens: Input tokens: {input_token_count}, Output tokens: {output_token_count}, Thoughts tokens: {thoughts_token_count}, Total tokens: {token_count}")
+    logger.info(f"Tokens: Input tokens: {input_token_count} ({cached_token_count} cached), Output tokens: {output_token_count}, Thoughts tokens: {thoughts_token_count}, Total tokens: {token_count}")
+    count_tokens(model_name, input_token_count, output_token_count, thoughts_token_count, cached_token_count)
 
     return {
         "invoice": replace_null_values(invoice.model_dump()),
@@ -240,82 +742,477 @@ def generate_response(content, message, model_name):
         "input_token_count": input_token_count,
         "output_token_count": output_token_count,
         "thoughts_token_count": thoughts_token_count,
+        "cached_token_count": cached_token_count,
         "model": model_name
     }
 
 
-def process_image(model_name: str, image_path: str) -> Dict[str, Any]:
+async def _stream_chunks(contents, model_name: str) -> AsyncIterator["types.GenerateContentResponse"]:
+    """Stream the response chunks, falling back to the inline prompt like generate_response."""
+    from google.genai import errors
+
+    cache_name = prompt_cache.get(client, model_name) if prompt_cache else None
+    received = False
+    try:
+        async for chunk in await client.aio.models.generate_content_stream(
+            model=model_name,
+            contents=contents,
+            config=_generation_config(cache_name),
+        ):
+            received = True
+            yield chunk
+    except errors.ClientError as e:
+        if received or not cache_name or e.code not in (400, 403, 404):
+            raise
+        logger.warning(f"Prompt cache {cache_name} rejected, retrying without it: {str(e)}")
+        prompt_cache.invalidate(model_name, cache_name)
+        async for chunk in await client.aio.models.generate_content_stream(
+            model=model_name,
+            contents=contents,
+            config=_generation_config(None),
+        ):
+            yield chunk
+
+
+async def generate_response_stream(content, message, model_name,
+                                   estimated_tokens: Optional[int] = None) -> AsyncIterator[Tuple[Any, ...]]:
+    """
+    Streaming variant of generate_response. Yields the events of the incremental JSON parser while the
+    model generates the invoice, ("field", name, value) for the top-level fields and ("item", "lines",
+    index, line) for the line items, and finally ("result", result) with the validated invoice.
+    """
+    parser = IncrementalJsonParser(stream_arrays=("lines",))
+    text_parts: List[str] = []
+    usage_metadata = None
+    # A stream is not retried once events were sent, it only waits for the model's budget
+    limit = rate_limiter.slot(model_name, estimated_tokens or estimate_request_tokens(content)) if rate_limiter else nullcontext()
+    async with limit as slot:
+        with observe_stage(STAGE_LLM_CALL, model=model_name) as span, \
+                LLM_CALLS_IN_FLIGHT.labels(model_label(model_name)).track_inprogress():
+            async for chunk in _stream_chunks(content, model_name):
+                if chunk.usage_metadata:
+                    usage_metadata = chunk.usage_metadata
+                text = chunk.text
+                if not text:
+                    continue
+                text_parts.append(text)
+                for event in parser.feed(text):
+                    yield event
+            if usage_metadata:
+                span.update(_usage_attributes(usage_metadata))
+        if slot and usage_metadata:
+            slot.used_tokens = usage_metadata.total_token_count
+
+    invoice = Invoice.model_validate_json("".join(text_parts))
+    yield ("result", _response_result(invoice, usage_metadata, message, model_name))
+
+
+def _prepare_images(images: List["Image.Image"],
+                    max_long_edge: int = None) -> Tuple[List["types.Part"], Dict[str, Any]]:
+    """
+    Downscale and re-encode images to the configured budget (blocking, run in a worker thread).
+    Returns the parts for the model and a summary of the applied parameters stored with the record.
+    """
+    from google.genai import types
+    from image_prep import prepare_image
+
+    if max_long_edge is None:
+        max_long_edge = IMAGE_MAX_LONG_EDGE
+    parts = []
+    pages = []
+    for image in images:
+        data, mime_type, params = prepare_image(
+            image,
+            max_long_edge=max_long_edge,
+            max_tokens=IMAGE_MAX_TOKENS,
+            grayscale=IMAGE_GRAYSCALE,
+            image_format=IMAGE_FORMAT,
+            quality=IMAGE_QUALITY,
+        )
+        parts.append(types.Part.from_bytes(data=data, mime_type=mime_type))
+        pages.append(params)
+
+    summary = {
+        "max_long_edge": max_long_edge,
+        "max_tokens": IMAGE_MAX_TOKENS,
+        "grayscale": IMAGE_GRAYSCALE,
+        "format": IMAGE_FORMAT,
+        "quality": IMAGE_QUALITY,
+        "bytes": sum(page["bytes"] for page in pages),
+        "estimated_tokens": sum(page["estimated_tokens"] for page in pages),
+        "pages": pages,
+    }
+    return parts, summary
+
+
+def _load_image(document: BinaryIO) -> Tuple[List["types.Part"], Dict[str, Any]]:
+    """Decode and prepare an uploaded image (blocking, run in a worker thread)."""
+    from image_prep import open_image
+
+    image = open_image(document, IMAGE_MAX_LONG_EDGE, IMAGE_GRAYSCALE)
+    return _prepare_images([image])
+
+
+def _convert_to_markdown(document: BinaryIO, mime_type: str) -> str:
+    """Convert a document to markdown text using the shared MarkItDown converter (blocking, run in a worker thread)."""
+    return document_converter.convert(document, mime_type)
+
+
+_rasterizer: Optional[Rasterizer] = None
+
+
+def check_pdf_settings():
+    """Reject an unknown PDF_DIGITAL_MODE at startup, digital PDFs would silently be sent like scans."""
+    if PDF_DIGITAL_MODE not in PDF_DIGITAL_MODES:
+        message = f"PDF_DIGITAL_MODE must be one of {', '.join(PDF_DIGITAL_MODES)}, got {PDF_DIGITAL_MODE!r}"
+        logger.error(message)
+        raise RuntimeError(message)
+
+
+def _get_rasterizer() -> Rasterizer:
+    """Return the configured PDF rasterizer backend (created on first use)."""
+    global _rasterizer
+    if _rasterizer is None:
+        _rasterizer = get_rasterizer(
+            PDF_RASTERIZER,
+            dpi=PDF_DPI,
+            grayscale=PDF_GRAYSCALE,
+            thread_count=PDF_RASTER_THREADS,
+            jpeg_quality=PDF_JPEG_QUALITY,
+        )
+    return _rasterizer
+
+
+def _rasterize_pdf(document: BinaryIO, max_pages: int = None) -> List["Image.Image"]:
+    """
+    Render the first pages (PDF_MAX_PAGES by default) to images (blocking, run in a worker thread).
+    Pages beyond the limit are never rendered, so the cost does not depend on the length of the PDF.
+    """
+    document.seek(0)
+    return _get_rasterizer().render(document.read(), PDF_MAX_PAGES if max_pages is None else max_pages)
+
+
+def _classify_pdf(document: BinaryIO) -> Dict[str, Any]:
+    """Classify the PDF as born-digital or scanned (blocking, run in a worker thread)."""
+    document.seek(0)
+    return classify_pdf(
+        document.read(),
+        max_pages=PDF_MAX_PAGES,
+        min_char_density=PDF_MIN_CHAR_DENSITY,
+        max_image_coverage=PDF_MAX_IMAGE_COVERAGE,
+    )
+
+
+def _document_text_prompt(markdown_text: str) -> str:
+    """Prompt part with the converted document text, truncated to DOCUMENT_TEXT_MAX_CHARS characters."""
+    document_text = markdown_text[:DOCUMENT_TEXT_MAX_CHARS]
+    set_trace_attributes(markdown_chars=len(markdown_text), markdown_chars_sent=len(document_text))
+    return PROMPT_TEMPLATE_DOCUMENT_TEXT.format(document_text=document_text)
+
+
+async def build_image_request(document: BinaryIO) -> Tuple[List[Any], Dict[str, Any]]:
+    """Preprocess an image into the model contents; returns the contents and the fields added to the result."""
+    with observe_stage(STAGE_IMAGE_PREPARATION):
+        image_parts, image_params = await asyncio.to_thread(_load_image, document)
+    set_trace_attributes(page_count=1, image_bytes=image_params["bytes"])
+    return [*image_parts], {"image_params": image_params}
+
+
+async def build_pdf_request(document: BinaryIO) -> Tuple[List[Any], Dict[str, Any]]:
+    """Convert, classify and render a PDF into the model contents and the fields added to the result."""
+    # Use MarkItDown to convert PDF to markdown text
+    with observe_stage(STAGE_CONVERSION):
+        markdown_text = await asyncio.to_thread(_convert_to_markdown, document, 'application/pdf')
+    logger.info(f"PDF converted to markdown text using MarkItDown")
+
+    # Page images are only needed in full for scans, the text layer of digital PDFs is complete.
+    # With PDF_DIGITAL_MODE=images every PDF is sent like a scan, so parsing its pages would be wasted
+    if PDF_DIGITAL_MODE == "images":
+        classification = {"kind": PDF_UNKNOWN, "pages": []}
+    else:
+        classification = await asyncio.to_thread(_classify_pdf, document)
+    route = PDF_DIGITAL_MODE if classification["kind"] == PDF_DIGITAL else "images"
+    logger.info(f"PDF classified as {classification['kind']}, sending {route}")
+    set_trace_attributes(page_count=classification.get("page_count"), pdf_kind=classification["kind"], pdf_route=route)
+
+    image_parts: List["types.Part"] = []
+    image_params = None
+    if route != "text":
+        # Digital PDFs get a smaller image of the first page only
+        first_page = route == "first_page"
+        with observe_stage(STAGE_RASTERIZATION) as span:
+            pages = await asyncio.to_thread(_rasterize_pdf, document, 1 if first_page else None)
+            span.update(pages=len(pages), dpi=PDF_DPI)
+        logger.info(f"PDF rendered to {len(pages)} page images at {PDF_DPI} DPI")
+        with observe_stage(STAGE_IMAGE_PREPARATION):
+            image_parts, image_params = await asyncio.to_thread(
+                _prepare_images, pages, PDF_DIGITAL_LONG_EDGE if first_page else None
+            )
+        set_trace_attributes(rendered_pages=len(pages), dpi=PDF_DPI, image_bytes=image_params["bytes"])
+
+    contents: List[Any] = [
+        _document_text_prompt(markdown_text),
+    ]
+    contents.extend(image_parts)
+
+    pdf_route = {"kind": classification["kind"], "route": route, "pages": classification["pages"]}
+    return contents, {"image_params": image_params, "pdf_route": pdf_route}
+
+
+async def build_docx_request(document: BinaryIO) -> Tuple[List[Any], Dict[str, Any]]:
+    """Convert a DOCX document into the model contents."""
+    # Use MarkItDown to convert DOCX to markdown text
+    with observe_stage(STAGE_CONVERSION):
+        markdown_text = await asyncio.to_thread(
+            _convert_to_markdown,
+            document,
+            'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+        )
+    logger.info(f"DOCX converted to markdown text using MarkItDown")
+
+    contents = [
+        _document_text_prompt(markdown_text),
+    ]
+    return contents, {}
+
+
+REQUEST_BUILDERS = {
+    "image": build_image_request,
+    "pdf": build_pdf_request,
+    "docx": build_docx_request,
+}
+
+
+async def build_request(file_type: str, document: BinaryIO) -> Tuple[List[Any], Dict[str, Any]]:
+    """
+    Build the model contents for a document of the given type (see FILE_TYPES). The static prompt is not
+    part of the contents, it is sent as the system instruction; the interactive and bulk paths share this.
+    """
+    return await REQUEST_BUILDERS[file_type](document)
+
+
+def _error_type(error: Exception) -> str:
+    """Error label of the invoice_errors_total metric."""
+    return "quota_exceeded" if is_overload_error(error) else type(error).__name__
+
+
+def _processing_error(kind: str, error: Exception) -> HTTPException:
+    """HTTP error for a failed extraction: 503 with Retry-After when the model is still over quota after the retries."""
+    count_error(STAGE_EXTRACTION, _error_type(error))
+    if is_overload_error(error):
+        retry_after = math.ceil(retry_after_seconds(error) or GEMINI_RETRY_BASE_DELAY * 2 ** GEMINI_MAX_RETRIES)
+        return HTTPException(
+            status_code=503,
+            detail=f"Model quota exceeded while processing {kind}, retry later: {str(error)}",
+            headers={"Retry-After": str(retry_after)}
+        )
+    return HTTPException(status_code=500, detail=f"Error processing {kind}: {str(error)}")
+
+
+async def process_image(model_name: str, document: BinaryIO, file_name: str = "") -> Dict[str, Any]:
     """Process an image using Gemini and extract invoice data"""
     try:
-        image = Image.open(image_path)
+        contents, extra_fields = await build_image_request(document)
         
-        logger.info(f"Processing image: {Path(image_path).name}")
+        logger.info(f"Processing image: {file_name}")
         # global client
         if not client:
             raise RuntimeError("Gemini client not initialized")
 
-        contents = [PROMPT_SYSTEM, PROMPT_UNIFIED_POLICY, image]
-
-        return generate_response(contents, f"Processing image: {Path(image_path).name}", model_name)
+        result = await generate_response(contents, f"Processing image: {file_name}", model_name,
+                                         estimate_request_tokens(contents, extra_fields))
+        result.update(extra_fields)
+        return result
 
     except Exception as e:
-        logger.error(f"Error processing image {image_path}: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
+        logger.error(f"Error processing image {file_name}: {str(e)}")
+        raise _processing_error("image", e)
 
 
-def process_pdf(model_name: str, pdf_path: str) -> Dict[str, Any]:
+async def process_pdf(model_name: str, document: BinaryIO, file_name: str = "") -> Dict[str, Any]:
     """Process a PDF document using Gemini"""
     try:
-        # Use MarkItDown to convert PDF to markdown text
-        md = MarkItDown(enable_plugins=False)
-        with open(pdf_path, 'rb') as f:
-            result = md.convert_stream(f, mime_type='application/pdf')
-        
-        markdown_text = result.text_content or ""
-        logger.info(f"PDF converted to markdown text using MarkItDown")
-        
-        # Also convert PDF to image for visual analysis
-        pages = convert_from_path(pdf_path)
-        if len(pages) > 5:
-            pages = pages[:5]
-            logger.info(f"PDF has more than 5 pages, limiting to first 5 pages")
-
-        contents: List[Any] = [
-            PROMPT_SYSTEM,
-            PROMPT_UNIFIED_POLICY,
-            PROMPT_TEMPLATE_DOCUMENT_TEXT.format(document_text=markdown_text[:8000]),
-        ]
-        contents.extend(pages)
+        contents, extra_fields = await build_pdf_request(document)
 
-        return generate_response(contents, f"Processing PDF: {Path(pdf_path).name}", model_name)
+        result = await generate_response(contents, f"Processing PDF: {file_name}", model_name,
+                                         estimate_request_tokens(contents, extra_fields))
+        result.update(extra_fields)
+        return result
 
     except Exception as e:
-        logger.error(f"Error processing PDF {pdf_path}: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error processing PDF: {str(e)}")
+        logger.error(f"Error processing PDF {file_name}: {str(e)}")
+        raise _processing_error("PDF", e)
 
 
-def process_docx(model_name: str, docx_path: str) -> Dict[str, Any]:
+async def process_docx(model_name: str, document: BinaryIO, file_name: str = "") -> Dict[str, Any]:
     """Process a DOCX document using Gemini"""
     try:
-        # Use MarkItDown to convert DOCX to markdown text
-        md = MarkItDown(enable_plugins=False)
-        with open(docx_path, 'rb') as f:
-            result = md.convert_stream(f, mime_type='application/vnd.openxmlformats-officedocument.wordprocessingml.document')
-        
-        markdown_text = result.text_content or ""
-        logger.info(f"DOCX converted to markdown text using MarkItDown")
+        contents, extra_fields = await build_docx_request(document)
+
+        result = await generate_response(contents, f"Processing DOCX: {file_name}", model_name,
+                                         estimate_request_tokens(contents, extra_fields))
+        result.update(extra_fields)
+        return result
+
+    except Exception as e:
+        logger.error(f"Error processing DOCX {file_name}: {str(e)}")
+        raise _processing_error("DOCX", e)
+
+
+def _check_model(model_name: str):
+    """Reject a model outside GEMINI_ALLOWED_MODELS with HTTP 400, before any per-model state is created."""
+    if model_name not in GEMINI_ALLOWED_MODELS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"model_name must be one of: {', '.join(sorted(GEMINI_ALLOWED_MODELS))}"
+        )
+
+
+def _start_request_trace(file_id: str, model_name: str) -> Trace:
+    """
+    Trace the rest of the current task and tag its log records with the request. Each request
+    (and each file of a batch) runs in its own task, so both end with it.
+    """
+    trace = Trace()
+    set_current_trace(trace)
+    set_log_context(request_id=trace.trace_id, file_id=file_id, model=model_name)
+    return trace
+
+
+async def _read_upload(file: UploadFile, max_size: Optional[int] = None, model_name: str = "",
+                       spool_size: int = UPLOAD_SPOOL_SIZE) -> Upload:
+    """Stream an upload into a bounded buffer, rejecting oversized files with HTTP 413."""
+    file_type = FILE_TYPES.get(file.filename.lower().split('.')[-1], "other")
+    try:
+        with observe_stage(STAGE_UPLOAD_READ, file_type, model_name):
+            return await Upload.from_upload_file(file, MAX_UPLOAD_SIZE if max_size is None else max_size, spool_size)
+    except UploadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls with the same key: the first caller starts the function as a task,
+    later callers await its result instead of running the pipeline again. The task is shielded from
+    its callers, so a cancelled caller (e.g. a disconnected client) does not cancel the others; it runs
+    to completion even when all of them are gone.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
 
-        contents = [
-            PROMPT_SYSTEM,
-            PROMPT_UNIFIED_POLICY,
-            PROMPT_TEMPLATE_DOCUMENT_TEXT.format(document_text=markdown_text[:8000]),
-        ]
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Return the result of fn() and whether it was shared with an earlier in-flight call."""
+        task = self._calls.get(key)
+        shared = task is not None
+        if task is None:
+            task = asyncio.create_task(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        return copy.deepcopy(await asyncio.shield(task)), shared
 
-        return generate_response(contents, f"Processing DOCX: {Path(docx_path).name}", model_name)
+    def _forget(self, key: str, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()  # Mark as retrieved when every caller was cancelled
+
+
+# In-flight extractions keyed by the upload hash and the model
+in_flight_extractions = SingleFlight()
+
+
+async def _run_cascade(model_name: str, document: BinaryIO, file_type: str, filename: str) -> Dict[str, Any]:
+    """
+    Extract with CASCADE_MODEL first and check the invoice deterministically (line amounts, totals, dates,
+    company IDs); only when a check fails is the same preprocessed request sent to the requested model.
+    """
+    kind = PROCESSING_KINDS[file_type]
+    try:
+        if not client:
+            raise RuntimeError("Gemini client not initialized")
+        contents, extra_fields = await build_request(file_type, document)
+        estimated_tokens = estimate_request_tokens(contents, extra_fields)
+
+        result = await generate_response(contents, f"Processing {kind} with {CASCADE_MODEL}: {filename}",
+                                         CASCADE_MODEL, estimated_tokens)
+        failures = check_invoice(result["invoice"])
+        cascade = {"tier": TIER_CHEAP, "models": [CASCADE_MODEL], "failed_checks": failures}
+        if failures:
+            logger.info(f"Escalating {filename} to {model_name}, failed checks: "
+                        f"{'; '.join(failure['message'] for failure in failures)}")
+            cheap_result = result
+            result = await generate_response(contents, f"Processing {kind} with {model_name}: {filename}",
+                                             model_name, estimated_tokens)
+            # Both calls were paid for
+            for key in NO_TOKEN_USAGE:
+                result[key] = (result[key] or 0) + (cheap_result[key] or 0)
+            cascade.update(tier=TIER_STRONG, models=[CASCADE_MODEL, model_name],
+                           escalated_failed_checks=check_invoice(result["invoice"]))
+
+        result["cascade"] = cascade
+        result.update(extra_fields)
+        return result
 
     except Exception as e:
-        logger.error(f"Error processing DOCX {docx_path}: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error processing DOCX: {str(e)}")
+        logger.error(f"Error processing {kind} {filename}: {str(e)}")
+        raise _processing_error(kind, e)
+
+
+async def _run_pipeline(model_name: str, document: BinaryIO, file_extension: str, filename: str) -> Dict[str, Any]:
+    """Run the extraction pipeline matching the file type on the upload buffer."""
+    file_type = FILE_TYPES[file_extension]
+    if CASCADE_MODEL and CASCADE_MODEL != model_name:
+        return await _run_cascade(model_name, document, file_type, filename)
+    if file_type == "image":
+        return await process_image(model_name, document, filename)
+    elif file_type == "pdf":
+        return await process_pdf(model_name, document, filename)
+    else:
+        return await process_docx(model_name, document, filename)
+
+
+async def _run_shared_pipeline(model_name: str, upload: Upload, file_extension: str, filename: str,
+                               cache_key: Optional[str]) -> Dict[str, Any]:
+    """Run the pipeline for all the requests waiting on the upload and release the upload afterwards."""
+    try:
+        result = await _run_pipeline(model_name, upload.buffer, file_extension, filename)
+        await _store_cached_result(cache_key, model_name, result)
+        return result
+    finally:
+        upload.close()
+
+
+async def _extract(model_name: str, upload: Upload, file_extension: str, filename: str) -> Dict[str, Any]:
+    """
+    Extract invoice data from a supported upload. The result is served from the result cache
+    when possible and identical concurrent uploads share a single pipeline run.
+    """
+    with metric_labels(FILE_TYPES[file_extension], model_name):
+        return await _extract_labelled(model_name, upload, file_extension, filename)
+
+
+async def _extract_labelled(model_name: str, upload: Upload, file_extension: str, filename: str) -> Dict[str, Any]:
+    content_sha256 = upload.sha256
+    cache_key = _result_cache_key(content_sha256, model_name)
+    cached_result = await _get_cached_result(cache_key)
+    if cached_result is not None:
+        logger.info(f"Result cache hit for file {filename}")
+        return cached_result
+
+    def run():
+        # The shared run may outlive the request that started it (see SingleFlight), so it holds its own
+        # reference to the upload, taken before that request can be cancelled and close its own
+        return _run_shared_pipeline(model_name, upload.retain(), file_extension, filename, cache_key)
+
+    result, shared = await in_flight_extractions.do(f"{content_sha256}:{model_name}", run)
+    if shared:
+        # The tokens were spent (and recorded) by the request that ran the pipeline
+        logger.info(f"Shared in-flight extraction result for file {filename}")
+        CACHE_HITS.labels("in_flight").inc()
+        result.update(NO_TOKEN_USAGE)
+    result["cache_hit"] = shared
+    return result
 
 
 @app.post("/invoice", response_class=JSONResponse)
@@ -323,106 +1220,300 @@ async def process_invoice(file: UploadFile = File(...), file_id: str = Form(...)
     """
     Process an invoice document (image, PDF, or DOCX) and extract structured data
     """
+    _check_model(model_name)
+    _start_request_trace(file_id, model_name)
     # Check file type
     file_extension = file.filename.lower().split('.')[-1]
     
-    # Save uploaded file temporarily
-    temp_file_path = tempfile.mktemp(suffix=f'.{file_extension}')    
+    upload = None
     try:
-        # Read the uploaded file content
-        content = await file.read()
-        
-        # Save to temporary file for processing
-        with open(temp_file_path, 'wb') as temp_file:
-            temp_file.write(content)
-        
+        if file_extension not in FILE_TYPES:
+            error_msg = f"Unsupported file format: {file_extension}"
+            raise HTTPException(status_code=400, detail=error_msg)
+
+        # Stream the uploaded file content into the processing buffer
+        upload = await _read_upload(file, model_name=model_name)
+
         # Process file based on type
-        try:
-            if file_extension in ['jpg', 'jpeg', 'png']:
-                result = process_image(model_name, temp_file_path)
-                file_type = "image"
-            elif file_extension == 'pdf':
-                result = process_pdf(model_name, temp_file_path)
-                file_type = "pdf"
-            elif file_extension == 'docx':
-                result = process_docx(model_name, temp_file_path)
-                file_type = "docx"
-            else:
-                error_msg = f"Unsupported file format: {file_extension}"                # Log the error to database
-                raise HTTPException(status_code=400, detail=error_msg)
-              # Add file_id to the result
-            result["file_id"] = file_id
-              # Store processing data in database
-            save_to_database(
-                file_id=file_id,
-                file_name=file.filename,
-                file_type=file_type,
-                model=model_name,
-                token_count=result.get("total_token_count"),
-                input_token_count=result.get("input_token_count"),
-                output_token_count=result.get("output_token_count"),
-                thoughts_token_count=result.get("thoughts_token_count"),
-                response_data=result
+        result = await _extract(model_name, upload, file_extension, file.filename)
+        # Add file_id to the result
+        result["file_id"] = file_id
+        # Store processing data in database
+        await _save_result(file_id, file.filename, FILE_TYPES[file_extension], model_name, result)
+
+        return result
+    except HTTPException as e:  # Handle HTTP exceptions raised during processing
+        logger.error(f"HTTP error processing file {file.filename}: {str(e)}")
+        raise e
+    except Exception as e:            # Log any other exceptions
+        error_msg = f"Error processing file: {str(e)}"
+        raise HTTPException(status_code=500, detail=error_msg)
+    finally:
+        if upload is not None:
+            upload.close()
+
+
+@app.post("/invoice/stream")
+async def process_invoice_stream(file: UploadFile = File(...), file_id: str = Form(...), model_name: str = Form(...)):
+    """
+    Process an invoice document like POST /invoice and stream the extraction as Server-Sent Events:
+    a `field` event for every top-level invoice field as soon as the model has generated it, a `line` event
+    per line item and finally an `invoice` event with the validated result (the POST /invoice response).
+    Failures after the stream has started are sent as an `error` event.
+    """
+    _check_model(model_name)
+    file_extension = file.filename.lower().split('.')[-1]
+    if file_extension not in FILE_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unsupported file format: {file_extension}")
+
+    # Inherited by the task streaming the response
+    _start_request_trace(file_id, model_name)
+    upload = await _read_upload(file, model_name=model_name)
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(
+        _stream_extraction(model_name, upload, file_extension, file.filename, file_id),
+        media_type="text/event-stream",
+        headers=headers
+    )
+
+
+def _sse_event(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _invoice_events(invoice: Dict[str, Any]):
+    """Field and line events for an already extracted invoice (result cache hit)."""
+    for name, value in invoice.items():
+        if name == "lines" and isinstance(value, list):
+            for index, line in enumerate(value):
+                yield _sse_event("line", {"index": index, "line": line})
+        else:
+            yield _sse_event("field", {"name": name, "value": value})
+
+
+async def _stream_extraction(model_name: str, upload: Upload, file_extension: str, filename: str, file_id: str):
+    file_type = FILE_TYPES[file_extension]
+    # The generator runs in the response's own task, the labels do not outlive the request
+    set_metric_labels(file_type, model_name)
+    result = None
+    try:
+        cache_key = _result_cache_key(upload.sha256, model_name)
+        result = await _get_cached_result(cache_key)
+        if result is not None:
+            logger.info(f"Result cache hit for file {filename}")
+            for event in _invoice_events(result["invoice"]):
+                yield event
+        else:
+            if not client:
+                raise RuntimeError("Gemini client not initialized")
+            contents, extra_fields = await build_request(file_type, upload.buffer)
+            estimated_tokens = estimate_request_tokens(contents, extra_fields)
+            async for event in generate_response_stream(contents, f"Streaming {file_type}: {filename}", model_name,
+                                                        estimated_tokens):
+                if event[0] == "result":
+                    result = event[1]
+                elif event[0] == FIELD_EVENT:
+                    yield _sse_event("field", {"name": event[1], "value": replace_null_values(event[2])})
+                else:
+                    yield _sse_event("line", {"index": event[2], "line": replace_null_values(event[3])})
+            result.update(extra_fields)
+            await _store_cached_result(cache_key, model_name, result)
+            result["cache_hit"] = False
+
+        result["file_id"] = file_id
+        await _save_result(file_id, filename, file_type, model_name, result)
+        yield _sse_event("invoice", result)
+    except Exception as e:
+        logger.error(f"Error streaming file {filename}: {str(e)}")
+        if result is None:
+            count_error(STAGE_EXTRACTION, _error_type(e))
+        yield _sse_event("error", {"detail": str(e)})
+    finally:
+        upload.close()
+
+
+@app.post("/invoices/batch")
+async def process_invoice_batch(files: List[UploadFile] = File(...), model_name: str = Form(...),
+                                file_ids: Optional[List[str]] = Form(None)):
+    """
+    Process many invoice documents in one request and stream one NDJSON line per file as it completes.
+    Files can be sent as several multipart files and/or ZIP archives (expanded in place); `file_ids` are
+    matched to the files in that order and default to the file names. BATCH_CONCURRENCY files are
+    processed at a time, so preprocessing of one file overlaps with the Gemini calls of the others.
+    """
+    _check_model(model_name)
+    documents = await _read_batch(files, model_name)
+    try:
+        if not documents:
+            raise HTTPException(status_code=400, detail="No files in the batch")
+        if file_ids and len(file_ids) != len(documents):
+            raise HTTPException(
+                status_code=400,
+                detail=f"Got {len(file_ids)} file_ids for {len(documents)} files"
             )
+    except HTTPException:
+        _close_batch(documents)
+        raise
 
-            return result
-        except HTTPException as e:  # Handle HTTP exceptions raised during processing
-            logger.error(f"HTTP error processing file {file.filename}: {str(e)}")
-            raise e
-        except Exception as e:            # Log any other exceptions
-            error_msg = f"Error processing file: {str(e)}"
-            raise HTTPException(status_code=500, detail=error_msg)
-    
+    ids = file_ids or [filename for filename, _ in documents]
+    headers = {"X-Batch-Count": str(len(documents))}
+    return StreamingResponse(_stream_batch(model_name, documents, ids), media_type="application/x-ndjson", headers=headers)
+
+
+async def _read_batch(files: List[UploadFile], model_name: str) -> List[Tuple[str, Upload]]:
+    """
+    Read the batch files into upload buffers, expanding ZIP archives. All of them are read before the
+    first one is processed, so beyond BATCH_SPOOL_SIZE bytes each one waits in a temporary file.
+    """
+    documents: List[Tuple[str, Upload]] = []
+    try:
+        for file in files:
+            if not file.filename.lower().endswith(".zip"):
+                documents.append((file.filename, await _read_upload(file, model_name=model_name,
+                                                                    spool_size=BATCH_SPOOL_SIZE)))
+            else:
+                archive = await _read_upload(file, BATCH_MAX_SIZE, model_name, BATCH_SPOOL_SIZE)
+                try:
+                    remaining = BATCH_MAX_FILES - len(documents) if BATCH_MAX_FILES else 0
+                    if BATCH_MAX_FILES and remaining <= 0:
+                        raise UploadTooLargeError(f"Batch contains more than {BATCH_MAX_FILES} files")
+                    documents.extend(await asyncio.to_thread(
+                        expand_zip, archive, MAX_UPLOAD_SIZE, BATCH_SPOOL_SIZE, remaining
+                    ))
+                finally:
+                    archive.close()
+            if BATCH_MAX_FILES and len(documents) > BATCH_MAX_FILES:
+                raise UploadTooLargeError(f"Batch contains more than {BATCH_MAX_FILES} files")
+    except UploadTooLargeError as e:
+        _close_batch(documents)
+        raise HTTPException(status_code=413, detail=str(e))
+    except zipfile.BadZipFile as e:
+        _close_batch(documents)
+        raise HTTPException(status_code=400, detail=f"Invalid ZIP archive: {str(e)}")
+    except BaseException:
+        _close_batch(documents)
+        raise
+    return documents
+
+
+def _close_batch(documents: List[Tuple[str, Upload]]):
+    for _, upload in documents:
+        upload.close()
+
+
+async def _process_batch_item(model_name: str, index: int, filename: str, file_id: str,
+                              upload: Upload) -> Dict[str, Any]:
+    """Extract and store one batch file; failures are reported in its line instead of failing the batch."""
+    # Every file is processed in its own task and gets its own trace
+    _start_request_trace(file_id, model_name)
+    line = {"index": index, "file_id": file_id, "filename": filename}
+    file_extension = filename.lower().split('.')[-1]
+    try:
+        if file_extension not in FILE_TYPES:
+            raise HTTPException(status_code=400, detail=f"Unsupported file format: {file_extension}")
+        result = await _extract(model_name, upload, file_extension, filename)
+        result["file_id"] = file_id
+        await _save_result(file_id, filename, FILE_TYPES[file_extension], model_name, result)
+        return {**line, "status": "ok", **result}
+    except Exception as e:
+        error = e.detail if isinstance(e, HTTPException) else str(e)
+        logger.error(f"Error processing batch file {filename}: {error}")
+        return {**line, "status": "error", "error": error}
+    finally:
+        upload.close()
+
+
+async def _stream_batch(model_name: str, documents: List[Tuple[str, Upload]], file_ids: List[str]):
+    semaphore = asyncio.Semaphore(max(1, BATCH_CONCURRENCY))
+
+    async def process(index: int, filename: str, upload: Upload) -> Dict[str, Any]:
+        async with semaphore:
+            return await _process_batch_item(model_name, index, filename, file_ids[index], upload)
+
+    tasks = [asyncio.create_task(process(index, filename, upload)) for index, (filename, upload) in enumerate(documents)]
+    try:
+        for completed in asyncio.as_completed(tasks):
+            yield json.dumps(await completed) + "\n"
     finally:
-        # Clean up the temp file
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
+        # The client went away: stop the files not processed yet
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        _close_batch(documents)
 
 
 @app.post("/invoice/async", response_class=JSONResponse)
 async def process_invoice_async(file: UploadFile = File(...), file_id: str = Form(...), model_name: str = Form(...)):
     """
     Asynchronously process an invoice document and immediately respond.
-    The result will be sent to the configured CALLBACK_URL.
+    The file is stored in the persistent job queue and processed by the worker pool;
+    the result will be sent to the configured CALLBACK_URL.
     """
+    _check_model(model_name)
+    if job_queue is None:
+        raise HTTPException(status_code=503, detail="Job queue is not running")
+
     file_extension = file.filename.lower().split('.')[-1]
-    temp_file_path = tempfile.mktemp(suffix=f'.{file_extension}')
+    upload = await _read_upload(file, model_name=model_name)
     try:
-        content = await file.read()
-        with open(temp_file_path, 'wb') as temp_file:
-            temp_file.write(content)
-
-        # Respond immediately
-        response_data = {"status": "processing", "file_id": file_id, "filename": file.filename}
-        asyncio.create_task(
-            _process_and_callback(
-                model_name,
-                temp_file_path,
-                file_extension,
-                file_id,
-                file.filename,
-                CALLBACK_URL
-            )
+        job_id = await job_queue.enqueue(
+            file_id,
+            file.filename,
+            file_extension,
+            model_name,
+            upload.read_bytes(),
+            CALLBACK_URL
         )
-        return response_data
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     finally:
-        # Do not remove temp file here; cleanup is handled in the background task
-        pass
+        upload.close()
+
+    # Respond immediately
+    return {"status": "processing", "job_id": job_id, "file_id": file_id, "filename": file.filename}
+
+
+@app.get("/invoice/async/{job_id}")
+async def get_async_job(job_id: int):
+    """Return the state of a job submitted to /invoice/async (queued, running, done or failed)"""
+    if job_queue is None:
+        raise HTTPException(status_code=503, detail="Job queue is not running")
+
+    job = await job_queue.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Job with ID {job_id} not found")
+    return job
+
+
+async def _run_job(job: Dict[str, Any]):
+    """Job queue handler: process the stored upload."""
+    trace = Trace()
+    with trace_context(trace), log_context(request_id=trace.trace_id, file_id=job["file_id"], model=job["model"]):
+        await _process_and_callback(
+            job["model"],
+            job["payload"],
+            job["file_extension"],
+            job["file_id"],
+            job["file_name"],
+            job["callback_url"]
+        )
+
+async def _send_callback(callback_url: str, payload: Dict[str, Any]):
+    """Store a callback in the outbox, the dispatcher delivers it (with retries) in the background."""
+    if callback_outbox is None:
+        raise RuntimeError("Callback outbox is not running")
+    await callback_outbox.enqueue(callback_url, payload)
+
 
-async def _process_and_callback(model_name, temp_file_path, file_extension, file_id, filename, callback_url):
+async def _process_and_callback(model_name, content, file_extension, file_id, filename, callback_url):
     file_type = None
     result = None
     error_message = None
+    upload = Upload.from_bytes(content)
     try:
-        if file_extension in ['jpg', 'jpeg', 'png']:
-            result = process_image(model_name, temp_file_path)
-            file_type = "image"
-        elif file_extension == 'pdf':
-            result = process_pdf(model_name, temp_file_path)
-            file_type = "pdf"
-        elif file_extension == 'docx':
-            result = process_docx(model_name, temp_file_path)
-            file_type = "docx"
+        if file_extension in FILE_TYPES:
+            result = await _extract(model_name, upload, file_extension, filename)
+            file_type = FILE_TYPES[file_extension]
         else:
             error_message = f"Unsupported file format: {file_extension}"
             result = {"error": error_message}
@@ -432,34 +1523,32 @@ async def _process_and_callback(model_name, temp_file_path, file_extension, file
             result["file_id"] = file_id
 
         # Save to database
-        save_to_database(
-            file_id=file_id,
-            file_name=filename,
-            file_type=file_type,
-            model=model_name,
-            token_count=result.get("total_token_count") if result else None,
-            input_token_count=result.get("input_token_count") if result else None,
-            output_token_count=result.get("output_token_count") if result else None,
-            thoughts_token_count=result.get("thoughts_token_count") if result else None,
-            response_data=result,
-            error_message=error_message
-        )
+        await _save_result(file_id, filename, file_type, model_name, result, error_message)
 
         # Send callback if URL is set
         if callback_url:
-            async with httpx.AsyncClient(timeout=30) as client:
-                await client.post(callback_url, json=result if result else {"error": error_message, "file_id": file_id})
+            await _send_callback(callback_url, result if result else {"error": error_message, "file_id": file_id})
         else:
             logger.warning("No CALLBACK_URL configured; skipping callback.")
     except Exception as e:
         logger.error(f"Async processing error for file {filename}: {str(e)}")
         # Attempt to send error callback
         if callback_url:
-            async with httpx.AsyncClient(timeout=30) as client:
-                await client.post(callback_url, json={"error": str(e), "file_id": file_id})
+            await _send_callback(callback_url, {"error": str(e), "file_id": file_id})
+        # Let the job queue mark the job as failed
+        raise
     finally:
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
+        upload.close()
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics: stage latency histograms, token, cache hit and error counters, queue depths"""
+    if job_queue is not None:
+        QUEUE_DEPTH.labels("jobs").set(await job_queue.pending_count())
+    if callback_outbox is not None:
+        QUEUE_DEPTH.labels("callbacks").set(await callback_outbox.pending_count())
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 
 @app.get("/healthcheck")
@@ -468,83 +1557,211 @@ async def healthcheck():
     return {"status": "healthy", "timestamp": datetime.now().isoformat()}
 
 
+def _encode_history_cursor(timestamp: str, record_id: int) -> str:
+    """Opaque /history cursor pointing after the given record."""
+    return base64.urlsafe_b64encode(json.dumps([timestamp, record_id]).encode()).decode()
+
+
+def _decode_history_cursor(cursor: str) -> Tuple[str, int]:
+    try:
+        timestamp, record_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(timestamp), int(record_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def _query_history(conn: sqlite3.Connection, fields: Optional[List[str]], file_id: Optional[str],
+                   after: Optional[Tuple[str, int]], limit: int, offset: int) -> List[sqlite3.Row]:
+    """Select one page of history records, newest first (keyset pagination after the given key)."""
+    columns = "*"
+    if fields is not None:
+        available = {row["name"] for row in conn.execute("PRAGMA table_info(invoice_processes)")}
+        unknown = [field for field in fields if field not in available]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+        # id and timestamp are always returned, they form the pagination key
+        columns = ", ".join(["id", "timestamp"] + [f for f in fields if f not in ("id", "timestamp")])
+
+    query = f"SELECT {columns} FROM invoice_processes"
+    conditions = []
+    params: List[Any] = []
+    
+    if file_id:
+        conditions.append("file_id = ?")
+        params.append(file_id)
+    if after:
+        conditions.append("(timestamp, id) < (?, ?)")
+        params.extend(after)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+        
+    query += " ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?"
+    params.extend([limit, offset])
+    return conn.execute(query, params).fetchall()
+
+
+def _count_history(conn: sqlite3.Connection, file_id: Optional[str], count: str) -> Optional[int]:
+    """Total number of history records for the given filter."""
+    if count == "none":
+        return None
+    elif file_id:
+        # Served from the file_id index
+        query, params = "SELECT COUNT(*) FROM invoice_processes WHERE file_id = ?", [file_id]
+    elif count == "estimate":
+        # Each bare MIN/MAX subquery is answered by one seek to an end of the rowid b-tree (together in
+        # one SELECT they would scan it); an upper bound, deleted records are not subtracted
+        query, params = ("SELECT COALESCE((SELECT MAX(id) FROM invoice_processes)"
+                         " - (SELECT MIN(id) FROM invoice_processes) + 1, 0)"), []
+    else:
+        query, params = "SELECT COUNT(*) FROM invoice_processes", []
+    return conn.execute(query, params).fetchone()[0]
+
+
+# Columns holding JSON documents, returned as objects
+HISTORY_JSON_COLUMNS = ("response_json", "trace_json")
+
+
+def _history_row_to_ndjson(row: sqlite3.Row) -> str:
+    """Serialize a history record as one NDJSON line, passing the stored JSON columns through as is."""
+    item = dict(row)
+    documents = {column: item.pop(column) or "null" for column in HISTORY_JSON_COLUMNS if column in item}
+    line = json.dumps(item)
+    for column, document in documents.items():
+        line = f'{line[:-1]}, "{column}": {document}}}'
+    return line + "\n"
+
+
+HISTORY_STREAM_CHUNK = 200  # Records read from the database per chunk in NDJSON mode
+
+
 @app.get("/history")
-async def get_processing_history(limit: int = 50, offset: int = 0, file_id: Optional[str] = None):
+async def get_processing_history(limit: int = 50, offset: int = 0, file_id: Optional[str] = None,
+                                 cursor: Optional[str] = None, count: str = "exact",
+                                 fields: Optional[str] = None, output_format: str = Query("json", alias="format")):
     """
-    Retrieve processing history from the database
+    Retrieve processing history from the database, newest records first
     
     Parameters:
     - limit: Maximum number of records to return (default: 50)
     - offset: Offset for pagination (default: 0)
     - file_id: Optional filter by file ID
+    - cursor: Keyset pagination cursor, the `next_cursor` of the previous page. Use it instead of
+      offset: every page costs the same regardless of its depth
+    - count: How to compute `total`: "exact" (default), "estimate" (constant time) or "none"
+    - fields: Comma separated list of columns to return, e.g. `fields=file_id,token_count`
+      (`id` and `timestamp` are always included). Leave out `response_json` to skip the extracted data
+      and `trace_json` to skip the stage traces
+    - format: "json" (default) or "ndjson" to stream one record per line; the stored response JSON
+      is passed through without re-parsing and the total is sent in the `X-Total-Count` header
     """
+    if count not in ("exact", "estimate", "none"):
+        raise HTTPException(status_code=400, detail="count must be one of: exact, estimate, none")
+    if output_format not in ("json", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be one of: json, ndjson")
+    after = _decode_history_cursor(cursor) if cursor else None
+    field_list = [field.strip() for field in fields.split(",") if field.strip()] if fields is not None else None
+
+    if output_format == "ndjson":
+        return await _stream_history(limit, offset, file_id, after, count, field_list)
+
+    def query_history(conn: sqlite3.Connection):
+        rows = _query_history(conn, field_list, file_id, after, limit, offset)
+        return rows, _count_history(conn, file_id, count)
+
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row  # Return rows as dictionaries
-        cursor = conn.cursor()
-        
-        # Build query based on parameters
-        query = "SELECT * FROM invoice_processes"
-        params = []
-        
-        if file_id:
-            query += " WHERE file_id = ?"
-            params.append(file_id)
-            
-        query += " ORDER BY timestamp DESC LIMIT ? OFFSET ?"
-        params.extend([limit, offset])
-        
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        
-        # Count total records for pagination info
-        count_query = "SELECT COUNT(*) as count FROM invoice_processes"
-        if file_id:
-            count_query += " WHERE file_id = ?"
-            cursor.execute(count_query, [file_id])
-        else:
-            cursor.execute(count_query)
-            
-        total_count = cursor.fetchone()["count"]
+        rows, total_count = await db.run_read(query_history)
           # Convert rows to list of dicts
         results = []
         for row in rows:
             item = dict(row)            # Parse JSON strings back to objects
-            if item["response_json"]:
-                item["response_json"] = json.loads(item["response_json"])
+            for column in HISTORY_JSON_COLUMNS:
+                if item.get(column):
+                    item[column] = json.loads(item[column])
                 
             results.append(item)
-            
-        conn.close()
+
+        next_cursor = None
+        if len(rows) == limit and rows:
+            next_cursor = _encode_history_cursor(rows[-1]["timestamp"], rows[-1]["id"])
         
         return {
             "total": total_count,
             "offset": offset,
             "limit": limit,
+            "next_cursor": next_cursor,
             "results": results
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error retrieving history: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error retrieving processing history: {str(e)}")
 
 
+async def _stream_history(limit: int, offset: int, file_id: Optional[str], after: Optional[Tuple[str, int]],
+                          count: str, fields: Optional[List[str]]) -> StreamingResponse:
+    """Stream history records as NDJSON, reading them from the database in bounded chunks."""
+    def first_chunk(conn: sqlite3.Connection):
+        rows = _query_history(conn, fields, file_id, after, min(limit, HISTORY_STREAM_CHUNK), offset)
+        return rows, _count_history(conn, file_id, count)
+
+    try:
+        rows, total_count = await db.run_read(first_chunk)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error retrieving history: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error retrieving processing history: {str(e)}")
+
+    async def generate():
+        chunk = rows
+        remaining = limit
+        while chunk:
+            yield "".join(_history_row_to_ndjson(row) for row in chunk)
+            remaining -= len(chunk)
+            if remaining <= 0 or len(chunk) < HISTORY_STREAM_CHUNK:
+                break
+            last_key = (chunk[-1]["timestamp"], chunk[-1]["id"])
+            chunk = await db.run_read(
+                lambda conn: _query_history(conn, fields, file_id, last_key, min(remaining, HISTORY_STREAM_CHUNK), 0)
+            )
+
+    headers = {"X-Total-Count": str(total_count)} if total_count is not None else {}
+    return StreamingResponse(generate(), media_type="application/x-ndjson", headers=headers)
+
+
+@app.get("/history/{record_id}/trace")
+async def get_history_trace(record_id: int):
+    """Return the stage trace of a history record: stage timestamps and durations, page count, DPI, image bytes, text length and tokens"""
+    try:
+        row = await db.run_read(lambda conn: conn.execute(
+            "SELECT id, file_id, file_name, file_type, timestamp, model, trace_json FROM invoice_processes WHERE id = ?",
+            [record_id]
+        ).fetchone())
+    except Exception as e:
+        logger.error(f"Error retrieving trace: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error retrieving trace: {str(e)}")
+
+    if not row:
+        raise HTTPException(status_code=404, detail=f"Record with ID {record_id} not found")
+    if not row["trace_json"]:
+        raise HTTPException(status_code=404, detail=f"Record {record_id} has no trace")
+    item = dict(row)
+    item["trace"] = json.loads(item.pop("trace_json"))
+    return item
+
+
 @app.delete("/history/{record_id}")
 async def delete_history_record(record_id: int):
     """Delete a specific history record from the database"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Check if record exists
-        cursor.execute("SELECT id FROM invoice_processes WHERE id = ?", [record_id])
-        if not cursor.fetchone():
+        deleted = await db.run_write(
+            lambda conn: conn.execute("DELETE FROM invoice_processes WHERE id = ?", [record_id]).rowcount
+        )
+        if not deleted:
             raise HTTPException(status_code=404, detail=f"Record with ID {record_id} not found")
         
-        cursor.execute("DELETE FROM invoice_processes WHERE id = ?", [record_id])
-        conn.commit()
-        conn.close()
-        
         return {"message": f"Record {record_id} deleted successfully"}
         
     except HTTPException:
@@ -554,4 +1771,6 @@ async def delete_history_record(record_id: int):
         raise HTTPException(status_code=500, detail=f"Error deleting record: {str(e)}")
 
 if __name__ == "__main__":
+    import uvicorn
+
     uvicorn.run("main:app", host="0.0.0.0", port=8007, reload=True)
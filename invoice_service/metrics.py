@@ -0,0 +1,138 @@
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, FrozenSet, Iterable, Iterator, Optional, Tuple
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from tracing import current_trace
+
+
+logger = logging.getLogger("invoice_service")
+
+
+STAGE_UPLOAD_READ = "upload_read"
+STAGE_CONVERSION = "conversion"
+STAGE_RASTERIZATION = "rasterization"
+STAGE_IMAGE_PREPARATION = "image_preparation"
+STAGE_LLM_CALL = "llm_call"
+STAGE_DB_WRITE = "db_write"
+STAGE_CALLBACK_DELIVERY = "callback_delivery"
+# Errors only: a failed preprocessing or model call of an extraction
+STAGE_EXTRACTION = "extraction"
+
+# From quick local stages (milliseconds) to slow model calls (minutes)
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+STAGE_DURATION = Histogram(
+    "invoice_stage_duration_seconds",
+    "Duration of the stages of the extraction pipeline",
+    ["stage", "file_type", "model"],
+    buckets=STAGE_BUCKETS
+)
+TOKENS = Counter("invoice_tokens", "Gemini tokens used, by kind (input, output, thoughts, cached)", ["model", "kind"])
+CACHE_HITS = Counter("invoice_cache_hits", "Extractions answered without calling the model", ["cache"])
+ERRORS = Counter("invoice_errors", "Failures by stage and error type", ["stage", "file_type", "error"])
+QUEUE_DEPTH = Gauge("invoice_queue_depth", "Entries waiting in or being processed from a persistent queue", ["queue"])
+REQUESTS_IN_FLIGHT = Gauge("invoice_requests_in_flight", "HTTP requests being processed")
+LLM_CALLS_IN_FLIGHT = Gauge("invoice_llm_calls_in_flight", "Gemini calls waiting for a response", ["model"])
+
+# File type and model of the extraction running in the current task, inherited by its worker threads
+_labels: ContextVar[Tuple[str, str]] = ContextVar("metric_labels", default=("", ""))
+
+# Models recorded by name (None = any); the model names come from the clients, every other one is
+# recorded as "other" so they cannot add series without bound
+_model_labels: Optional[FrozenSet[str]] = None
+
+
+def limit_model_labels(models: Optional[Iterable[str]]):
+    """Record only these models by name in the model label, see model_label."""
+    global _model_labels
+    _model_labels = None if models is None else frozenset(models)
+
+
+def model_label(model: str) -> str:
+    if _model_labels is None or not model or model in _model_labels:
+        return model
+    return "other"
+
+
+def set_metric_labels(file_type: str, model: str):
+    """Label the metrics recorded by the current task (and the tasks and threads it starts)."""
+    _labels.set((file_type, model))
+
+
+@contextmanager
+def metric_labels(file_type: str, model: str) -> Iterator[None]:
+    """Label the metrics recorded inside the block, see set_metric_labels."""
+    token = _labels.set((file_type, model))
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+def _resolve(file_type: Optional[str], model: Optional[str]) -> Tuple[str, str]:
+    current_file_type, current_model = _labels.get()
+    return (current_file_type if file_type is None else file_type), (current_model if model is None else model)
+
+
+@contextmanager
+def observe_stage(stage: str, file_type: Optional[str] = None, model: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Record the duration of the block; labels not given are taken from the current metric labels.
+    The block is also added as a span to the current trace, with the attributes set on the yielded dict,
+    and logged with its stage and duration (levels per stage are set with LOG_STAGE_LEVELS).
+    """
+    labels = _resolve(file_type, model)
+    attributes: Dict[str, Any] = {}
+    start_ns = time.time_ns()
+    start = time.perf_counter()
+    try:
+        yield attributes
+    except BaseException as e:
+        attributes["error"] = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        STAGE_DURATION.labels(stage, labels[0], model_label(labels[1])).observe(duration)
+        trace = current_trace()
+        if trace is not None:
+            span_attributes = {"file_type": labels[0], "model": labels[1], **attributes}
+            trace.add_span(stage, start_ns, start_ns + int(duration * 1e9), span_attributes)
+        duration_ms = round(duration * 1000, 1)
+        extra = {"stage": stage, "duration_ms": duration_ms}
+        if labels[1]:
+            extra["model"] = labels[1]
+        if "error" in attributes:
+            logger.warning(f"Stage {stage} failed after {duration_ms} ms: {attributes['error']}", extra=extra)
+        else:
+            logger.info(f"Stage {stage} finished in {duration_ms} ms", extra=extra)
+
+
+def count_error(stage: str, error: str, file_type: Optional[str] = None):
+    ERRORS.labels(stage, _resolve(file_type, None)[0], error).inc()
+
+
+def count_tokens(model: str, input_tokens: Optional[int], output_tokens: Optional[int],
+                 thoughts_tokens: Optional[int], cached_tokens: Optional[int]):
+    for kind, count in (("input", input_tokens), ("output", output_tokens),
+                        ("thoughts", thoughts_tokens), ("cached", cached_tokens)):
+        if count:
+            TOKENS.labels(model_label(model), kind).inc(count)
+
+
+class InFlightMiddleware:
+    """ASGI middleware tracking the HTTP requests in progress (streamed responses until their last chunk)."""
+
+    def __init__(self, app, exclude_paths: Tuple[str, ...] = ()):
+        self.app = app
+        self.exclude_paths = exclude_paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.exclude_paths:
+            await self.app(scope, receive, send)
+            return
+        with REQUESTS_IN_FLIGHT.track_inprogress():
+            await self.app(scope, receive, send)
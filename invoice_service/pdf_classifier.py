@@ -0,0 +1,68 @@
+from typing import Any, Dict
+
+from rasterizers import pdfium_lock
+
+
+PDF_DIGITAL = "digital"
+PDF_SCANNED = "scanned"
+PDF_UNKNOWN = "unknown"
+
+POINTS_PER_INCH = 72
+
+
+def classify_pdf(content: bytes, max_pages: int = 5, min_char_density: float = 2.0,
+                 max_image_coverage: float = 0.5) -> Dict[str, Any]:
+    """
+    Classify a PDF as born-digital or scanned from its text layer (blocking, run in a worker thread).
+
+    A page is digital when it has at least `min_char_density` non-whitespace characters per square inch
+    and images cover less than `max_image_coverage` of its area (scans with an OCR layer are full-page
+    images). The PDF is digital only if all of its first `max_pages` pages are.
+    Returns the kind, the per-page measurements and the page count of the document; the kind is "unknown"
+    when pypdfium2 is not installed or the file cannot be parsed.
+    """
+    try:
+        import pypdfium2
+        import pypdfium2.raw as pdfium_c
+    except ImportError:
+        return {"kind": PDF_UNKNOWN, "pages": []}
+
+    pages = []
+    with pdfium_lock:
+        try:
+            pdf = pypdfium2.PdfDocument(content)
+        except pypdfium2.PdfiumError:
+            return {"kind": PDF_UNKNOWN, "pages": []}
+        try:
+            document_pages = len(pdf)
+            page_count = min(document_pages, max_pages) if max_pages else document_pages
+            for index in range(page_count):
+                page = pdf[index]
+                try:
+                    width, height = page.get_size()
+                    area = max(width * height, 1.0)
+                    textpage = page.get_textpage()
+                    try:
+                        chars = sum(1 for char in textpage.get_text_range() if not char.isspace())
+                    finally:
+                        textpage.close()
+                    image_area = 0.0
+                    for image in page.get_objects(filter=(pdfium_c.FPDF_PAGEOBJ_IMAGE,)):
+                        left, bottom, right, top = image.get_bounds()
+                        image_area += (right - left) * (top - bottom)
+                finally:
+                    page.close()
+
+                pages.append({
+                    "chars": chars,
+                    "char_density": round(chars / (area / POINTS_PER_INCH ** 2), 2),
+                    "image_coverage": round(min(image_area / area, 1.0), 2),
+                })
+        finally:
+            pdf.close()
+
+    digital = bool(pages) and all(
+        page["char_density"] >= min_char_density and page["image_coverage"] < max_image_coverage
+        for page in pages
+    )
+    return {"kind": PDF_DIGITAL if digital else PDF_SCANNED, "pages": pages, "page_count": document_pages}
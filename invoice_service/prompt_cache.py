@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Iterable, Optional
+
+
+logger = logging.getLogger("invoice_service")
+
+
+# Smallest content the Gemini API accepts as explicit cached content, in tokens (Pro models need more)
+MIN_CACHE_TOKENS = 1024
+MIN_CACHE_TOKENS_PRO = 4096
+
+
+def min_cache_tokens(model_name: str) -> int:
+    return MIN_CACHE_TOKENS_PRO if "pro" in model_name else MIN_CACHE_TOKENS
+
+
+class PromptCache:
+    """
+    Explicit Gemini context cache holding the static system instruction, one cached content per model.
+
+    The cached contents of the configured models are created on startup; a model first requested later,
+    an expiring TTL or a deleted cache are handled by a background task while requests send the prompt
+    inline, so the request path never waits for the caches API. The contents are deleted on shutdown.
+    A prompt below the model's minimum cacheable size (estimated at 4 characters per token, `min_tokens`
+    overrides the per-model minimum) is never cached; it is sent inline, where the stable prefix still
+    benefits from Gemini's implicit caching. A failed creation is not retried for `retry_after` seconds.
+    """
+
+    def __init__(self, system_instruction: str, ttl_seconds: int = 3600, refresh_margin: int = 300,
+                 retry_after: int = 600, display_name: str = "invoice-service-prompt", min_tokens: int = 0):
+        self.system_instruction = system_instruction
+        self.ttl_seconds = ttl_seconds
+        self.refresh_margin = min(refresh_margin, ttl_seconds // 2)
+        self.retry_after = retry_after
+        self.display_name = display_name
+        self.min_tokens = min_tokens
+        self.estimated_tokens = len(system_instruction) // 4
+
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._failed_until: Dict[str, float] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def cacheable(self, model_name: str) -> bool:
+        """Whether the prompt reaches the model's minimum size for explicit caching."""
+        return self.estimated_tokens >= (self.min_tokens or min_cache_tokens(model_name))
+
+    async def start(self, client, model_names: Iterable[str]):
+        """Create the cached contents of the given models before the first request."""
+        for model_name in dict.fromkeys(filter(None, model_names)):
+            if not self.cacheable(model_name):
+                logger.info(f"Prompt of ~{self.estimated_tokens} tokens is below the explicit cache minimum of model "
+                            f"{model_name}, sending it inline")
+                continue
+            await self._create(client, model_name)
+
+    def get(self, client, model_name: str) -> Optional[str]:
+        """
+        Return the name of the cached content for the model, or None to send the prompt inline.
+        Never calls the API: a missing or expiring cached content is renewed in the background.
+        """
+        if not self.cacheable(model_name):
+            return None
+        now = time.monotonic()
+        entry = self._entries.get(model_name)
+        if entry and entry["expires_at"] - now > self.refresh_margin:
+            return entry["name"]
+        if self._failed_until.get(model_name, 0) <= now:
+            task = self._tasks.get(model_name)
+            if task is None or task.done():
+                self._tasks[model_name] = asyncio.create_task(self._renew(client, model_name))
+        # An expiring cached content is still used until the renewal replaces it
+        return entry["name"] if entry and entry["expires_at"] > now else None
+
+    def invalidate(self, model_name: str, name: str):
+        """Forget a cached content the API no longer accepts; it is recreated on the next request."""
+        entry = self._entries.get(model_name)
+        if entry and entry["name"] == name:
+            del self._entries[model_name]
+
+    async def close(self, client):
+        """Stop the renewals and delete the cached contents created by this process."""
+        from google.genai import errors
+
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tasks = {}
+        for model_name, entry in list(self._entries.items()):
+            try:
+                await client.aio.caches.delete(name=entry["name"])
+            except errors.APIError as e:
+                logger.warning(f"Could not delete prompt cache {entry['name']}: {str(e)}")
+        self._entries = {}
+
+    async def _renew(self, client, model_name: str):
+        try:
+            entry = self._entries.get(model_name)
+            if entry and entry["expires_at"] > time.monotonic() and await self._refresh(client, entry["name"]):
+                entry["expires_at"] = time.monotonic() + self.ttl_seconds
+                return
+            await self._create(client, model_name)
+        except Exception as e:
+            # Nobody awaits the renewal, a transport error must not end up as an unretrieved task exception
+            logger.warning(f"Prompt cache for model {model_name} not renewed, sending the prompt inline: {str(e)}")
+            self._failed_until[model_name] = time.monotonic() + self.retry_after
+
+    async def _create(self, client, model_name: str) -> Optional[str]:
+        from google.genai import errors, types
+
+        try:
+            cache = await client.aio.caches.create(
+                model=model_name,
+                config=types.CreateCachedContentConfig(
+                    system_instruction=self.system_instruction,
+                    display_name=self.display_name,
+                    ttl=f"{self.ttl_seconds}s",
+                ),
+            )
+        except errors.APIError as e:
+            logger.warning(f"Prompt cache for model {model_name} not created, sending the prompt inline: {str(e)}")
+            self._failed_until[model_name] = time.monotonic() + self.retry_after
+            return None
+
+        self._entries[model_name] = {"name": cache.name, "expires_at": time.monotonic() + self.ttl_seconds}
+        logger.info(f"Created prompt cache {cache.name} for model {model_name} (TTL {self.ttl_seconds} s)")
+        return cache.name
+
+    async def _refresh(self, client, name: str) -> bool:
+        from google.genai import errors, types
+
+        try:
+            await client.aio.caches.update(name=name, config=types.UpdateCachedContentConfig(ttl=f"{self.ttl_seconds}s"))
+        except errors.APIError as e:
+            logger.warning(f"Prompt cache {name} could not be refreshed: {str(e)}")
+            return False
+        return True
@@ -0,0 +1,98 @@
+import threading
+from typing import Dict, List, Type, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+
+class Rasterizer:
+    """
+    Renders the first pages of a PDF to images.
+
+    Backends are selected by name with `get_rasterizer` (PDF_RASTERIZER setting); `render` is
+    blocking and is called from a worker thread.
+    """
+
+    name = ""
+
+    def __init__(self, dpi: int = 150, grayscale: bool = True, thread_count: int = 1, jpeg_quality: int = 85):
+        self.dpi = dpi
+        self.grayscale = grayscale
+        self.thread_count = max(1, thread_count)
+        self.jpeg_quality = jpeg_quality
+
+    def render(self, content: bytes, max_pages: int) -> List["Image.Image"]:
+        """Render pages 1..max_pages of the PDF (all pages when max_pages is 0)."""
+        raise NotImplementedError
+
+
+class PopplerRasterizer(Rasterizer):
+    """Renders with poppler's pdftoppm through pdf2image (one subprocess per thread)."""
+
+    name = "poppler"
+
+    def render(self, content: bytes, max_pages: int) -> List["Image.Image"]:
+        from pdf2image import convert_from_bytes
+
+        return convert_from_bytes(
+            content,
+            dpi=self.dpi,
+            first_page=1,
+            last_page=max_pages or None,
+            grayscale=self.grayscale,
+            thread_count=self.thread_count,
+            fmt="jpeg",
+            jpegopt={"quality": self.jpeg_quality, "optimize": True},
+        )
+
+
+# PDFium is not thread-safe, all documents in the process have to be handled one at a time
+# (shared with the PDF classifier)
+pdfium_lock = threading.Lock()
+
+
+class PdfiumRasterizer(Rasterizer):
+    """Renders in-process with PDFium (pypdfium2), directly from the uploaded bytes."""
+
+    name = "pdfium"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        try:
+            import pypdfium2
+        except ImportError as e:
+            raise RuntimeError("The pdfium rasterizer requires the pypdfium2 package") from e
+        self._pdfium = pypdfium2
+
+    def render(self, content: bytes, max_pages: int) -> List["Image.Image"]:
+        scale = self.dpi / 72
+        with pdfium_lock:
+            pdf = self._pdfium.PdfDocument(content)
+            try:
+                page_count = min(len(pdf), max_pages) if max_pages else len(pdf)
+                images = []
+                for index in range(page_count):
+                    page = pdf[index]
+                    try:
+                        bitmap = page.render(scale=scale, grayscale=self.grayscale)
+                        # to_pil copies the BGR(x) buffer into a new RGB image, so the bitmap can be freed
+                        image = bitmap.to_pil()
+                        images.append(image.convert("L") if self.grayscale else image)
+                    finally:
+                        page.close()
+                return images
+            finally:
+                pdf.close()
+
+
+RASTERIZERS: Dict[str, Type[Rasterizer]] = {
+    PopplerRasterizer.name: PopplerRasterizer,
+    PdfiumRasterizer.name: PdfiumRasterizer,
+}
+
+
+def get_rasterizer(name: str, **options) -> Rasterizer:
+    """Create the rasterizer backend with the given name."""
+    if name not in RASTERIZERS:
+        raise ValueError(f"Unknown PDF rasterizer: {name} (available: {', '.join(RASTERIZERS)})")
+    return RASTERIZERS[name](**options)
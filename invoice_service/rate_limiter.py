@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import random
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, TypeVar
+
+
+logger = logging.getLogger("invoice_service")
+
+T = TypeVar("T")
+
+# HTTP status codes of Gemini responses meaning "too many requests now", worth waiting for
+OVERLOAD_STATUS_CODES = (429, 503)
+
+
+def is_overload_error(error: BaseException) -> bool:
+    """Whether an API error is a quota (429) or overload (503) response."""
+    return getattr(error, "code", None) in OVERLOAD_STATUS_CODES
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """
+    The delay the API asked for before retrying: the google.rpc.RetryInfo `retryDelay` of the
+    error details or the Retry-After header. None when the response carries no hint.
+    """
+    details = getattr(error, "details", None)
+    if isinstance(details, dict):
+        for detail in (details.get("error") or {}).get("details") or []:
+            delay = detail.get("retryDelay") if isinstance(detail, dict) else None
+            match = re.fullmatch(r"(\d+(?:\.\d+)?)s", str(delay or ""))
+            if match:
+                return float(match.group(1))
+
+    response = getattr(error, "response", None)
+    header = getattr(response, "headers", {}).get("retry-after") if response is not None else None
+    try:
+        return float(header) if header else None
+    except ValueError:
+        return None  # An HTTP date, not used by the Gemini API
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at `per_minute` tokens per minute, holding at most one minute's worth.
+    Waiters are served in order; `debit` corrects an estimate after the fact and `pause` blocks
+    the bucket while the API asked to back off.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount: float = 1):
+        """Wait until `amount` tokens (at most the capacity) are available and take them."""
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                wait = self._blocked_until - time.monotonic()
+                if wait <= 0:
+                    if self.tokens >= amount:
+                        self.tokens -= amount
+                        return
+                    wait = (amount - self.tokens) / self.rate
+                await asyncio.sleep(wait)
+
+    def debit(self, amount: float):
+        """Take (or give back, when negative) tokens without waiting, e.g. actual minus estimated usage."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+    def pause(self, seconds: float):
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class AdaptiveConcurrency:
+    """
+    Concurrency limit adjusted AIMD-style: every successful call raises the limit by 1/limit (about +1
+    per limit's worth of calls), an overload response halves it, at most once per `cooldown` seconds
+    so one burst of 429s counts as a single congestion signal.
+    """
+
+    def __init__(self, maximum: int, minimum: int = 1, decrease_factor: float = 0.5, cooldown: float = 5.0):
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.limit = float(self.maximum)
+        self.active = 0
+        self._last_decrease = float("-inf")
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.active < int(self.limit))
+            self.active += 1
+
+    async def release(self):
+        async with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    def on_success(self):
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def on_overload(self):
+        now = time.monotonic()
+        if now - self._last_decrease >= self.cooldown:
+            self.limit = max(self.minimum, self.limit * self.decrease_factor)
+            self._last_decrease = now
+            logger.warning(f"Concurrency limit lowered to {int(self.limit)} after an overload response")
+
+
+class Slot:
+    """A granted model call. Set `used_tokens` to the actual usage to correct the token estimate."""
+
+    def __init__(self, estimated_tokens: int):
+        self.estimated_tokens = estimated_tokens
+        self.used_tokens: Optional[int] = None
+
+
+class ModelLimiter:
+    """Request and token buckets (0 = unlimited) and the adaptive concurrency limit of one model."""
+
+    def __init__(self, rpm: float = 0, tpm: float = 0, max_concurrency: int = 16, min_concurrency: int = 1):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.concurrency = AdaptiveConcurrency(max_concurrency, min_concurrency)
+
+    @asynccontextmanager
+    async def slot(self, estimated_tokens: int) -> AsyncIterator[Slot]:
+        """Wait for a concurrency slot and the request and token budget, then run the call."""
+        slot = Slot(estimated_tokens)
+        await self.concurrency.acquire()
+        try:
+            if self.requests:
+                await self.requests.acquire(1)
+            if self.tokens:
+                await self.tokens.acquire(estimated_tokens)
+            try:
+                yield slot
+            except BaseException as e:
+                if is_overload_error(e):
+                    self.concurrency.on_overload()
+                    self.pause(retry_after_seconds(e) or 0)
+                raise
+            self.concurrency.on_success()
+            if self.tokens and slot.used_tokens is not None:
+                self.tokens.debit(slot.used_tokens - estimated_tokens)
+        finally:
+            await self.concurrency.release()
+
+    def pause(self, seconds: float):
+        """Hold back all new calls of the model for the given time."""
+        for bucket in (self.requests, self.tokens):
+            if bucket and seconds > 0:
+                bucket.pause(seconds)
+
+
+class RateLimiter:
+    """
+    Per-model client-side rate limiting for the Gemini calls. Each model gets request (RPM) and
+    token (TPM) buckets and an adaptive concurrency limit; calls wait for budget instead of failing,
+    and quota/overload errors are retried after the delay the API asked for (or exponential backoff).
+    `limits` maps model names to {"rpm", "tpm", "max_concurrency"} overriding the defaults.
+    """
+
+    def __init__(self, rpm: float = 0, tpm: float = 0, max_concurrency: int = 16,
+                 limits: Optional[Dict[str, Dict[str, Any]]] = None, max_retries: int = 5,
+                 base_delay: float = 1.0, max_delay: float = 60.0):
+        self.defaults = {"rpm": rpm, "tpm": tpm, "max_concurrency": max_concurrency}
+        self.limits = limits or {}
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._models: Dict[str, ModelLimiter] = {}
+
+    def for_model(self, model_name: str) -> ModelLimiter:
+        limiter = self._models.get(model_name)
+        if limiter is None:
+            config = {**self.defaults, **self.limits.get(model_name, {})}
+            limiter = self._models[model_name] = ModelLimiter(
+                rpm=config["rpm"], tpm=config["tpm"], max_concurrency=config["max_concurrency"]
+            )
+        return limiter
+
+    def slot(self, model_name: str, estimated_tokens: int):
+        """Context manager granting one call of the model (no retries)."""
+        return self.for_model(model_name).slot(estimated_tokens)
+
+    async def run(self, model_name: str, estimated_tokens: int, fn: Callable[[], Awaitable[T]],
+                  used_tokens: Optional[Callable[[T], Optional[int]]] = None) -> T:
+        """Call fn() within the model's limits, retrying quota and overload errors."""
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self.slot(model_name, estimated_tokens) as slot:
+                    result = await fn()
+                    if used_tokens:
+                        slot.used_tokens = used_tokens(result)
+                    return result
+            except Exception as e:
+                if not is_overload_error(e) or attempt == self.max_retries:
+                    raise
+                delay = retry_after_seconds(e)
+                if delay is None:
+                    delay = min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1)
+                logger.warning(f"Model {model_name} returned {e.code}, retry {attempt + 1} of {self.max_retries} "
+                               f"in {delay:.1f} s")
+                await asyncio.sleep(delay)
@@ -0,0 +1,87 @@
+import hashlib
+import json
+import sqlite3
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from database import Database
+
+
+def setup_cache_table(cursor: sqlite3.Cursor):
+    """Create the extraction result cache table."""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS result_cache (
+        cache_key TEXT PRIMARY KEY,
+        model TEXT NOT NULL,
+        result_json TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        last_hit_at TEXT NOT NULL,
+        hit_count INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_result_cache_last_hit ON result_cache (last_hit_at)")
+
+
+def fingerprint(*parts: str) -> str:
+    """Return a short stable hash of the given text parts (used for prompt, schema and settings versions)."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+
+def make_cache_key(content_sha256: str, model_name: str, prompt_version: str, schema_version: str,
+                   settings_version: str) -> str:
+    """Build the cache key from the uploaded bytes hash, the model and the prompt/schema/settings versions."""
+    return f"{content_sha256}:{model_name}:{prompt_version}:{schema_version}:{settings_version}"
+
+
+async def get_cached_result(db: Database, cache_key: str, ttl_seconds: int) -> Optional[Dict[str, Any]]:
+    """Return the cached extraction result, or None when missing or expired."""
+    row = await db.run_read(
+        lambda conn: conn.execute(
+            "SELECT result_json, created_at FROM result_cache WHERE cache_key = ?", [cache_key]
+        ).fetchone()
+    )
+    if not row:
+        return None
+
+    now = datetime.now()
+    if ttl_seconds and datetime.fromisoformat(row["created_at"]) < now - timedelta(seconds=ttl_seconds):
+        db.write_nowait(lambda conn: conn.execute("DELETE FROM result_cache WHERE cache_key = ?", [cache_key]))
+        return None
+
+    # Hit statistics are not worth waiting for
+    db.write_nowait(lambda conn: conn.execute(
+        "UPDATE result_cache SET last_hit_at = ?, hit_count = hit_count + 1 WHERE cache_key = ?",
+        [now.isoformat(), cache_key]
+    ))
+    return json.loads(row["result_json"])
+
+
+async def store_cached_result(db: Database, cache_key: str, model_name: str, result: Dict[str, Any],
+                              max_entries: int, ttl_seconds: int):
+    """Store an extraction result and evict expired and least recently used entries."""
+    result_json = json.dumps(result)
+
+    def store(conn: sqlite3.Connection):
+        cursor = conn.cursor()
+        now = datetime.now()
+        cursor.execute('''
+        INSERT OR REPLACE INTO result_cache (cache_key, model, result_json, created_at, last_hit_at, hit_count)
+        VALUES (?, ?, ?, ?, ?, 0)
+        ''', (cache_key, model_name, result_json, now.isoformat(), now.isoformat()))
+
+        if ttl_seconds:
+            cursor.execute(
+                "DELETE FROM result_cache WHERE created_at < ?",
+                [(now - timedelta(seconds=ttl_seconds)).isoformat()]
+            )
+        cursor.execute('''
+        DELETE FROM result_cache WHERE cache_key IN (
+            SELECT cache_key FROM result_cache ORDER BY last_hit_at DESC LIMIT -1 OFFSET ?
+        )
+        ''', [max_entries])
+
+    await db.run_write(store)
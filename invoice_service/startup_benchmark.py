@@ -0,0 +1,110 @@
+"""
+Cold start benchmark for the invoice service.
+
+Imports `main` in fresh interpreters with `python -X importtime` from an empty working directory and reports
+the import time, the slowest modules and whether the import loaded any of the lazily imported libraries or
+created files. Exits with status 1 when a check fails or the median import time exceeds --max-ms.
+
+    python startup_benchmark.py --runs 5 --top 15 --max-ms 1000
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+
+SERVICE_DIR = Path(__file__).resolve().parent
+
+# Libraries that must only be imported when a request (or the startup) needs them
+LAZY_MODULES = (
+    "google.genai",
+    "PIL.Image",
+    "markitdown",
+    "pdf2image",
+    "pypdfium2",
+    "httpx",
+    "uvicorn",
+)
+
+
+def _run_python(code: str, cwd: str, *flags: str) -> subprocess.CompletedProcess:
+    env = dict(os.environ, PYTHONPATH=str(SERVICE_DIR), PYTHONDONTWRITEBYTECODE="1")
+    return subprocess.run(
+        [sys.executable, *flags, "-c", code],
+        cwd=cwd, env=env, capture_output=True, text=True, check=True
+    )
+
+
+def parse_importtime(stderr: str) -> Dict[str, Tuple[int, int]]:
+    """Parse `-X importtime` output into {module: (self_us, cumulative_us)}."""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def measure_import(runs: int = 5) -> List[Dict[str, Tuple[int, int]]]:
+    """Import main `runs` times in fresh interpreters and return the parsed import times."""
+    results = []
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as cwd:
+            results.append(parse_importtime(_run_python("import main", cwd, "-X", "importtime").stderr))
+    return results
+
+
+def check_import() -> Dict[str, List[str]]:
+    """Import main once and return the lazy modules it loaded and the files it created."""
+    code = (
+        "import json, sys, main; "
+        f"print(json.dumps([m for m in {list(LAZY_MODULES)!r} if m in sys.modules]))"
+    )
+    with tempfile.TemporaryDirectory() as cwd:
+        loaded = json.loads(_run_python(code, cwd).stdout.strip().splitlines()[-1])
+        created = sorted(str(path.relative_to(cwd)) for path in Path(cwd).rglob("*"))
+    return {"eager_modules": loaded, "created_files": created}
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="Number of cold imports to measure")
+    parser.add_argument("--top", type=int, default=15, help="Number of slowest modules to list")
+    parser.add_argument("--max-ms", type=float, default=0, help="Fail when the median import time is higher")
+    args = parser.parse_args()
+
+    runs = measure_import(args.runs)
+    totals_ms = [run["main"][1] / 1000 for run in runs]
+    median_ms = statistics.median(totals_ms)
+    print(f"import main: median {median_ms:.0f} ms, min {min(totals_ms):.0f} ms, max {max(totals_ms):.0f} ms "
+          f"({args.runs} runs)")
+
+    fastest = runs[totals_ms.index(min(totals_ms))]
+    print(f"\nSlowest modules (self time, fastest run):")
+    for name, (self_us, cumulative_us) in sorted(fastest.items(), key=lambda item: -item[1][0])[:args.top]:
+        print(f"  {self_us / 1000:8.1f} ms  {cumulative_us / 1000:8.1f} ms cumulative  {name}")
+
+    checks = check_import()
+    failed = False
+    if checks["eager_modules"]:
+        print(f"\nFAIL: imported at module load: {', '.join(checks['eager_modules'])}")
+        failed = True
+    if checks["created_files"]:
+        print(f"\nFAIL: files created at module load: {', '.join(checks['created_files'])}")
+        failed = True
+    if args.max_ms and median_ms > args.max_ms:
+        print(f"\nFAIL: median import time {median_ms:.0f} ms exceeds {args.max_ms:.0f} ms")
+        failed = True
+    if not failed:
+        print("\nOK: no eager heavy imports, no side effects")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
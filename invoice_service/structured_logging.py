@@ -0,0 +1,131 @@
+import copy
+import json
+import logging
+import queue
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+
+# Structured fields of a log record, taken from the record's `extra` or from the current log context
+CONTEXT_FIELDS = ("request_id", "file_id", "model", "stage", "duration_ms")
+
+# Fields of the request being processed in the current task, inherited by its worker threads
+_context: ContextVar[Dict[str, Any]] = ContextVar("log_context", default={})
+
+
+def set_log_context(**fields: Any):
+    """Add fields to the log records of the current task (and the tasks and threads it starts)."""
+    _context.set({**_context.get(), **fields})
+
+
+@contextmanager
+def log_context(**fields: Any) -> Iterator[None]:
+    """Add fields to the log records emitted inside the block, see set_log_context."""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def parse_level(level: Union[str, int]) -> int:
+    value = level if isinstance(level, int) else logging.getLevelName(str(level).upper())
+    if not isinstance(value, int):
+        raise ValueError(f"Unknown log level: {level}")
+    return value
+
+
+class ContextFilter(logging.Filter):
+    """Copy the log context into the record; runs in the emitting thread, before the record is queued."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for field, value in _context.get().items():
+            if not hasattr(record, field):
+                setattr(record, field, value)
+        return True
+
+
+class StageLevelFilter(logging.Filter):
+    """Drop records below the level configured for their stage (records without a stage use the default)."""
+
+    def __init__(self, default_level: int, stage_levels: Dict[str, int]):
+        super().__init__()
+        self.default_level = default_level
+        self.stage_levels = stage_levels
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= self.stage_levels.get(getattr(record, "stage", None), self.default_level)
+
+
+_traceback_formatter = logging.Formatter()
+
+
+class StructuredQueueHandler(QueueHandler):
+    """Queue handler keeping the traceback apart from the message (in exc_text) for the formatters."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        exception = _traceback_formatter.formatException(record.exc_info) if record.exc_info else record.exc_text
+        record = copy.copy(record)
+        # Merge the arguments in the emitting thread, they may change before the listener formats the record
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        record.exc_text = exception
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: timestamp, level, logger, message and the structured fields that are set."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "timestamp": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def start_queue_logging(logger: logging.Logger, handlers: List[logging.Handler], level: Union[str, int] = "INFO",
+                        stage_levels: Optional[Dict[str, Union[str, int]]] = None) -> QueueListener:
+    """
+    Route the logger's records through an in-memory queue to the given handlers, which are run by a
+    listener thread, so a slow disk or log rotation never blocks the event loop. `stage_levels` sets
+    the minimum level per pipeline stage, e.g. {"llm_call": "DEBUG", "upload_read": "WARNING"}.
+    """
+    default_level = parse_level(level)
+    levels = {stage: parse_level(stage_level) for stage, stage_level in (stage_levels or {}).items()}
+
+    queue_handler = StructuredQueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.addFilter(StageLevelFilter(default_level, levels))
+    logger.addHandler(queue_handler)
+    # The logger lets the lowest configured level through, the stage filter does the rest
+    logger.setLevel(min([default_level, *levels.values()]))
+
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def stop_queue_logging(logger: logging.Logger, listener: QueueListener):
+    """Write the queued records and detach the queue handler."""
+    listener.stop()
+    for handler in list(logger.handlers):
+        if isinstance(handler, QueueHandler):
+            logger.removeHandler(handler)
+    for handler in listener.handlers:
+        handler.close()
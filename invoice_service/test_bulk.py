@@ -0,0 +1,151 @@
+import os
+import json
+import asyncio
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from database import Database
+from bulk import BatchTransport, BulkJobs, parse_result_line, BULK_DONE, BULK_FAILED
+from main import setup_database, build_request, _save_result, SYSTEM_INSTRUCTION
+
+
+ADDRESS = {"street": "", "city": "", "postalcode": "", "state": "", "country": ""}
+COMPANY = {"company_name": "", "address": ADDRESS, "identification_number": "", "tax_number": "", "phone": "", "email": ""}
+INVOICE = {
+    "type": "received",
+    "external_invoice_number": "2505001",
+    "issue_date": "2025-05-01",
+    "payment_method": "bank_transfer",
+    "banking_info": {"account_number": "", "bank_code": ""},
+    "own_company_info": {"name": "Deymed", **COMPANY},
+    "counterparty_info": COMPANY,
+    "currency_id": "CZK",
+    "lines": [],
+}
+
+
+class FakeBatchTransport(BatchTransport):
+    """Local stand-in for the batch service: answers every request with the same invoice."""
+
+    def __init__(self, final_state="JOB_STATE_SUCCEEDED"):
+        self.final_state = final_state
+        self.requests = []
+        self.polls = 0
+
+    async def submit(self, model_name, requests_path, display_name):
+        with open(requests_path) as f:
+            self.requests = [json.loads(line) for line in f]
+        return "batches/fake-1"
+
+    async def get_state(self, job_name):
+        self.polls += 1
+        return ("JOB_STATE_RUNNING", None) if self.polls < 2 else (self.final_state, None)
+
+    async def download_results(self, job_name):
+        lines = [{
+            "key": request["key"],
+            "response": {
+                "candidates": [{"content": {"parts": [{"text": json.dumps(INVOICE)}], "role": "model"}}],
+                "usageMetadata": {"promptTokenCount": 80, "candidatesTokenCount": 20, "totalTokenCount": 100},
+            },
+        } for request in self.requests]
+        return "\n".join(json.dumps(line) for line in lines).encode()
+
+
+class TestBulkJobs(unittest.TestCase):
+    """Test cases for the offline bulk mode."""
+
+    image_path = Path("test/data/faktura.png")
+
+    def setUp(self):
+        """Set up a temporary database and a directory with the files to import."""
+        self.temp_db = tempfile.mktemp(suffix='.db')
+        self.db_path_patcher = patch('main.DB_PATH', Path(self.temp_db))
+        self.db_path_patcher.start()
+        setup_database()
+        self.db = Database(Path(self.temp_db))
+        self.db.start()
+        self.db_patcher = patch('main.db', self.db)
+        self.db_patcher.start()
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        """Remove the temporary database and files."""
+        self.db_patcher.stop()
+        self.db.stop()
+        self.db_path_patcher.stop()
+        self.temp_dir.cleanup()
+        if os.path.exists(self.temp_db):
+            os.remove(self.temp_db)
+
+    def _bulk_jobs(self, transport):
+        return BulkJobs(self.db, transport, build_request, _save_result, SYSTEM_INSTRUCTION, poll_interval=0)
+
+    def _files(self):
+        if not self.image_path.exists():
+            self.skipTest(f"Test image file not found: {self.image_path}")
+        broken = Path(self.temp_dir.name) / "broken.png"
+        broken.write_bytes(b"not an image")
+        return [(self.image_path, "id-1", "image"), (broken, "id-2", "image")]
+
+    def _records(self):
+        with sqlite3.connect(self.temp_db) as conn:
+            conn.row_factory = sqlite3.Row
+            return {row["file_id"]: dict(row) for row in conn.execute("SELECT * FROM invoice_processes")}
+
+    def test_bulk_job_stores_results(self):
+        """Test that files are preprocessed into one request file and the results are stored."""
+        transport = FakeBatchTransport()
+        bulk_jobs = self._bulk_jobs(transport)
+
+        async def run():
+            job_id = await bulk_jobs.submit("test-model", self._files())
+            return await bulk_jobs.wait(job_id)
+
+        job = asyncio.run(run())
+
+        self.assertEqual(job["status"], BULK_DONE)
+        self.assertEqual(job["request_count"], 1)
+        self.assertEqual(job["items"], {"done": 1, "failed": 1})
+
+        # The request carries the preprocessed image, the system instruction and the response schema
+        request = transport.requests[0]["request"]
+        self.assertEqual(request["contents"][0]["parts"][0]["inlineData"]["mimeType"], "image/jpeg")
+        self.assertEqual(request["systemInstruction"]["parts"][0]["text"], SYSTEM_INSTRUCTION)
+        self.assertEqual(request["generationConfig"]["responseSchema"]["type"], "OBJECT")
+
+        records = self._records()
+        self.assertEqual(records["id-1"]["token_count"], 100)
+        self.assertIsNotNone(records["id-1"]["image_bytes"])
+        response = json.loads(records["id-1"]["response_json"])
+        self.assertEqual(response["invoice"]["external_invoice_number"], "2505001")
+        self.assertEqual(response["bulk_job_id"], job["id"])
+        # The file failing preprocessing is recorded as an error and left out of the batch
+        self.assertIsNotNone(records["id-2"]["error_message"])
+
+    def test_failed_batch_job(self):
+        """Test that the files of an expired batch job are marked as failed."""
+        bulk_jobs = self._bulk_jobs(FakeBatchTransport("JOB_STATE_EXPIRED"))
+
+        async def run():
+            job_id = await bulk_jobs.submit("test-model", self._files()[:1])
+            return await bulk_jobs.wait(job_id)
+
+        job = asyncio.run(run())
+
+        self.assertEqual(job["status"], BULK_FAILED)
+        self.assertEqual(job["items"], {"failed": 1})
+        self.assertNotIn("id-1", self._records())
+
+    def test_parse_error_line(self):
+        """Test that a failed request in the result file is turned into an error message."""
+        result, error = parse_result_line({"key": "1", "error": {"code": 400, "message": "Bad image"}}, "test-model")
+        self.assertIsNone(result)
+        self.assertEqual(error, "Bad image")
+
+
+if __name__ == "__main__":
+    unittest.main()
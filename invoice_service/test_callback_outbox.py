@@ -0,0 +1,110 @@
+import os
+import asyncio
+import tempfile
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+
+from database import Database
+from callback_outbox import CallbackOutbox, CALLBACK_DELIVERED, CALLBACK_FAILED
+
+
+class FakeHttpClient:
+    """Answers the posted callbacks with the given status codes (or raises the given exceptions)."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.posts = []
+
+    async def post(self, url, content=None, headers=None):
+        self.posts.append((url, content))
+        response = self.responses.pop(0) if self.responses else 200
+        if isinstance(response, Exception):
+            raise response
+        return SimpleNamespace(status_code=response)
+
+
+class TestCallbackOutbox(unittest.TestCase):
+    """Test cases for the persistent callback outbox."""
+
+    def setUp(self):
+        """Set up a temporary database."""
+        self.temp_db = tempfile.mktemp(suffix='.db')
+        self.db = Database(Path(self.temp_db))
+        self.db.start()
+
+    def tearDown(self):
+        """Remove the temporary database."""
+        self.db.stop()
+        if os.path.exists(self.temp_db):
+            os.remove(self.temp_db)
+
+    def _outbox(self, http_client, **kwargs):
+        return CallbackOutbox(self.db, http_client, base_delay=0.01, max_delay=0.05, poll_interval=0.02, **kwargs)
+
+    async def _wait_for(self, outbox, callback_id, status):
+        for _ in range(200):
+            callback = await outbox.get_callback(callback_id)
+            if callback["status"] == status:
+                return callback
+            await asyncio.sleep(0.02)
+        self.fail(f"Callback {callback_id} did not reach status {status}")
+
+    def test_retried_until_delivered(self):
+        """Test that server errors and connection failures are retried with backoff."""
+        http_client = FakeHttpClient(503, ConnectionError("Connection refused"), 200)
+
+        async def run():
+            outbox = self._outbox(http_client)
+            await outbox.start()
+            callback_id = await outbox.enqueue("http://erp/callback", {"file_id": "file-1"})
+            callback = await self._wait_for(outbox, callback_id, CALLBACK_DELIVERED)
+            await outbox.stop()
+            return callback
+
+        callback = asyncio.run(run())
+        self.assertEqual(callback["attempts"], 3)
+        self.assertEqual(http_client.posts, [("http://erp/callback", '{"file_id": "file-1"}')] * 3)
+
+    def test_failed_after_max_attempts(self):
+        """Test that a callback is given up after max_attempts and client errors are not retried."""
+        http_client = FakeHttpClient(500, 500, 500, 400)
+
+        async def run():
+            outbox = self._outbox(http_client, max_attempts=3)
+            await outbox.start()
+            retried_id = await outbox.enqueue("http://erp/callback", {"file_id": "file-1"})
+            retried = await self._wait_for(outbox, retried_id, CALLBACK_FAILED)
+            rejected_id = await outbox.enqueue("http://erp/callback", {"file_id": "file-2"})
+            rejected = await self._wait_for(outbox, rejected_id, CALLBACK_FAILED)
+            await outbox.stop()
+            return retried, rejected
+
+        retried, rejected = asyncio.run(run())
+        self.assertEqual((retried["attempts"], retried["last_error"]), (3, "HTTP 500"))
+        self.assertEqual((rejected["attempts"], rejected["last_error"]), (1, "HTTP 400"))
+
+    def test_interrupted_delivery_is_recovered(self):
+        """Test that callbacks claimed by a crashed process are delivered after a restart."""
+        now = "2025-01-01T00:00:00"
+
+        async def run():
+            crashed = self._outbox(FakeHttpClient())
+            await crashed.start()
+            await crashed.stop()
+            callback_id = await self.db.run_write(lambda conn: conn.execute(
+                "INSERT INTO callback_outbox (url, payload, status, attempts, next_attempt_at, created_at, updated_at) "
+                "VALUES (?, ?, 'delivering', 1, ?, ?, ?)", ["http://erp/callback", "{}", now, now, now]
+            ).lastrowid)
+
+            outbox = self._outbox(FakeHttpClient())
+            await outbox.start()
+            callback = await self._wait_for(outbox, callback_id, CALLBACK_DELIVERED)
+            await outbox.stop()
+            return callback
+
+        self.assertEqual(asyncio.run(run())["attempts"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
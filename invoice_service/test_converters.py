@@ -0,0 +1,37 @@
+import io
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from converters import DocumentConverter, _sample_pdf, _sample_docx
+
+
+DOCX_MIME_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+
+class TestDocumentConverter(unittest.TestCase):
+    """Test cases for the shared document converter."""
+
+    def test_warm_up_creates_the_converter_once(self):
+        """Test that the warm-up creates the MarkItDown instance reused by later conversions."""
+        converter = DocumentConverter()
+        converter.warm_up()
+        markitdown = converter._markitdown
+        self.assertIsNotNone(markitdown)
+
+        self.assertIn("Invoice", converter.convert(io.BytesIO(_sample_docx()), DOCX_MIME_TYPE))
+        self.assertIs(converter._markitdown, markitdown)
+
+    def test_concurrent_conversions(self):
+        """Test that one converter instance serves conversions from several threads."""
+        converter = DocumentConverter()
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            texts = list(executor.map(
+                lambda i: converter.convert(io.BytesIO(_sample_pdf(f"Invoice {i}")), "application/pdf"),
+                range(8)
+            ))
+
+        self.assertEqual([text.strip() for text in texts], [f"Invoice {i}" for i in range(8)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,5 @@
 import os
+import asyncio
 import unittest
 import sqlite3
 import json
@@ -10,7 +11,8 @@ from pathlib import Path
 from fastapi.testclient import TestClient
 
 # Import from the correct location
-from invoice_service.main import app, setup_database, save_to_database, DB_PATH
+from invoice_service.main import app, setup_database, save_to_database, DB_PATH, _count_history
+from database import Database
 
 
 class TestDatabaseFunctionality(unittest.TestCase):
@@ -27,6 +29,10 @@ class TestDatabaseFunctionality(unittest.TestCase):
         
         # Initialize the test database
         setup_database()
+        self.db = Database(Path(self.temp_db))
+        self.db.start()
+        self.db_patcher = patch('invoice_service.main.db', self.db)
+        self.db_patcher.start()
         
         # Mock the Gemini client for testing
         self.gemini_patcher = patch('invoice_service.main.client')
@@ -67,6 +73,8 @@ class TestDatabaseFunctionality(unittest.TestCase):
     def tearDown(self):
         """Clean up after tests."""
         self.gemini_patcher.stop()
+        self.db_patcher.stop()
+        self.db.stop()
         self.db_path_patcher.stop()
         
         # Remove the temporary database
@@ -80,18 +88,17 @@ class TestDatabaseFunctionality(unittest.TestCase):
         file_name = "test-invoice.pdf"
         file_type = "pdf"
         token_count = 100
-        request_data = {"filename": file_name, "file_id": file_id}
         response_data = {"invoice": {"customer": "DEYMED"}, "token_count": token_count}
         
         # Call the function
-        save_to_database(
+        asyncio.run(save_to_database(
             file_id=file_id,
+            model="test-model",
             file_name=file_name,
             file_type=file_type,
             token_count=token_count,
-            request_data=request_data,
             response_data=response_data
-        )
+        ))
         
         # Query the database to verify
         conn = sqlite3.connect(self.temp_db)
@@ -107,7 +114,6 @@ class TestDatabaseFunctionality(unittest.TestCase):
         self.assertEqual(row["file_name"], file_name)
         self.assertEqual(row["file_type"], file_type)
         self.assertEqual(row["token_count"], token_count)
-        self.assertEqual(json.loads(row["request_json"]), request_data)
         self.assertEqual(json.loads(row["response_json"]), response_data)
 
     def test_error_saving(self):
@@ -119,12 +125,13 @@ class TestDatabaseFunctionality(unittest.TestCase):
         error_message = "Unsupported file format"
         
         # Call the function
-        save_to_database(
+        asyncio.run(save_to_database(
             file_id=file_id,
+            model="test-model",
             file_name=file_name,
             file_type=file_type,
             error_message=error_message
-        )
+        ))
         
         # Query the database to verify
         conn = sqlite3.connect(self.temp_db)
@@ -141,21 +148,46 @@ class TestDatabaseFunctionality(unittest.TestCase):
         self.assertEqual(row["file_type"], file_type)
         self.assertEqual(row["error_message"], error_message)
         self.assertIsNone(row["token_count"])
-        self.assertIsNone(row["request_json"])
         self.assertIsNone(row["response_json"])
 
+    def test_concurrent_saves(self):
+        """Test that concurrent saves are all committed by the batched writer."""
+        async def save_all():
+            await asyncio.gather(*[
+                save_to_database(
+                    file_id=f"batch-file-{i}",
+                    model="test-model",
+                    file_name=f"invoice-{i}.pdf",
+                    file_type="pdf",
+                    token_count=i
+                )
+                for i in range(50)
+            ])
+
+        asyncio.run(save_all())
+
+        conn = sqlite3.connect(self.temp_db)
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM invoice_processes WHERE file_id LIKE 'batch-file-%'")
+        count = cursor.fetchone()[0]
+        cursor.execute("PRAGMA journal_mode")
+        journal_mode = cursor.fetchone()[0]
+        conn.close()
+        self.assertEqual(count, 50)
+        self.assertEqual(journal_mode, "wal")
+
     def test_history_endpoint(self):
         """Test the history endpoint."""
         # Add some test data
         for i in range(5):
-            save_to_database(
+            asyncio.run(save_to_database(
                 file_id=f"file-{i}",
+                model="test-model",
                 file_name=f"invoice-{i}.pdf",
                 file_type="pdf",
                 token_count=100 + i,
-                request_data={"file_id": f"file-{i}"},
                 response_data={"invoice": {"customer": "DEYMED"}}
-            )
+            ))
         
         # Test the endpoint
         response = self.client.get("/history")
@@ -177,17 +209,95 @@ class TestDatabaseFunctionality(unittest.TestCase):
         self.assertEqual(len(data["results"]), 1)
         self.assertEqual(data["results"][0]["file_id"], "file-3")
 
+    def test_history_cursor_pagination(self):
+        """Test keyset pagination of the history endpoint."""
+        for i in range(5):
+            asyncio.run(save_to_database(
+                file_id=f"file-{i}",
+                model="test-model",
+                file_name=f"invoice-{i}.pdf",
+                file_type="pdf"
+            ))
+
+        file_ids = []
+        cursor = None
+        for _ in range(3):
+            url = "/history?limit=2&count=none" + (f"&cursor={cursor}" if cursor else "")
+            data = self.client.get(url).json()
+            self.assertIsNone(data["total"])
+            file_ids.extend(item["file_id"] for item in data["results"])
+            cursor = data["next_cursor"]
+            if not cursor:
+                break
+
+        self.assertEqual(file_ids, [f"file-{i}" for i in reversed(range(5))])
+        self.assertIsNone(cursor)
+
+        # Estimated total and an invalid cursor
+        self.assertEqual(self.client.get("/history?count=estimate").json()["total"], 5)
+        self.assertEqual(self.client.get("/history?cursor=invalid").status_code, 400)
+
+    def test_history_estimated_count(self):
+        """Test that the estimated total is an upper bound computed without scanning the table."""
+        for i in range(5):
+            asyncio.run(save_to_database(file_id=f"file-{i}", model="test-model",
+                                         file_name=f"invoice-{i}.pdf", file_type="pdf"))
+        with sqlite3.connect(self.temp_db) as conn:
+            conn.execute("DELETE FROM invoice_processes WHERE file_id IN ('file-1', 'file-3')")
+
+        self.assertEqual(self.client.get("/history").json()["total"], 3)
+        self.assertGreaterEqual(self.client.get("/history?count=estimate").json()["total"], 3)
+
+        with sqlite3.connect(self.temp_db) as conn:
+            self.assertEqual(_count_history(conn, None, "estimate"), 5)
+            query_plans = []
+            conn.set_trace_callback(lambda statement: query_plans.append(statement))
+            _count_history(conn, None, "estimate")
+            conn.set_trace_callback(None)
+            plan = conn.execute("EXPLAIN QUERY PLAN " + query_plans[-1]).fetchall()
+        self.assertFalse([row for row in plan if row[-1].startswith("SCAN invoice_processes")], plan)
+
+    def test_history_ndjson_projection(self):
+        """Test NDJSON streaming and field projection of the history endpoint."""
+        response_data = {"invoice": {"external_invoice_number": "FV-1"}, "total_token_count": 100}
+        for i in range(3):
+            asyncio.run(save_to_database(
+                file_id=f"file-{i}",
+                model="test-model",
+                file_name=f"invoice-{i}.pdf",
+                file_type="pdf",
+                token_count=100,
+                response_data=response_data
+            ))
+
+        # Small chunks to exercise reading the records in several database queries
+        with patch('invoice_service.main.HISTORY_STREAM_CHUNK', 2):
+            response = self.client.get("/history?format=ndjson")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["x-total-count"], "3")
+        records = [json.loads(line) for line in response.text.splitlines()]
+        self.assertEqual([r["file_id"] for r in records], ["file-2", "file-1", "file-0"])
+        self.assertEqual(records[0]["response_json"], response_data)
+
+        response = self.client.get("/history?format=ndjson&fields=file_id,token_count&limit=2")
+        records = [json.loads(line) for line in response.text.splitlines()]
+        self.assertEqual(len(records), 2)
+        self.assertEqual(set(records[0]), {"id", "timestamp", "file_id", "token_count"})
+
+        response = self.client.get("/history?fields=file_id,unknown")
+        self.assertEqual(response.status_code, 400)
+
     def test_delete_endpoint(self):
         """Test the delete endpoint."""
         # Add test data
-        save_to_database(
+        asyncio.run(save_to_database(
             file_id="file-to-delete",
+            model="test-model",
             file_name="delete-me.pdf",
             file_type="pdf",
             token_count=100,
-            request_data={"file_id": "file-to-delete"},
             response_data={"invoice": {"customer": "DEYMED"}}
-        )
+        ))
         
         # Get the ID of the added record
         conn = sqlite3.connect(self.temp_db)
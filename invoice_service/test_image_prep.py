@@ -0,0 +1,57 @@
+import io
+import unittest
+
+from PIL import Image
+
+from image_prep import estimate_image_tokens, fit_size, is_grayscale, open_image, prepare_image
+
+
+class TestImagePrep(unittest.TestCase):
+    """Test cases for the image preprocessing before sending images to the model."""
+
+    def test_estimate_image_tokens(self):
+        """Test the tile based token estimate."""
+        self.assertEqual(estimate_image_tokens(300, 200), 258)
+        self.assertEqual(estimate_image_tokens(1086, 1536), 4 * 258)
+
+    def test_fit_size(self):
+        """Test that images are scaled to the long edge and token budgets."""
+        self.assertEqual(fit_size(4000, 3000, 1536), (1536, 1152))
+        self.assertEqual(fit_size(800, 600, 1536), (800, 600))
+        width, height = fit_size(4000, 3000, 1536, max_tokens=2 * 258)
+        self.assertLessEqual(estimate_image_tokens(width, height), 2 * 258)
+
+    def test_grayscale_detection(self):
+        """Test that only colorless images are converted to grayscale in the auto mode."""
+        scan = Image.new("RGB", (200, 200), "white")
+        scan.paste((40, 40, 40), (20, 20, 180, 60))
+        stamp = scan.copy()
+        stamp.paste((20, 60, 200), (100, 100, 180, 180))
+        self.assertTrue(is_grayscale(scan))
+        self.assertFalse(is_grayscale(stamp))
+
+        _, _, params = prepare_image(stamp, grayscale="auto")
+        self.assertEqual(params["mode"], "RGB")
+        _, _, params = prepare_image(scan, grayscale="auto")
+        self.assertEqual(params["mode"], "L")
+
+    def test_photo_is_oriented_downscaled_and_recompressed(self):
+        """Test EXIF orientation, draft decoding and re-encoding of a large JPEG photo."""
+        photo = Image.new("RGB", (4000, 3000), (200, 120, 40))
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Rotated 90 degrees
+        buffer = io.BytesIO()
+        photo.save(buffer, "JPEG", exif=exif)
+
+        image = open_image(buffer, max_long_edge=1536)
+        self.assertLess(image.width, 4000)  # Decoded at a reduced scale
+
+        data, mime_type, params = prepare_image(image, max_long_edge=1536, image_format="webp")
+        self.assertEqual(mime_type, "image/webp")
+        self.assertEqual(params["size"], [1152, 1536])
+        self.assertEqual(params["bytes"], len(data))
+        self.assertEqual(Image.open(io.BytesIO(data)).size, (1152, 1536))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+from datetime import date
+
+from invoice_checks import check_invoice, check_line_amounts, check_totals, check_dates, is_valid_ico
+
+
+def make_invoice(**overrides):
+    invoice = {
+        "issue_date": "2025-05-01",
+        "due_date": "2025-05-15",
+        "taxable_supply_date": "2025-05-01",
+        "amount_total": 2541.0,
+        "amount_rounding": 0.0,
+        "own_company_info": {"identification_number": "25596641"},
+        "counterparty_info": {"identification_number": "27082440"},
+        "lines": [
+            {"quantity": 2, "unit_price": 500.0, "ext_price": 1000.0, "tax_class_id": 21, "total_with_vat": 1210.0},
+            {"quantity": 3, "unit_price": 366.67, "ext_price": 1100.0, "tax_class_id": 21, "total_with_vat": 1331.0},
+        ],
+    }
+    invoice.update(overrides)
+    return invoice
+
+
+class TestInvoiceChecks(unittest.TestCase):
+    """Test cases for the deterministic invoice checks."""
+
+    def test_consistent_invoice(self):
+        """Test that a consistent invoice passes all checks."""
+        self.assertEqual(check_invoice(make_invoice()), [])
+
+    def test_line_amounts(self):
+        """Test that a line not matching quantity x unit price fails, a discounted one passes."""
+        lines = [
+            {"quantity": 2, "unit_price": 500.0, "ext_price": 100.0},
+            {"quantity": 2, "unit_price": 500.0, "discount_percent": 10, "ext_price": 900.0},
+        ]
+        problems = check_line_amounts({"lines": lines})
+        self.assertEqual(len(problems), 1)
+        self.assertTrue(problems[0].startswith("line 1:"))
+
+    def test_totals(self):
+        """Test that the lines must add up to the total, allowing for cash rounding and net-only lines."""
+        self.assertEqual(len(check_totals(make_invoice(amount_total=3000.0))), 1)
+        self.assertEqual(check_totals(make_invoice(amount_total=2541.4)), [])
+        net_lines = [{"ext_price": 1000.0, "tax_class_id": 21, "total_with_vat": 0}]
+        self.assertEqual(check_totals({"amount_total": 1210.0, "lines": net_lines}), [])
+        self.assertEqual(check_totals({"amount_total": 1210.0, "lines": []}), ["no line items extracted"])
+
+    def test_dates(self):
+        """Test that missing, invalid and implausible dates are reported."""
+        today = date(2025, 6, 1)
+        self.assertEqual(check_dates(make_invoice(), today), [])
+        self.assertEqual(len(check_dates(make_invoice(issue_date=None), today)), 1)
+        self.assertEqual(len(check_dates(make_invoice(due_date="2025-02-30"), today)), 1)
+        self.assertEqual(len(check_dates(make_invoice(taxable_supply_date="1925-05-01"), today)), 1)
+
+    def test_company_ids(self):
+        """Test the IČO check digit; foreign registration numbers are not checked."""
+        self.assertTrue(is_valid_ico("25596641"))
+        self.assertTrue(is_valid_ico("00064581"))
+        self.assertFalse(is_valid_ico("25596642"))
+        failures = check_invoice(make_invoice(counterparty_info={"identification_number": "12345678"}))
+        self.assertEqual([failure["check"] for failure in failures], ["company_ids"])
+        self.assertEqual(check_invoice(make_invoice(counterparty_info={"identification_number": "HRB 12345"})), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+import os
+import asyncio
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+
+from database import Database
+from job_queue import JobQueue, QueueFullError, JOB_DONE, JOB_FAILED, JOB_QUEUED
+
+
+class TestJobQueue(unittest.TestCase):
+    """Test cases for the persistent job queue."""
+
+    def setUp(self):
+        """Set up a temporary database."""
+        self.temp_db = tempfile.mktemp(suffix='.db')
+        self.db = Database(Path(self.temp_db))
+        self.db.start()
+        self.processed = []
+
+    def tearDown(self):
+        """Remove the temporary database."""
+        self.db.stop()
+        if os.path.exists(self.temp_db):
+            os.remove(self.temp_db)
+
+    async def _handler(self, job):
+        if job["file_name"] == "broken.pdf":
+            raise RuntimeError("Processing failed")
+        self.processed.append((job["file_id"], job["payload"]))
+
+    async def _wait_for(self, queue, job_id, status):
+        for _ in range(100):
+            job = await queue.get_job(job_id)
+            if job["status"] == status:
+                return job
+            await asyncio.sleep(0.02)
+        self.fail(f"Job {job_id} did not reach status {status}")
+
+    def test_jobs_are_processed(self):
+        """Test that enqueued jobs are processed and marked done or failed."""
+        async def run():
+            queue = JobQueue(self.db, self._handler, workers=2, poll_interval=0.05)
+            await queue.start()
+            ok_id = await queue.enqueue("file-1", "invoice.pdf", "pdf", "test-model", b"data")
+            failed_id = await queue.enqueue("file-2", "broken.pdf", "pdf", "test-model", b"data")
+            await self._wait_for(queue, ok_id, JOB_DONE)
+            failed = await self._wait_for(queue, failed_id, JOB_FAILED)
+            await queue.stop()
+            return failed
+
+        failed = asyncio.run(run())
+        self.assertEqual(self.processed, [("file-1", b"data")])
+        self.assertEqual(failed["error_message"], "Processing failed")
+
+    def test_unfinished_jobs_are_recovered(self):
+        """Test that jobs left running by a crashed process are resumed on start."""
+        async def run():
+            crashed = JobQueue(self.db, self._handler, workers=1, poll_interval=0.05)
+            await crashed.start()
+            await crashed.stop()
+            job_id = await self.db.run_write(
+                lambda conn: crashed._insert(conn, "file-1", "invoice.pdf", "pdf", "test-model", b"data", None)
+            )
+            await self.db.run_write(crashed._claim)  # Simulate a crash after the job was claimed
+
+            queue = JobQueue(self.db, self._handler, poll_interval=0.05)
+            await queue.start()
+            await self._wait_for(queue, job_id, JOB_DONE)
+            await queue.stop()
+
+        asyncio.run(run())
+        self.assertEqual(self.processed, [("file-1", b"data")])
+
+    def test_worker_survives_database_errors(self):
+        """Test that a failed claim does not stop the worker and the job is still processed."""
+        queue = JobQueue(self.db, self._handler, workers=1, poll_interval=0.05)
+        claim = queue._claim
+        failures = []
+
+        def failing_claim(conn):
+            # Twice, as the database retries a failed write once on its own when it was batched with others
+            queued = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", [JOB_QUEUED]).fetchone()[0]
+            if queued and len(failures) < 2:
+                failures.append(1)
+                raise sqlite3.OperationalError("disk I/O error")
+            return claim(conn)
+
+        queue._claim = failing_claim
+
+        async def run():
+            await queue.start()
+            job_id = await queue.enqueue("file-1", "invoice.pdf", "pdf", "test-model", b"data")
+            await self._wait_for(queue, job_id, JOB_DONE)
+            await queue.stop()
+
+        with self.assertLogs("invoice_service", "ERROR"):
+            asyncio.run(run())
+        self.assertEqual(failures, [1, 1])
+        self.assertEqual(self.processed, [("file-1", b"data")])
+
+    def test_queue_limit(self):
+        """Test that enqueueing beyond the pending limit is rejected."""
+        release = asyncio.Event()
+
+        async def blocked_handler(job):
+            await release.wait()
+
+        async def run():
+            queue = JobQueue(self.db, blocked_handler, workers=1, max_pending=1, poll_interval=0.05)
+            await queue.start()
+            await queue.enqueue("file-1", "invoice.pdf", "pdf", "test-model", b"data")
+            with self.assertRaises(QueueFullError):
+                await queue.enqueue("file-2", "invoice.pdf", "pdf", "test-model", b"data")
+            release.set()
+            await queue.stop()
+
+        asyncio.run(run())
+        conn = sqlite3.connect(self.temp_db)
+        jobs = conn.execute("SELECT file_id, status FROM jobs").fetchall()
+        conn.close()
+        self.assertEqual(jobs, [("file-1", JOB_DONE)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import json
+import unittest
+
+from json_stream import IncrementalJsonParser
+
+
+class TestIncrementalJsonParser(unittest.TestCase):
+    """Test cases for the incremental JSON parser."""
+
+    document = {
+        "number": "2505001",
+        "note": "quoted \"}, and ] inside",
+        "counterparty": {"name": "ACME", "ids": [1, 2]},
+        "lines": [{"name": "a, b"}, {"name": "c"}],
+        "total": 12.5,
+    }
+
+    def _feed(self, parser, text, size):
+        events = []
+        for start in range(0, len(text), size):
+            events.extend(parser.feed(text[start:start + size]))
+        return events
+
+    def test_events_for_any_chunking(self):
+        """Test that fields and array items are reported in order however the text is split."""
+        text = json.dumps(self.document, indent=2)
+        for size in (1, 3, 17, len(text)):
+            parser = IncrementalJsonParser(stream_arrays=("lines",))
+            events = self._feed(parser, text, size)
+            self.assertEqual(events, [
+                ("field", "number", "2505001"),
+                ("field", "note", self.document["note"]),
+                ("field", "counterparty", self.document["counterparty"]),
+                ("item", "lines", 0, {"name": "a, b"}),
+                ("item", "lines", 1, {"name": "c"}),
+                ("field", "total", 12.5),
+            ])
+            self.assertTrue(parser.done)
+
+    def test_field_reported_before_the_document_ends(self):
+        """Test that a completed field is reported while later fields are still missing."""
+        parser = IncrementalJsonParser()
+        self.assertEqual(parser.feed('{"number": "2505001", "total": 1'), [("field", "number", "2505001")])
+        self.assertFalse(parser.done)
+        self.assertEqual(parser.feed("2.5}"), [("field", "total", 12.5)])
+
+
+if __name__ == "__main__":
+    unittest.main()
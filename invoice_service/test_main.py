@@ -1,11 +1,34 @@
 import os
+import io
+import json
+import sqlite3
+import subprocess
+import sys
+import zipfile
+import asyncio
+import tempfile
+import time
 import unittest
 from pathlib import Path
-from unittest.mock import patch, MagicMock
+from types import SimpleNamespace
+from unittest.mock import patch, MagicMock, AsyncMock
 
+import httpx
+from fastapi import FastAPI, UploadFile, File
+from google.genai import errors
+from PIL import Image
 from fastapi.testclient import TestClient
 
-from main import app, process_image, process_pdf, process_docx
+from database import Database
+from uploads import MaxBodySizeMiddleware
+from startup_benchmark import check_import
+from prompt_cache import PromptCache
+from rate_limiter import RateLimiter
+from tracing import OtlpFileExporter
+from metrics import count_tokens, limit_model_labels
+import main
+from main import app, process_image, process_pdf, process_docx, setup_database, SingleFlight
+from main import generate_response, SYSTEM_INSTRUCTION, _read_batch, check_pdf_settings
 
 
 class TestInvoiceService(unittest.TestCase):
@@ -14,8 +37,21 @@ class TestInvoiceService(unittest.TestCase):
     def setUp(self):
         """Set up test environment."""
         self.client = TestClient(app)
+
+        # Use a temporary database file for testing
+        self.temp_db = tempfile.mktemp(suffix='.db')
+        self.db_path_patcher = patch('main.DB_PATH', Path(self.temp_db))
+        self.db_path_patcher.start()
+        setup_database()
+        self.db = Database(Path(self.temp_db))
+        self.db.start()
+        self.db_patcher = patch('main.db', self.db)
+        self.db_patcher.start()
+        self.models_patcher = patch('main.GEMINI_ALLOWED_MODELS', {"test-model", "cheap-model", "metrics-model"})
+        self.models_patcher.start()
+
         # Mock the Gemini client for testing
-        self.gemini_patcher = patch('invoce_service.main.client')
+        self.gemini_patcher = patch('main.client')
         self.mock_gemini = self.gemini_patcher.start()
         
         # Mock the response from Gemini
@@ -48,15 +84,25 @@ class TestInvoiceService(unittest.TestCase):
             ]
         }
         self.mock_response.usage_metadata.total_token_count = 100
+        self.mock_response.usage_metadata.prompt_token_count = 80
+        self.mock_response.usage_metadata.candidates_token_count = 20
+        self.mock_response.usage_metadata.thoughts_token_count = 0
+        self.mock_response.usage_metadata.cached_content_token_count = 0
         
-        self.mock_gemini.models.generate_content.return_value = self.mock_response
+        self.mock_gemini.aio.models.generate_content = AsyncMock(return_value=self.mock_response)
 
     def tearDown(self):
         """Clean up after tests."""
         self.gemini_patcher.stop()
+        self.models_patcher.stop()
+        self.db_patcher.stop()
+        self.db.stop()
+        self.db_path_patcher.stop()
+        if os.path.exists(self.temp_db):
+            os.remove(self.temp_db)
 
-    @patch('main.MarkItDown')
-    def test_process_image(self, mock_markitdown):
+    @patch('main.document_converter')
+    def test_process_image(self, mock_converter):
         """Test processing an image file."""
         # REPLACE WITH ACTUAL IMAGE PATH
         image_path = "test/data/faktura.png"  
@@ -66,18 +112,21 @@ class TestInvoiceService(unittest.TestCase):
             self.skipTest(f"Test image file not found: {image_path}")
         
         # Test image processing
-        result = process_image(image_path)
+        with open(image_path, "rb") as f:
+            document = io.BytesIO(f.read())
+        result = asyncio.run(process_image("test-model", document, Path(image_path).name))
         
         # Verify the result
         self.assertIn("invoice", result)
         self.assertIn("total_token_count", result)
         self.assertEqual(result["total_token_count"], 100)
-        self.mock_gemini.models.generate_content.assert_called_once()
+        self.mock_gemini.aio.models.generate_content.assert_awaited_once()
 
-    @patch('main.MarkItDown')
-    @patch('main.convert_from_path')
-    def test_process_pdf(self, mock_convert_from_path, mock_markitdown):
-        """Test processing a PDF file."""
+    @patch('main.document_converter')
+    @patch('main._get_rasterizer')
+    @patch('main._classify_pdf', return_value={"kind": "scanned", "pages": []})
+    def test_process_pdf(self, mock_classify_pdf, mock_get_rasterizer, mock_converter):
+        """Test processing a scanned PDF file."""
         # REPLACE WITH ACTUAL PDF PATH
         pdf_path = "test/data/matejfanta-2505001.pdf"  # Replace with your test PDF file
         
@@ -85,31 +134,83 @@ class TestInvoiceService(unittest.TestCase):
         if not Path(pdf_path).exists():
             self.skipTest(f"Test PDF file not found: {pdf_path}")
         
-        # Mock the PDF to image conversion
-        mock_image = MagicMock()
-        mock_image.save.return_value = None
-        mock_convert_from_path.return_value = [mock_image]
+        # Mock the PDF to image conversion with an A4 page rendered at 300 DPI
+        page = Image.new("L", (2480, 3508), "white")
+        mock_get_rasterizer.return_value.render.return_value = [page]
         
         # Mock markitdown conversion result
-        mock_result = MagicMock()
-        mock_result.text_content = "Test markdown content"
-        mock_markitdown_instance = MagicMock()
-        mock_markitdown_instance.convert_stream.return_value = mock_result
-        mock_markitdown.return_value = mock_markitdown_instance
+        mock_converter.convert.return_value = "Test markdown content"
         
         # Test PDF processing
-        result = process_pdf(pdf_path)
+        with open(pdf_path, "rb") as f:
+            document = io.BytesIO(f.read())
+        result = asyncio.run(process_pdf("test-model", document, Path(pdf_path).name))
         
         # Verify the result
         self.assertIn("invoice", result)
         self.assertIn("total_token_count", result)
         self.assertEqual(result["total_token_count"], 100)
-        self.mock_gemini.models.generate_content.assert_called_once()
-        mock_markitdown.assert_called_once()
-        mock_markitdown_instance.convert_stream.assert_called_once()
+        self.mock_gemini.aio.models.generate_content.assert_awaited_once()
+        mock_converter.convert.assert_called_once()
+
+        # Only the pages sent to the model are rendered
+        args, _ = mock_get_rasterizer.return_value.render.call_args
+        self.assertEqual(args[1], 5)
+
+        # Pages are downscaled to the image budget
+        self.assertEqual(result["image_params"]["pages"][0]["size"], [1086, 1536])
+        self.assertGreater(result["image_params"]["bytes"], 0)
+
+    @patch('main.document_converter')
+    @patch('main._get_rasterizer')
+    def test_process_digital_pdf(self, mock_get_rasterizer, mock_converter):
+        """Test that a born-digital PDF is sent without the full page images."""
+        pdf_path = "test/data/matejfanta-2505001.pdf"
+        if not Path(pdf_path).exists():
+            self.skipTest(f"Test PDF file not found: {pdf_path}")
+        with open(pdf_path, "rb") as f:
+            content = f.read()
+
+        mock_get_rasterizer.return_value.render.return_value = [Image.new("L", (1240, 1754), "white")]
+        mock_converter.convert.return_value = "Test markdown content"
+
+        with patch('main.PDF_DIGITAL_MODE', "text"):
+            result = asyncio.run(process_pdf("test-model", io.BytesIO(content), Path(pdf_path).name))
+        self.assertEqual(result["pdf_route"]["kind"], "digital")
+        self.assertIsNone(result["image_params"])
+        mock_get_rasterizer.return_value.render.assert_not_called()
+
+        with patch('main.PDF_DIGITAL_MODE', "first_page"):
+            result = asyncio.run(process_pdf("test-model", io.BytesIO(content), Path(pdf_path).name))
+        args, _ = mock_get_rasterizer.return_value.render.call_args
+        self.assertEqual(args[1], 1)
+        self.assertEqual(result["image_params"]["pages"][0]["size"], [543, 768])
+
+        # Every PDF is sent like a scan in the images mode, without classifying it first
+        with patch('main.PDF_DIGITAL_MODE', "images"), patch('main._classify_pdf') as mock_classify_pdf:
+            result = asyncio.run(process_pdf("test-model", io.BytesIO(content), Path(pdf_path).name))
+        mock_classify_pdf.assert_not_called()
+        self.assertEqual(result["pdf_route"]["route"], "images")
+        args, _ = mock_get_rasterizer.return_value.render.call_args
+        self.assertEqual(args[1], 5)
+
+    def test_pdf_digital_mode_validated(self):
+        """Test that an unknown PDF_DIGITAL_MODE is rejected instead of sending every page as an image."""
+        for mode in ("first_page", "text", "images"):
+            with patch('main.PDF_DIGITAL_MODE', mode):
+                check_pdf_settings()
+        with patch('main.PDF_DIGITAL_MODE', "first-page"), self.assertRaises(RuntimeError):
+            check_pdf_settings()
 
-    @patch('main.MarkItDown')
-    def test_process_docx(self, mock_markitdown):
+    def test_log_stage_levels_validated(self):
+        """Test that a malformed LOG_STAGE_LEVELS is reported by name on startup, not as an import error."""
+        for value in ('{"llm_call": "DEBUG"', '["DEBUG"]', '{"llm_call": "VERBOSE"}'):
+            with patch('main.LOG_STAGE_LEVELS', value), patch('main.log_listener', None), \
+                    self.assertRaisesRegex(RuntimeError, "LOG_STAGE_LEVELS"):
+                main.setup_logging()
+
+    @patch('main.document_converter')
+    def test_process_docx(self, mock_converter):
         """Test processing a DOCX file."""
         # REPLACE WITH ACTUAL DOCX PATH
         docx_path = "test/data/Downloadable-Word-Invoice-Template.docx"  # Replace with your test DOCX file
@@ -119,22 +220,19 @@ class TestInvoiceService(unittest.TestCase):
             self.skipTest(f"Test DOCX file not found: {docx_path}")
         
         # Mock markitdown conversion result
-        mock_result = MagicMock()
-        mock_result.text_content = "Test markdown content"
-        mock_markitdown_instance = MagicMock()
-        mock_markitdown_instance.convert_stream.return_value = mock_result
-        mock_markitdown.return_value = mock_markitdown_instance
+        mock_converter.convert.return_value = "Test markdown content"
         
         # Test DOCX processing
-        result = process_docx(docx_path)
+        with open(docx_path, "rb") as f:
+            document = io.BytesIO(f.read())
+        result = asyncio.run(process_docx("test-model", document, Path(docx_path).name))
         
         # Verify the result
         self.assertIn("invoice", result)
         self.assertIn("total_token_count", result)
         self.assertEqual(result["total_token_count"], 100)
-        self.mock_gemini.models.generate_content.assert_called_once()
-        mock_markitdown.assert_called_once()
-        mock_markitdown_instance.convert_stream.assert_called_once()
+        self.mock_gemini.aio.models.generate_content.assert_awaited_once()
+        mock_converter.convert.assert_called_once()
 
     def test_health_check(self):
         """Test the health check endpoint."""
@@ -142,6 +240,45 @@ class TestInvoiceService(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json()["status"], "healthy")
 
+    @patch('main.document_converter')
+    def test_metrics(self, mock_converter):
+        """Test that an extraction is recorded in the stage histograms and token counters of /metrics."""
+        docx_path = "test/data/Downloadable-Word-Invoice-Template.docx"
+        if not Path(docx_path).exists():
+            self.skipTest(f"Test DOCX file not found: {docx_path}")
+        mock_converter.convert.return_value = "Invoice 2505001"
+
+        with open(docx_path, "rb") as f:
+            response = self.client.post(
+                "/invoice",
+                files={"file": ("invoice.docx", f.read(), "application/octet-stream")},
+                data={"file_id": "test-file-id", "model_name": "metrics-model"}
+            )
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("text/plain"))
+        for stage in ("upload_read", "conversion", "llm_call", "db_write"):
+            self.assertIn(
+                f'invoice_stage_duration_seconds_count{{file_type="docx",model="metrics-model",stage="{stage}"}} 1.0',
+                response.text
+            )
+        self.assertIn('invoice_tokens_total{kind="input",model="metrics-model"} 80.0', response.text)
+        self.assertIn("invoice_requests_in_flight 0.0", response.text)
+
+    def test_metrics_model_label_bounded(self):
+        """Test that models outside the allowed ones are recorded under the "other" model label."""
+        limit_model_labels({"metrics-model"})
+        try:
+            count_tokens("metrics-model", 1, 0, 0, 0)
+            count_tokens("unknown-model", 1, 0, 0, 0)
+        finally:
+            limit_model_labels(None)
+        response = self.client.get("/metrics")
+        self.assertIn('invoice_tokens_total{kind="input",model="other"}', response.text)
+        self.assertNotIn('model="unknown-model"', response.text)
+
     def test_invoice_endpoint_image(self):
         """Test the invoice endpoint with an image file."""
         # REPLACE WITH ACTUAL IMAGE PATH
@@ -158,7 +295,8 @@ class TestInvoiceService(unittest.TestCase):
         # Send request to the endpoint
         response = self.client.post(
             "/invoice",
-            files={"file": ("test_image.jpg", image_data, "image/jpeg")}
+            files={"file": ("test_image.jpg", image_data, "image/jpeg")},
+            data={"file_id": "test-file-id", "model_name": "test-model"}
         )
         
         # Check the response
@@ -166,6 +304,13 @@ class TestInvoiceService(unittest.TestCase):
         self.assertIn("invoice", response.json())
         self.assertIn("total_token_count", response.json())
 
+        # The preprocessing parameters and the size sent to the model are stored with the record
+        conn = sqlite3.connect(self.temp_db)
+        image_params, image_bytes = conn.execute("SELECT image_params, image_bytes FROM invoice_processes").fetchone()
+        conn.close()
+        self.assertEqual(json.loads(image_params)["format"], "jpeg")
+        self.assertEqual(image_bytes, response.json()["image_params"]["bytes"])
+
     def test_invoice_endpoint_pdf(self):
         """Test the invoice endpoint with a PDF file."""
         # REPLACE WITH ACTUAL PDF PATH
@@ -182,7 +327,8 @@ class TestInvoiceService(unittest.TestCase):
         # Send request to the endpoint
         response = self.client.post(
             "/invoice",
-            files={"file": ("test_invoice.pdf", pdf_data, "application/pdf")}
+            files={"file": ("test_invoice.pdf", pdf_data, "application/pdf")},
+            data={"file_id": "test-file-id", "model_name": "test-model"}
         )
         
         # Check the response
@@ -190,6 +336,47 @@ class TestInvoiceService(unittest.TestCase):
         self.assertIn("invoice", response.json())
         self.assertIn("total_token_count", response.json())
 
+    def test_history_trace(self):
+        """Test that a request's stage trace is stored, returned by /history/{id}/trace and exported to a file."""
+        pdf_path = "test/data/matejfanta-2505001.pdf"
+        if not Path(pdf_path).exists():
+            self.skipTest(f"Test PDF file not found: {pdf_path}")
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            export_path = Path(temp_dir) / "traces.jsonl"
+            with open(pdf_path, "rb") as f, patch("main.trace_exporter", OtlpFileExporter(export_path)):
+                response = self.client.post(
+                    "/invoice",
+                    files={"file": ("test_invoice.pdf", f.read(), "application/pdf")},
+                    data={"file_id": "test-file-id", "model_name": "test-model"}
+                )
+            self.assertEqual(response.status_code, 200)
+            exported = [json.loads(line) for line in export_path.read_text().splitlines()]
+
+        record = self.client.get("/history?fields=duration_ms,trace_json").json()["results"][0]
+        self.assertGreater(record["duration_ms"], 0)
+
+        response = self.client.get(f"/history/{record['id']}/trace")
+        self.assertEqual(response.status_code, 200)
+        trace = response.json()["trace"]
+        self.assertEqual(trace, record["trace_json"])
+        spans = {span["stage"]: span for span in trace["spans"]}
+        self.assertIn("upload_read", spans)
+        self.assertIn("conversion", spans)
+        self.assertEqual(spans["llm_call"]["model"], "test-model")
+        self.assertEqual(spans["llm_call"]["input_tokens"], 80)
+        self.assertEqual(trace["attributes"]["page_count"], 1)
+        self.assertGreater(trace["attributes"]["markdown_chars"], 0)
+
+        # One OTLP/JSON request with the request span and a child span per stage, including the database write
+        self.assertEqual(len(exported), 1)
+        otlp_spans = exported[0]["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        self.assertEqual(otlp_spans[0]["name"], "extract_invoice")
+        self.assertEqual({span["traceId"] for span in otlp_spans}, {trace["trace_id"]})
+        self.assertEqual({span["name"] for span in otlp_spans[1:]}, set(spans) | {"db_write"})
+
+        self.assertEqual(self.client.get("/history/12345/trace").status_code, 404)
+
     def test_invoice_endpoint_docx(self):
         """Test the invoice endpoint with a DOCX file."""
         # REPLACE WITH ACTUAL DOCX PATH
@@ -206,7 +393,8 @@ class TestInvoiceService(unittest.TestCase):
         # Send request to the endpoint
         response = self.client.post(
             "/invoice",
-            files={"file": ("test_invoice.docx", docx_data, "application/vnd.openxmlformats-officedocument.wordprocessingml.document")}
+            files={"file": ("test_invoice.docx", docx_data, "application/vnd.openxmlformats-officedocument.wordprocessingml.document")},
+            data={"file_id": "test-file-id", "model_name": "test-model"}
         )
         
         # Check the response
@@ -214,6 +402,370 @@ class TestInvoiceService(unittest.TestCase):
         self.assertIn("invoice", response.json())
         self.assertIn("total_token_count", response.json())
 
+    def test_invoice_endpoint_cache_hit(self):
+        """Test that a repeated upload is answered from the result cache."""
+        image_path = "test/data/faktura.png"
+        if not Path(image_path).exists():
+            self.skipTest(f"Test image file not found: {image_path}")
+
+        with open(image_path, "rb") as f:
+            image_data = f.read()
+
+        responses = [
+            self.client.post(
+                "/invoice",
+                files={"file": ("faktura.png", image_data, "image/png")},
+                data={"file_id": f"test-file-{i}", "model_name": "test-model"}
+            )
+            for i in range(2)
+        ]
+
+        self.assertEqual([r.status_code for r in responses], [200, 200])
+        self.assertFalse(responses[0].json()["cache_hit"])
+        self.assertTrue(responses[1].json()["cache_hit"])
+        self.assertEqual(responses[1].json()["file_id"], "test-file-1")
+        self.assertEqual(responses[1].json()["invoice"], responses[0].json()["invoice"])
+        self.mock_gemini.aio.models.generate_content.assert_awaited_once()
+
+    def test_result_cache_key_covers_settings(self):
+        """Test that a change of the preprocessing settings or the cascade model changes the result cache key."""
+        def settings_version(**env):
+            code = "import main; print(main.SETTINGS_VERSION)"
+            return subprocess.run([sys.executable, "-c", code], env={**os.environ, **env}, cwd=Path(main.__file__).parent,
+                                  capture_output=True, text=True, check=True).stdout.strip()
+
+        versions = {settings_version(PDF_DPI="300"), settings_version(CASCADE_MODEL="cheap-model")}
+        self.assertEqual(len(versions), 2)
+        self.assertNotIn(main.SETTINGS_VERSION, versions)
+        self.assertTrue(main._result_cache_key("sha", "test-model").endswith(main.SETTINGS_VERSION))
+
+    def test_prompt_cache(self):
+        """Test that the system instruction is sent as cached content and inline when the cache is gone."""
+        self.mock_gemini.aio.caches.create = AsyncMock(return_value=SimpleNamespace(name="cachedContents/prompt"))
+        self.mock_response.usage_metadata.cached_content_token_count = 60
+
+        prompt_cache = PromptCache(SYSTEM_INSTRUCTION, min_tokens=1)
+        asyncio.run(prompt_cache.start(self.mock_gemini, ["test-model"]))
+        with patch('main.prompt_cache', prompt_cache):
+            result = asyncio.run(generate_response(["document"], "Processing", "test-model"))
+            _, kwargs = self.mock_gemini.aio.models.generate_content.call_args
+            self.assertEqual(kwargs["config"]["cached_content"], "cachedContents/prompt")
+            self.assertNotIn("system_instruction", kwargs["config"])
+            self.assertEqual(result["cached_token_count"], 60)
+
+            # An expired cache is rejected by the API, the request is retried with the prompt inline
+            self.mock_gemini.aio.models.generate_content.side_effect = [
+                errors.ClientError(404, {"error": {"message": "Cached content not found", "status": "NOT_FOUND"}}),
+                self.mock_response,
+            ]
+            asyncio.run(generate_response(["document"], "Processing", "test-model"))
+            _, kwargs = self.mock_gemini.aio.models.generate_content.call_args
+            self.assertEqual(kwargs["config"]["system_instruction"], SYSTEM_INSTRUCTION)
+
+    def test_single_flight(self):
+        """Test that concurrent calls with the same key share one execution."""
+        calls = []
+
+        async def slow_extraction():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return {"invoice": {"external_invoice_number": "123"}}
+
+        async def run():
+            flight = SingleFlight()
+            return await asyncio.gather(*[flight.do("same-key", slow_extraction) for _ in range(3)])
+
+        results = asyncio.run(run())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([shared for _, shared in results], [False, True, True])
+        self.assertEqual(results[0][0], results[2][0])
+        self.assertIsNot(results[0][0], results[2][0])
+
+    @patch('main.RESULT_CACHE_MAX_ENTRIES', 0)
+    @patch('main.document_converter')
+    def test_single_flight_leader_cancelled(self, mock_converter):
+        """Test that identical uploads sharing a pipeline run survive the cancellation of the request that started it."""
+        def slow_convert(document, mime_type):
+            time.sleep(0.2)
+            document.seek(0)
+            document.read()
+            return "Test markdown content"
+
+        mock_converter.convert.side_effect = slow_convert
+        files = {"file": ("invoice.docx", b"docx content", "application/octet-stream")}
+
+        async def run():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                leader = asyncio.create_task(client.post(
+                    "/invoice", files=files, data={"file_id": "leader", "model_name": "test-model"}))
+                await asyncio.sleep(0.05)
+                follower = asyncio.create_task(client.post(
+                    "/invoice", files=files, data={"file_id": "follower", "model_name": "test-model"}))
+                await asyncio.sleep(0.05)
+                leader.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await leader
+                return await follower
+
+        response = asyncio.run(run())
+        self.assertEqual(response.status_code, 200, response.text)
+        self.assertTrue(response.json()["cache_hit"])
+        mock_converter.convert.assert_called_once()
+        self.mock_gemini.aio.models.generate_content.assert_awaited_once()
+
+    @patch('main.document_converter')
+    def test_quota_exceeded(self, mock_converter):
+        """Test that a model still over quota after the retries is reported as 503 with Retry-After."""
+        docx_path = "test/data/Downloadable-Word-Invoice-Template.docx"
+        if not Path(docx_path).exists():
+            self.skipTest(f"Test DOCX file not found: {docx_path}")
+        mock_converter.convert.return_value = "Invoice 2505001"
+        quota_error = errors.ClientError(429, {"error": {
+            "message": "Quota exceeded", "status": "RESOURCE_EXHAUSTED",
+            "details": [{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": "0.01s"}]
+        }})
+        self.mock_gemini.aio.models.generate_content = AsyncMock(side_effect=quota_error)
+
+        with open(docx_path, "rb") as f, patch("main.rate_limiter", RateLimiter(max_retries=2)):
+            response = self.client.post(
+                "/invoice",
+                files={"file": ("invoice.docx", f.read(), "application/octet-stream")},
+                data={"file_id": "test-file-id", "model_name": "test-model"}
+            )
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers["retry-after"], "1")
+        self.assertEqual(self.mock_gemini.aio.models.generate_content.await_count, 3)
+
+    @patch('main.document_converter')
+    def test_cascade(self, mock_converter):
+        """Test that the cheap model's result is kept when it passes the checks and escalated when not."""
+        docx_path = "test/data/Downloadable-Word-Invoice-Template.docx"
+        if not Path(docx_path).exists():
+            self.skipTest(f"Test DOCX file not found: {docx_path}")
+        mock_converter.convert.return_value = "Invoice 2505001"
+        consistent_response = MagicMock(usage_metadata=self.mock_response.usage_metadata)
+        consistent_response.parsed.model_dump.return_value = {
+            "issue_date": "2025-05-01",
+            "amount_total": 1210.0,
+            "lines": [{"quantity": 2, "unit_price": 500.0, "ext_price": 1000.0, "tax_class_id": 21,
+                       "total_with_vat": 1210.0}],
+        }
+
+        def post(file_id):
+            with open(docx_path, "rb") as f:
+                return self.client.post(
+                    "/invoice",
+                    files={"file": ("invoice.docx", f.read(), "application/octet-stream")},
+                    data={"file_id": file_id, "model_name": "test-model"}
+                )
+
+        generate_content = self.mock_gemini.aio.models.generate_content
+        with patch("main.CASCADE_MODEL", "cheap-model"), patch("main.RESULT_CACHE_MAX_ENTRIES", 0):
+            generate_content.return_value = consistent_response
+            cheap = post("cheap-file-id").json()
+            # The mock invoice has no issue date and no lines, so the checks fail
+            generate_content.return_value = self.mock_response
+            escalated = post("escalated-file-id").json()
+
+        self.assertEqual(cheap["cascade"]["tier"], "cheap")
+        self.assertEqual(cheap["model"], "cheap-model")
+        self.assertEqual(cheap["total_token_count"], 100)
+        self.assertEqual(escalated["cascade"]["tier"], "strong")
+        self.assertEqual(escalated["model"], "test-model")
+        self.assertEqual(escalated["total_token_count"], 200)
+        self.assertIn("dates", [failure["check"] for failure in escalated["cascade"]["failed_checks"]])
+        models = [call.kwargs["model"] for call in generate_content.await_args_list]
+        self.assertEqual(models, ["cheap-model", "cheap-model", "test-model"])
+
+        with sqlite3.connect(self.temp_db) as conn:
+            tiers = dict(conn.execute("SELECT file_id, model_tier FROM invoice_processes"))
+            stored_models = dict(conn.execute("SELECT file_id, model FROM invoice_processes"))
+        self.assertEqual(tiers, {"cheap-file-id": "cheap", "escalated-file-id": "strong"})
+        # The history records the model that produced the result
+        self.assertEqual(stored_models, {"cheap-file-id": "cheap-model", "escalated-file-id": "test-model"})
+
+    def test_unknown_model_rejected(self):
+        """Test that a model outside GEMINI_ALLOWED_MODELS is rejected before it reaches the rate limiter."""
+        response = self.client.post(
+            "/invoice",
+            files={"file": ("invoice.docx", b"docx content", "application/octet-stream")},
+            data={"file_id": "test-file-id", "model_name": "any-model-name"}
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("test-model", response.json()["detail"])
+        self.mock_gemini.aio.models.generate_content.assert_not_awaited()
+
+    def test_upload_too_large(self):
+        """Test that uploads above the size limit are rejected with 413."""
+        with patch("main.MAX_UPLOAD_SIZE", 10):
+            response = self.client.post(
+                "/invoice",
+                files={"file": ("faktura.png", b"x" * 11, "image/png")},
+                data={"file_id": "test-file-id", "model_name": "test-model"}
+            )
+
+        self.assertEqual(response.status_code, 413)
+        self.mock_gemini.aio.models.generate_content.assert_not_awaited()
+
+    def test_request_body_too_large(self):
+        """Test that the middleware rejects a request body above the limit before it is parsed."""
+        limited_app = FastAPI()
+        limited_app.add_middleware(MaxBodySizeMiddleware, max_body_size=1000)
+
+        @limited_app.post("/upload")
+        async def upload(file: UploadFile = File(...)):
+            return {"size": len(await file.read())}
+
+        client = TestClient(limited_app)
+        self.assertEqual(client.post("/upload", files={"file": ("a.bin", b"x" * 100)}).status_code, 200)
+        self.assertEqual(client.post("/upload", files={"file": ("a.bin", b"x" * 10000)}).status_code, 413)
+
+    def test_batch_endpoint(self):
+        """Test that a batch streams one NDJSON line per file, including per-file errors."""
+        image_path = "test/data/faktura.png"
+        if not Path(image_path).exists():
+            self.skipTest(f"Test image file not found: {image_path}")
+        with open(image_path, "rb") as f:
+            image_data = f.read()
+
+        response = self.client.post(
+            "/invoices/batch",
+            files=[
+                ("files", ("first.png", image_data, "image/png")),
+                ("files", ("notes.txt", b"not an invoice", "text/plain")),
+                ("files", ("second.png", image_data + b"\0", "image/png")),
+            ],
+            data={"model_name": "test-model", "file_ids": ["id-1", "id-2", "id-3"]}
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["content-type"], "application/x-ndjson")
+        lines = sorted((json.loads(line) for line in response.text.splitlines()), key=lambda line: line["index"])
+        self.assertEqual([line["file_id"] for line in lines], ["id-1", "id-2", "id-3"])
+        self.assertEqual([line["status"] for line in lines], ["ok", "error", "ok"])
+        self.assertIn("Unsupported file format", lines[1]["error"])
+        self.assertIn("invoice", lines[0])
+
+        conn = sqlite3.connect(self.temp_db)
+        stored = [row[0] for row in conn.execute("SELECT file_id FROM invoice_processes ORDER BY file_id")]
+        conn.close()
+        self.assertEqual(stored, ["id-1", "id-3"])
+
+    def test_batch_endpoint_zip(self):
+        """Test that ZIP archives are expanded into batch files and mismatched file_ids are rejected."""
+        image_path = "test/data/faktura.png"
+        if not Path(image_path).exists():
+            self.skipTest(f"Test image file not found: {image_path}")
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w") as zip_file:
+            zip_file.write(image_path, "invoices/a.png")
+            zip_file.writestr("__MACOSX/invoices/._a.png", b"metadata")
+            zip_file.write(image_path, "invoices/b.png")
+
+        response = self.client.post(
+            "/invoices/batch",
+            files=[("files", ("invoices.zip", archive.getvalue(), "application/zip"))],
+            data={"model_name": "test-model"}
+        )
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        self.assertEqual(response.headers["x-batch-count"], "2")
+        self.assertEqual(sorted(line["file_id"] for line in lines), ["a.png", "b.png"])
+        # Both files have the same content, so the second one is served by the cache or the shared call
+        self.mock_gemini.aio.models.generate_content.assert_awaited_once()
+
+        response = self.client.post(
+            "/invoices/batch",
+            files=[("files", ("invoices.zip", archive.getvalue(), "application/zip"))],
+            data={"model_name": "test-model", "file_ids": ["only-one"]}
+        )
+        self.assertEqual(response.status_code, 400)
+
+    @patch('main.BATCH_SPOOL_SIZE', 1024)
+    def test_batch_files_spooled_to_disk(self):
+        """Test that batch files waiting for processing are kept in temporary files, not in memory."""
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w") as zip_file:
+            zip_file.writestr("b.pdf", b"b" * 4096)
+        archive.seek(0)
+        files = [
+            UploadFile(io.BytesIO(b"a" * 4096), filename="a.pdf"),
+            UploadFile(io.BytesIO(b"c" * 100), filename="c.pdf"),
+            UploadFile(archive, filename="invoices.zip"),
+        ]
+
+        documents = asyncio.run(_read_batch(files, "test-model"))
+        try:
+            buffers = {name: upload.buffer for name, upload in documents}
+            self.assertNotIsInstance(buffers["a.pdf"], io.BytesIO)
+            self.assertNotIsInstance(buffers["b.pdf"], io.BytesIO)
+            self.assertIsInstance(buffers["c.pdf"], io.BytesIO)
+            self.assertEqual(dict(documents)["b.pdf"].read_bytes(), b"b" * 4096)
+        finally:
+            for _, upload in documents:
+                upload.close()
+
+    def test_stream_endpoint(self):
+        """Test that the streaming endpoint sends the fields and lines before the validated invoice."""
+        image_path = "test/data/faktura.png"
+        if not Path(image_path).exists():
+            self.skipTest(f"Test image file not found: {image_path}")
+        with open(image_path, "rb") as f:
+            image_data = f.read()
+
+        address = {"street": "", "city": "", "postalcode": "", "state": "", "country": ""}
+        company = {"company_name": "ACME", "address": address, "identification_number": "", "tax_number": "",
+                   "phone": "", "email": ""}
+        line = {"name": "Item", "quantity": 1, "unit_price": 10, "ext_price": 10, "tax_class_id": 21,
+                "total_with_vat": 12.1}
+        document = json.dumps({
+            "type": "received", "external_invoice_number": "2505001", "issue_date": "2025-05-01",
+            "payment_method": "card", "banking_info": {"account_number": "", "bank_code": ""},
+            "own_company_info": {"name": "Deymed", **company}, "counterparty_info": company,
+            "currency_id": "CZK", "lines": [line, line],
+        })
+
+        async def chunks():
+            for start in range(0, len(document), 40):
+                yield SimpleNamespace(text=document[start:start + 40], usage_metadata=None)
+            yield SimpleNamespace(text="", usage_metadata=self.mock_response.usage_metadata)
+
+        self.mock_gemini.aio.models.generate_content_stream = AsyncMock(return_value=chunks())
+
+        response = self.client.post(
+            "/invoice/stream",
+            files={"file": ("faktura.png", image_data, "image/png")},
+            data={"file_id": "stream-1", "model_name": "test-model"}
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("text/event-stream"))
+        events = []
+        for block in response.text.strip().split("\n\n"):
+            event, data = block.split("\n")
+            events.append((event[len("event: "):], json.loads(data[len("data: "):])))
+
+        names = [event for event, _ in events]
+        self.assertEqual(names[-3:], ["line", "line", "invoice"])
+        self.assertIn(("field", {"name": "external_invoice_number", "value": "2505001"}), events)
+        self.assertLess(names.index("field"), names.index("line"))
+        invoice = events[-1][1]
+        self.assertEqual(invoice["file_id"], "stream-1")
+        self.assertEqual(invoice["total_token_count"], 100)
+        self.assertEqual(len(invoice["invoice"]["lines"]), 2)
+
+        conn = sqlite3.connect(self.temp_db)
+        stored = conn.execute("SELECT file_id, token_count FROM invoice_processes").fetchall()
+        conn.close()
+        self.assertEqual(stored, [("stream-1", 100)])
+
+    def test_import_has_no_side_effects(self):
+        """Test that importing the service does not load heavy libraries or create files."""
+        checks = check_import()
+        self.assertEqual(checks["eager_modules"], [])
+        self.assertEqual(checks["created_files"], [])
+
     def test_invalid_file_format(self):
         """Test the invoice endpoint with an unsupported file format."""
         # Create a simple text file
@@ -222,7 +774,8 @@ class TestInvoiceService(unittest.TestCase):
         # Send request to the endpoint
         response = self.client.post(
             "/invoice",
-            files={"file": ("test.txt", text_data, "text/plain")}
+            files={"file": ("test.txt", text_data, "text/plain")},
+            data={"file_id": "test-file-id", "model_name": "test-model"}
         )
         
         # Check that we get an error response
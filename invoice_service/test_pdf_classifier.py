@@ -0,0 +1,46 @@
+import io
+import unittest
+from pathlib import Path
+
+from PIL import Image
+
+from pdf_classifier import classify_pdf, PDF_DIGITAL, PDF_SCANNED, PDF_UNKNOWN
+
+
+class TestPdfClassifier(unittest.TestCase):
+    """Test cases for the digital vs scanned PDF classifier."""
+
+    def setUp(self):
+        try:
+            import pypdfium2  # noqa: F401
+        except ImportError:
+            self.skipTest("pypdfium2 is not installed")
+
+    def test_digital_pdf(self):
+        """Test that a PDF with a text layer is classified as digital."""
+        pdf_path = "test/data/matejfanta-2505001.pdf"
+        if not Path(pdf_path).exists():
+            self.skipTest(f"Test PDF file not found: {pdf_path}")
+        with open(pdf_path, "rb") as f:
+            classification = classify_pdf(f.read())
+
+        self.assertEqual(classification["kind"], PDF_DIGITAL)
+        self.assertGreater(classification["pages"][0]["chars"], 0)
+
+    def test_scanned_pdf(self):
+        """Test that a PDF made of a page-size image is classified as scanned."""
+        buffer = io.BytesIO()
+        Image.new("L", (850, 1100), "white").save(buffer, "PDF", resolution=100)
+
+        classification = classify_pdf(buffer.getvalue())
+
+        self.assertEqual(classification["kind"], PDF_SCANNED)
+        self.assertEqual(classification["pages"][0]["image_coverage"], 1.0)
+
+    def test_invalid_pdf(self):
+        """Test that unreadable content is not classified."""
+        self.assertEqual(classify_pdf(b"not a pdf")["kind"], PDF_UNKNOWN)
+
+
+if __name__ == "__main__":
+    unittest.main()
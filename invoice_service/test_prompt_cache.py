@@ -0,0 +1,96 @@
+import asyncio
+import time
+import unittest
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+from google.genai import errors
+
+from prompt_cache import PromptCache
+
+
+class TestPromptCache(unittest.TestCase):
+    """Test cases for the explicit Gemini context cache of the system instruction."""
+
+    def setUp(self):
+        self.client = MagicMock()
+        self.client.aio.caches.create = AsyncMock(return_value=SimpleNamespace(name="cachedContents/prompt"))
+        self.client.aio.caches.update = AsyncMock()
+        self.client.aio.caches.delete = AsyncMock()
+        self.cache = PromptCache("system instruction", ttl_seconds=3600, refresh_margin=300, min_tokens=1)
+
+    def test_created_on_start(self):
+        """Test that the configured models are cached on startup and requests do not call the API."""
+        asyncio.run(self.cache.start(self.client, ["test-model", "", "test-model"]))
+
+        self.assertEqual(self.cache.get(self.client, "test-model"), "cachedContents/prompt")
+        self.client.aio.caches.create.assert_awaited_once()
+        _, kwargs = self.client.aio.caches.create.call_args
+        self.assertEqual(kwargs["config"].system_instruction, "system instruction")
+        self.assertEqual(kwargs["config"].ttl, "3600s")
+
+    def test_created_in_background(self):
+        """Test that a model requested later is cached once in the background while requests go inline."""
+        async def run():
+            names = [self.cache.get(self.client, "other-model") for _ in range(5)]
+            await asyncio.gather(*self.cache._tasks.values())
+            return names, self.cache.get(self.client, "other-model")
+
+        names, name = asyncio.run(run())
+        self.assertEqual(names, [None] * 5)
+        self.assertEqual(name, "cachedContents/prompt")
+        self.client.aio.caches.create.assert_awaited_once()
+
+    def test_refreshed_before_expiry(self):
+        """Test that the TTL of a cached content about to expire is extended instead of recreating it."""
+        asyncio.run(self.cache.start(self.client, ["test-model"]))
+        self.cache._entries["test-model"]["expires_at"] = time.monotonic() + 60
+
+        async def run():
+            name = self.cache.get(self.client, "test-model")
+            await asyncio.gather(*self.cache._tasks.values())
+            return name
+
+        self.assertEqual(asyncio.run(run()), "cachedContents/prompt")
+        self.client.aio.caches.update.assert_awaited_once()
+        self.client.aio.caches.create.assert_awaited_once()
+        self.assertGreater(self.cache._entries["test-model"]["expires_at"], time.monotonic() + 3000)
+
+    def test_creation_failure_falls_back_to_inline_prompt(self):
+        """Test that a model whose cache cannot be created is not retried on every request."""
+        self.client.aio.caches.create.side_effect = errors.ClientError(
+            400, {"error": {"message": "Cached content is too small", "status": "INVALID_ARGUMENT"}}
+        )
+
+        async def run():
+            await self.cache.start(self.client, ["test-model"])
+            return self.cache.get(self.client, "test-model")
+
+        self.assertIsNone(asyncio.run(run()))
+        self.assertEqual(self.cache._tasks, {})
+        self.client.aio.caches.create.assert_awaited_once()
+
+    def test_below_minimum_is_not_cached(self):
+        """Test that a prompt below the model's explicit cache minimum is sent inline without calling the API."""
+        cache = PromptCache("x" * 4 * 2000)
+        self.assertTrue(cache.cacheable("gemini-2.5-flash"))
+        self.assertFalse(cache.cacheable("gemini-2.5-pro"))
+
+        async def run():
+            await cache.start(self.client, ["gemini-2.5-pro"])
+            return cache.get(self.client, "gemini-2.5-pro")
+
+        self.assertIsNone(asyncio.run(run()))
+        self.client.aio.caches.create.assert_not_awaited()
+
+    def test_close_deletes_caches(self):
+        """Test that the cached contents are deleted on shutdown."""
+        async def run():
+            await self.cache.start(self.client, ["test-model"])
+            await self.cache.close(self.client)
+
+        asyncio.run(run())
+        self.client.aio.caches.delete.assert_awaited_once_with(name="cachedContents/prompt")
+
+if __name__ == "__main__":
+    unittest.main()
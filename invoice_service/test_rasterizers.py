@@ -0,0 +1,51 @@
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from rasterizers import get_rasterizer, PopplerRasterizer
+
+
+class TestRasterizers(unittest.TestCase):
+    """Test cases for the PDF rasterizer backends."""
+
+    pdf_path = "test/data/matejfanta-2505001.pdf"
+
+    def _read_pdf(self):
+        if not Path(self.pdf_path).exists():
+            self.skipTest(f"Test PDF file not found: {self.pdf_path}")
+        with open(self.pdf_path, "rb") as f:
+            return f.read()
+
+    def test_pdfium_renders_from_bytes(self):
+        """Test that the pdfium backend renders the first page in process."""
+        try:
+            rasterizer = get_rasterizer("pdfium", dpi=72, grayscale=True)
+        except RuntimeError:
+            self.skipTest("pypdfium2 is not installed")
+
+        pages = rasterizer.render(self._read_pdf(), 1)
+
+        self.assertEqual(len(pages), 1)
+        self.assertEqual(pages[0].mode, "L")
+        self.assertGreater(pages[0].width, 0)
+
+    @patch("pdf2image.convert_from_bytes")
+    def test_poppler_renders_page_range(self, mock_convert_from_bytes):
+        """Test that the poppler backend only asks pdftoppm for the needed pages."""
+        rasterizer = get_rasterizer("poppler", dpi=100, thread_count=2)
+        self.assertIsInstance(rasterizer, PopplerRasterizer)
+
+        rasterizer.render(b"%PDF", 5)
+
+        _, kwargs = mock_convert_from_bytes.call_args
+        self.assertEqual((kwargs["first_page"], kwargs["last_page"]), (1, 5))
+        self.assertEqual((kwargs["dpi"], kwargs["thread_count"], kwargs["fmt"]), (100, 2, "jpeg"))
+
+    def test_unknown_rasterizer(self):
+        """Test that an unknown backend name is rejected."""
+        with self.assertRaises(ValueError):
+            get_rasterizer("ghostscript")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import time
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+from rate_limiter import RateLimiter, TokenBucket, AdaptiveConcurrency, retry_after_seconds
+
+
+class QuotaError(Exception):
+    """Stand-in for a google.genai APIError."""
+
+    def __init__(self, code, retry_delay=None, headers=None):
+        super().__init__(f"{code} RESOURCE_EXHAUSTED")
+        self.code = code
+        details = [{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": retry_delay}] if retry_delay else []
+        self.details = {"error": {"code": code, "details": details}}
+        self.response = SimpleNamespace(headers=headers or {})
+
+
+class TestRateLimiter(unittest.TestCase):
+    """Test cases for the per-model rate limiter."""
+
+    def test_token_bucket_waits_for_budget(self):
+        """Test that a request beyond the budget waits for the refill instead of failing."""
+        async def run():
+            bucket = TokenBucket(per_minute=600)  # 10 tokens per second
+            await bucket.acquire(600)
+            start = time.monotonic()
+            await bucket.acquire(2)
+            return time.monotonic() - start
+
+        self.assertGreaterEqual(asyncio.run(run()), 0.15)
+
+    def test_retries_honor_retry_after(self):
+        """Test that 429 responses are retried after the hinted delay and lower the concurrency limit."""
+        limiter = RateLimiter(max_concurrency=8, max_retries=3)
+        calls = []
+
+        async def call():
+            calls.append(time.monotonic())
+            if len(calls) < 3:
+                raise QuotaError(429, retry_delay="0.05s")
+            return "response"
+
+        self.assertEqual(asyncio.run(limiter.run("test-model", 100, call)), "response")
+        self.assertEqual(len(calls), 3)
+        self.assertGreaterEqual(calls[1] - calls[0], 0.05)
+        # Both errors came within the cooldown, so they count as one congestion signal
+        self.assertEqual(int(limiter.for_model("test-model").concurrency.limit), 4)
+
+    def test_other_errors_are_not_retried(self):
+        """Test that errors other than 429/503 fail immediately and retries are bounded."""
+        limiter = RateLimiter(max_retries=1, base_delay=0.01)
+        calls = []
+
+        async def call(error):
+            calls.append(error)
+            raise error
+
+        with self.assertRaises(ValueError):
+            asyncio.run(limiter.run("test-model", 100, lambda: call(ValueError("bad request"))))
+        with self.assertRaises(QuotaError):
+            asyncio.run(limiter.run("test-model", 100, lambda: call(QuotaError(503))))
+        self.assertEqual(len(calls), 3)
+
+    def test_adaptive_concurrency(self):
+        """Test the additive increase and multiplicative decrease of the concurrency limit."""
+        concurrency = AdaptiveConcurrency(maximum=10, cooldown=0)
+        concurrency.on_overload()
+        concurrency.on_overload()
+        self.assertEqual(concurrency.limit, 2.5)
+        for _ in range(5):
+            concurrency.on_success()
+        self.assertGreater(concurrency.limit, 4)
+
+    def test_retry_after_header(self):
+        """Test that the Retry-After header is used when the error details carry no delay."""
+        self.assertEqual(retry_after_seconds(QuotaError(429, headers={"retry-after": "7"})), 7.0)
+        self.assertEqual(retry_after_seconds(QuotaError(429, retry_delay="12s")), 12.0)
+        self.assertIsNone(retry_after_seconds(QuotaError(429)))
+
+
+if __name__ == "__main__":
+    unittest.main()
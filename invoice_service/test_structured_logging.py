@@ -0,0 +1,64 @@
+import io
+import json
+import logging
+import unittest
+
+from structured_logging import JsonFormatter, start_queue_logging, stop_queue_logging, log_context
+
+
+class TestStructuredLogging(unittest.TestCase):
+    """Test cases for the queued JSON logging."""
+
+    def setUp(self):
+        self.logger = logging.getLogger("test_structured_logging")
+        self.logger.propagate = False
+        self.output = io.StringIO()
+        handler = logging.StreamHandler(self.output)
+        handler.setFormatter(JsonFormatter())
+        self.listener = start_queue_logging(self.logger, [handler], "INFO", {"llm_call": "DEBUG", "db_write": "ERROR"})
+
+    def tearDown(self):
+        if self.listener is not None:
+            stop_queue_logging(self.logger, self.listener)
+
+    def records(self):
+        stop_queue_logging(self.logger, self.listener)
+        self.listener = None
+        return [json.loads(line) for line in self.output.getvalue().splitlines()]
+
+    def test_context_fields(self):
+        """Test that records carry the request context and the stage fields passed as extra."""
+        with log_context(request_id="abc", file_id="id-1", model="test-model"):
+            self.logger.info("Stage conversion finished", extra={"stage": "conversion", "duration_ms": 12.5})
+        self.logger.info("Outside of a request")
+
+        first, second = self.records()
+        self.assertEqual(first["message"], "Stage conversion finished")
+        self.assertEqual(first["level"], "INFO")
+        self.assertEqual((first["request_id"], first["file_id"], first["model"]), ("abc", "id-1", "test-model"))
+        self.assertEqual((first["stage"], first["duration_ms"]), ("conversion", 12.5))
+        self.assertNotIn("request_id", second)
+
+    def test_stage_levels(self):
+        """Test that the level configured for a stage overrides the default level."""
+        self.logger.debug("Default debug")
+        self.logger.debug("LLM debug", extra={"stage": "llm_call"})
+        self.logger.warning("DB warning", extra={"stage": "db_write"})
+        self.logger.error("DB error", extra={"stage": "db_write"})
+
+        self.assertEqual([record["message"] for record in self.records()], ["LLM debug", "DB error"])
+
+    def test_exception(self):
+        """Test that the traceback of a logged exception is kept."""
+        try:
+            raise ValueError("broken")
+        except ValueError:
+            self.logger.exception("Failed")
+
+        record, = self.records()
+        self.assertEqual(record["message"], "Failed")
+        self.assertIn("ValueError: broken", record["exception"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+import json
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+
+class Trace:
+    """
+    Timeline of one extraction: a span per pipeline stage (recorded by metrics.observe_stage) and
+    request-level attributes such as page count, image bytes or the length of the converted text.
+    Stored with the history record, so a slow request can be analyzed after the fact.
+    """
+
+    def __init__(self):
+        self.trace_id = secrets.token_hex(16)
+        self.start_ns = time.time_ns()
+        self.spans: List[Dict[str, Any]] = []
+        self.attributes: Dict[str, Any] = {}
+
+    def add_span(self, stage: str, start_ns: int, end_ns: int, attributes: Dict[str, Any]):
+        self.spans.append({"stage": stage, "start_ns": start_ns, "end_ns": end_ns, "attributes": attributes})
+
+    def to_dict(self, end_ns: Optional[int] = None) -> Dict[str, Any]:
+        """JSON form stored in invoice_processes.trace_json."""
+        end_ns = end_ns or time.time_ns()
+        return {
+            "trace_id": self.trace_id,
+            "start": _isoformat(self.start_ns),
+            "end": _isoformat(end_ns),
+            "duration_ms": _milliseconds(end_ns - self.start_ns),
+            "attributes": self.attributes,
+            "spans": [
+                {
+                    "stage": span["stage"],
+                    "start": _isoformat(span["start_ns"]),
+                    "end": _isoformat(span["end_ns"]),
+                    "duration_ms": _milliseconds(span["end_ns"] - span["start_ns"]),
+                    **span["attributes"],
+                }
+                for span in sorted(self.spans, key=lambda span: span["start_ns"])
+            ],
+        }
+
+
+def _isoformat(timestamp_ns: int) -> str:
+    return datetime.fromtimestamp(timestamp_ns / 1e9).isoformat()
+
+
+def _milliseconds(duration_ns: int) -> float:
+    return round(duration_ns / 1e6, 1)
+
+
+# Trace of the request running in the current task, inherited by its worker threads
+_current: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current.get()
+
+
+def set_current_trace(trace: Optional[Trace]):
+    """Trace the rest of the current task (and the tasks and threads it starts)."""
+    _current.set(trace)
+
+
+@contextmanager
+def trace_context(trace: Trace) -> Iterator[Trace]:
+    """Trace the block, see set_current_trace."""
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+
+
+def set_trace_attributes(**attributes: Any):
+    """Add request-level attributes to the current trace (no-op outside a traced request)."""
+    trace = _current.get()
+    if trace is not None:
+        trace.attributes.update(attributes)
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": value if isinstance(value, str) else json.dumps(value)}
+
+
+def _otlp_attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+class OtlpFileExporter:
+    """
+    Append finished traces to a file in the OpenTelemetry OTLP/JSON format (one ExportTraceServiceRequest
+    per line, as read by the OpenTelemetry Collector's otlpjsonfile receiver): a root span for the request
+    with a child span per stage. Blocking, call it from a worker thread.
+    """
+
+    def __init__(self, path: Path, service_name: str = "invoice_service"):
+        self.path = Path(path)
+        self.service_name = service_name
+        self._lock = threading.Lock()
+
+    def export(self, trace: Trace, name: str, attributes: Dict[str, Any], end_ns: Optional[int] = None):
+        end_ns = end_ns or time.time_ns()
+        root_id = secrets.token_hex(8)
+        spans = [{
+            "traceId": trace.trace_id,
+            "spanId": root_id,
+            "name": name,
+            "kind": 2,  # SPAN_KIND_SERVER
+            "startTimeUnixNano": str(trace.start_ns),
+            "endTimeUnixNano": str(end_ns),
+            "attributes": _otlp_attributes({**attributes, **trace.attributes}),
+        }]
+        for span in trace.spans:
+            error = span["attributes"].get("error")
+            otlp_span = {
+                "traceId": trace.trace_id,
+                "spanId": secrets.token_hex(8),
+                "parentSpanId": root_id,
+                "name": span["stage"],
+                "kind": 1,  # SPAN_KIND_INTERNAL
+                "startTimeUnixNano": str(span["start_ns"]),
+                "endTimeUnixNano": str(span["end_ns"]),
+                "attributes": _otlp_attributes(span["attributes"]),
+            }
+            if error:
+                otlp_span["status"] = {"code": 2, "message": error}  # STATUS_CODE_ERROR
+            spans.append(otlp_span)
+        request = {"resourceSpans": [{
+            "resource": {"attributes": _otlp_attributes({"service.name": self.service_name})},
+            "scopeSpans": [{"scope": {"name": "invoice_service"}, "spans": spans}],
+        }]}
+
+        line = json.dumps(request) + "\n"
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
@@ -0,0 +1,203 @@
+import hashlib
+import io
+import json
+import shutil
+import tempfile
+import zipfile
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+from fastapi import UploadFile, HTTPException
+
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MB
+MULTIPART_OVERHEAD = 64 * 1024  # Room for the form fields and part headers around the file
+
+
+class UploadTooLargeError(Exception):
+    """Raised when an upload exceeds the configured maximum size."""
+
+
+class Upload:
+    """
+    Uploaded document in a spooled buffer: kept in memory up to `spool_size` bytes and moved to an
+    anonymous temporary file (deleted by the OS even if the process crashes) beyond that.
+    The SHA-256 of the content is computed while the upload is streamed in. Work that may outlive
+    the request owning the upload takes its own reference with retain(); the buffer is closed
+    when the last reference is.
+
+    Unlike tempfile.SpooledTemporaryFile, both buffer types are real buffered binary streams,
+    which MarkItDown's file type detection requires.
+    """
+
+    def __init__(self, buffer: BinaryIO, sha256: str, size: int):
+        self.buffer = buffer
+        self.sha256 = sha256
+        self.size = size
+        self._references = 1
+
+    @classmethod
+    async def from_upload_file(cls, file: UploadFile, max_size: int, spool_size: int,
+                               chunk_size: int = UPLOAD_CHUNK_SIZE) -> "Upload":
+        """Stream an upload in chunks into a spooled buffer, rejecting it as soon as it exceeds max_size."""
+        writer = _UploadWriter(max_size, spool_size)
+        try:
+            while True:
+                chunk = await file.read(chunk_size)
+                if not chunk:
+                    break
+                writer.write(chunk)
+        except BaseException:
+            writer.close()
+            raise
+        return writer.finish()
+
+    @classmethod
+    def from_stream(cls, stream: BinaryIO, max_size: int, spool_size: int,
+                    chunk_size: int = UPLOAD_CHUNK_SIZE) -> "Upload":
+        """Blocking variant of from_upload_file for file-like objects (e.g. ZIP archive members)."""
+        writer = _UploadWriter(max_size, spool_size)
+        try:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                writer.write(chunk)
+        except BaseException:
+            writer.close()
+            raise
+        return writer.finish()
+
+    @classmethod
+    def from_bytes(cls, content: bytes) -> "Upload":
+        """Wrap content that is already in memory (e.g. a stored job payload)."""
+        return cls(io.BytesIO(content), hashlib.sha256(content).hexdigest(), len(content))
+
+    def read_bytes(self) -> bytes:
+        """Return the whole content (used when it has to be persisted)."""
+        self.buffer.seek(0)
+        return self.buffer.read()
+
+    def retain(self) -> "Upload":
+        """Take a reference keeping the buffer open until a matching close()."""
+        self._references += 1
+        return self
+
+    def close(self):
+        self._references -= 1
+        if self._references <= 0:
+            self.buffer.close()
+
+
+class _UploadWriter:
+    """Accumulates chunks into a spooled buffer while hashing them and enforcing the size limit."""
+
+    def __init__(self, max_size: int, spool_size: int):
+        self.max_size = max_size
+        self.spool_size = spool_size
+        self.buffer: BinaryIO = io.BytesIO()
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.max_size and self.size > self.max_size:
+            raise UploadTooLargeError(f"Upload exceeds the maximum size of {self.max_size} bytes")
+        self.digest.update(chunk)
+        if self.spool_size and self.size > self.spool_size and isinstance(self.buffer, io.BytesIO):
+            self.buffer = _roll_over(self.buffer)
+        self.buffer.write(chunk)
+
+    def finish(self) -> Upload:
+        self.buffer.seek(0)
+        return Upload(self.buffer, self.digest.hexdigest(), self.size)
+
+    def close(self):
+        self.buffer.close()
+
+
+def expand_zip(archive: Upload, max_size: int, spool_size: int, max_files: int) -> List[Tuple[str, Upload]]:
+    """
+    Extract the files of a ZIP archive into uploads, in archive order (blocking, run in a worker thread).
+    Directories and hidden or macOS metadata entries are skipped; every member is held to the same size
+    limit as a single upload, checked on the decompressed bytes so a ZIP bomb cannot exhaust the disk.
+    """
+    uploads: List[Tuple[str, Upload]] = []
+    try:
+        with zipfile.ZipFile(archive.buffer) as zip_file:
+            for info in zip_file.infolist():
+                name = info.filename.rsplit("/", 1)[-1]
+                if info.is_dir() or not name or name.startswith(".") or info.filename.startswith("__MACOSX/"):
+                    continue
+                if max_files and len(uploads) >= max_files:
+                    raise UploadTooLargeError(f"ZIP archive contains more than {max_files} files")
+                with zip_file.open(info) as member:
+                    uploads.append((name, Upload.from_stream(member, max_size, spool_size)))
+    except BaseException:
+        for _, upload in uploads:
+            upload.close()
+        raise
+    return uploads
+
+
+def _roll_over(buffer: io.BytesIO) -> BinaryIO:
+    """Move the in-memory buffer content to an anonymous temporary file."""
+    file = tempfile.TemporaryFile()
+    buffer.seek(0)
+    shutil.copyfileobj(buffer, file)
+    buffer.close()
+    return file
+
+
+class MaxBodySizeMiddleware:
+    """
+    ASGI middleware rejecting request bodies larger than `max_body_size` with HTTP 413.
+
+    Requests with a larger Content-Length are refused before the body is read; for chunked requests
+    the received bytes are counted and the request is aborted as soon as the limit is crossed,
+    so an oversized upload is never fully buffered by the multipart parser.
+    `path_limits` sets a different limit for specific paths (0 = unlimited).
+    """
+
+    def __init__(self, app, max_body_size: int, path_limits: Optional[Dict[str, int]] = None):
+        self.app = app
+        self.max_body_size = max_body_size
+        self.path_limits = path_limits or {}
+
+    async def __call__(self, scope, receive, send):
+        max_body_size = self.path_limits.get(scope.get("path"), self.max_body_size) if scope["type"] == "http" else 0
+        if not max_body_size:
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        content_length = headers.get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > max_body_size:
+            await self._reject(send, max_body_size)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_body_size:
+                    # Raised while the multipart parser reads the body, turned into a 413 response
+                    raise HTTPException(status_code=413, detail=self._detail(max_body_size))
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+    @staticmethod
+    def _detail(max_body_size: int) -> str:
+        return f"Request body exceeds the maximum size of {max_body_size} bytes"
+
+    async def _reject(self, send, max_body_size: int):
+        body = json.dumps({"detail": self._detail(max_body_size)}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})